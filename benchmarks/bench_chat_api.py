@@ -0,0 +1,337 @@
+"""
+Load benchmark of the chat API through the full main.app stack
+
+Requests go through CORS, the JWT middleware (with real signed tokens),
+New Relic naming and the routes. The database is the in-memory stand-in,
+and the users service and Expo are local stubs. All three have
+configurable latency. Workers keep a fixed concurrency and pick
+operations from a weighted mix.
+
+The report is JSON with, per operation and in total, the throughput and
+the p50/p95/p99 latencies. Given a baseline report, the run fails when
+throughput drops or a latency percentile grows by more than the
+allowed regression. The New Relic agent logs to stdout as configured in
+newrelic.ini, so use --output to get a clean JSON file.
+
+Usage:
+    python benchmarks/bench_chat_api.py [--duration S] [--concurrency N]
+        [--mix send=50,edit=10,delete=5,create=5,messages=20,inbox=10]
+        [--db-latency S] [--users-latency S] [--expo-latency S]
+        [--output FILE] [--baseline FILE] [--max-regression 0.1]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+CWD = os.getcwd()
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+# main initializes New Relic from newrelic.ini in the working directory
+os.chdir(ROOT)
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from repository.async_firebase_db import AsyncFirebaseDB  # noqa: E402
+from repository.firebase_db import ParticipantsCache  # noqa: E402
+from repository.memory_db import MemoryDatabase  # noqa: E402
+from repository.updated_at_buffer import UpdatedAtBuffer  # noqa: E402
+from service.container import Container  # noqa: E402
+from service.jwt_service import JWTService  # noqa: E402
+from service.users_service import UsersService  # noqa: E402
+from utils.push_dispatcher import PushDispatcher  # noqa: E402
+from utils.rate_limiter import RateLimiter  # noqa: E402
+
+OPERATIONS = ("create", "send", "edit", "delete", "messages", "inbox")
+DEFAULT_MIX = "send=50,edit=10,delete=5,create=5,messages=20,inbox=10"
+PERCENTILES = (50, 95, 99)
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name}")
+
+        weights[name] = float(weight)
+
+    return weights
+
+
+def stub_client(latency: float, respond) -> httpx.AsyncClient:
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if latency:
+            await asyncio.sleep(latency)
+
+        return respond(request)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def percentile(latencies: list[float], p: float) -> float:
+    # Nearest rank on sorted latencies
+    index = max(int(len(latencies) * p / 100 + 0.5) - 1, 0)
+
+    return latencies[min(index, len(latencies) - 1)]
+
+
+class Workload:
+    def __init__(self, users: int, chats: int, seed: int):
+        jwt_service = JWTService()
+
+        self.random = random.Random(seed)
+        self.users = [{"id": n, "username": f"bench{n}"} for n in range(1, users + 1)]
+        self.headers = {
+            user["id"]: {"Authorization": "Bearer " + jwt_service.sign(
+                {"type": "user", "userId": user["id"], "email": f"{user['username']}@bench.dev", "username": user["username"]})}
+            for user in self.users
+        }
+        self.chats: list[tuple[str, int, int]] = []
+        self.messages: dict[str, list[tuple[str, int]]] = {}
+        self.initial_chats = chats
+
+    async def setup(self, client: httpx.AsyncClient) -> None:
+        for _ in range(self.initial_chats):
+            await self.create(client)
+
+        for chat_id, *_ in list(self.chats):
+            for _ in range(5):
+                await self.send(client, chat_id)
+
+    async def create(self, client: httpx.AsyncClient, *_) -> httpx.Response:
+        user1, user2 = self.random.sample(self.users, 2)
+        response = await client.post("/chats", json={"user1": user1, "user2": user2}, headers=self.headers[user1["id"]])
+
+        if response.status_code == 201 and response.json()["id"] not in self.messages:
+            self.chats.append((response.json()["id"], user1["id"], user2["id"]))
+            self.messages[response.json()["id"]] = []
+
+        return response
+
+    async def send(self, client: httpx.AsyncClient, chat_id: str | None = None) -> httpx.Response:
+        chat_id, user1, user2 = next(chat for chat in self.chats if chat[0] == chat_id) if chat_id else self.random.choice(self.chats)
+        sender = self.random.choice((user1, user2))
+
+        response = await client.post(
+            f"/chats/{chat_id}",
+            json={"content": "x" * self.random.randint(1, 280), "receiver_expo_token": f"ExponentPushToken[{user1 + user2 - sender}]"},
+            headers=self.headers[sender]
+        )
+
+        if response.status_code == 201:
+            self.messages[chat_id].append((response.json()["id"], sender))
+
+        return response
+
+    def _own_message(self) -> tuple[str, str, int] | None:
+        chat_id = self.random.choice(self.chats)[0]
+
+        if not self.messages[chat_id]:
+            return None
+
+        message_id, sender = self.random.choice(self.messages[chat_id])
+
+        return chat_id, message_id, sender
+
+    async def edit(self, client: httpx.AsyncClient) -> httpx.Response:
+        target = self._own_message()
+
+        if target is None:
+            return await self.send(client)
+
+        chat_id, message_id, sender = target
+
+        return await client.patch(f"/chats/{chat_id}/messages/{message_id}", json={"content": "edited"}, headers=self.headers[sender])
+
+    async def delete(self, client: httpx.AsyncClient) -> httpx.Response:
+        target = self._own_message()
+
+        if target is None:
+            return await self.send(client)
+
+        chat_id, message_id, sender = target
+        self.messages[chat_id].remove((message_id, sender))
+
+        return await client.delete(f"/chats/{chat_id}/messages/{message_id}", headers=self.headers[sender])
+
+    async def messages_page(self, client: httpx.AsyncClient) -> httpx.Response:
+        chat_id, user1, _ = self.random.choice(self.chats)
+
+        return await client.get(f"/chats/{chat_id}/messages?limit=20", headers=self.headers[user1])
+
+    async def inbox(self, client: httpx.AsyncClient) -> httpx.Response:
+        _, user1, _ = self.random.choice(self.chats)
+
+        return await client.get("/chats?limit=20", headers=self.headers[user1])
+
+    def operation(self, name: str):
+        return {
+            "create": self.create,
+            "send": self.send,
+            "edit": self.edit,
+            "delete": self.delete,
+            "messages": self.messages_page,
+            "inbox": self.inbox
+        }[name]
+
+
+async def run(args: argparse.Namespace) -> dict:
+    database = MemoryDatabase(latency=args.db_latency,
+                              jitter=args.db_jitter, seed=args.seed)
+
+    users_service = UsersService(
+        stub_client(args.users_latency,
+                    lambda request: httpx.Response(200, json={})),
+        "http://users-service"
+    )
+
+    container = Container(
+        users_service=users_service,
+        repository=AsyncFirebaseDB(database.reference(), ParticipantsCache(),
+                                   UpdatedAtBuffer(database.reference())),
+        push_dispatcher=PushDispatcher(stub_client(
+            args.expo_latency, lambda request: httpx.Response(200, json={"data": []}))),
+        # A few simulated users write far faster than real ones, the limiter
+        # still runs but never rejects
+        rate_limiter=RateLimiter(user_rate=1e9, user_burst=1e9,
+                                 chat_rate=1e9, chat_burst=1e9)
+    )
+    main.app.state.container = container
+    await container.start(warm_up=False)
+
+    weights = parse_mix(args.mix)
+    workload = Workload(args.users, args.chats, args.seed)
+    latencies: dict[str, list[float]] = {name: [] for name in weights}
+    errors: dict[str, int] = {name: 0 for name in weights}
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app, raise_app_exceptions=False), base_url="http://bench") as client:
+        await workload.setup(client)
+
+        async def worker(deadline: float, record: bool) -> None:
+            while time.perf_counter() < deadline:
+                name = workload.random.choices(
+                    list(weights), list(weights.values()))[0]
+
+                start = time.perf_counter()
+                response = await workload.operation(name)(client)
+                elapsed = time.perf_counter() - start
+
+                if record:
+                    latencies[name].append(elapsed)
+                    errors[name] += not response.is_success
+
+        warmup_deadline = time.perf_counter() + args.warmup
+        await asyncio.gather(*(worker(warmup_deadline, False) for _ in range(args.concurrency)))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(start + args.duration, True) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+    await container.aclose()
+
+    def summarize(samples: list[float], failed: int) -> dict:
+        samples = sorted(samples)
+        summary: dict = {
+            "requests": len(samples),
+            "errors": failed,
+            "throughput": len(samples) / elapsed
+        }
+
+        for p in PERCENTILES:
+            summary[f"p{p}_ms"] = percentile(samples, p) * 1000 if samples else None
+
+        return summary
+
+    return {
+        "config": {
+            key: getattr(args, key) for key in
+            ("duration", "warmup", "concurrency", "users", "chats", "mix", "db_latency", "db_jitter", "users_latency", "expo_latency", "seed")
+        },
+        "operations": {name: summarize(latencies[name], errors[name]) for name in weights},
+        "total": summarize([value for samples in latencies.values() for value in samples], sum(errors.values())),
+        "database": {"reads": database.reads, "writes": database.writes}
+    }
+
+
+def regressions(report: dict, baseline: dict, max_regression: float) -> list[str]:
+    """Describe every metric of the report that regressed past the baseline"""
+    found = []
+    results = {**report["operations"], "total": report["total"]}
+    expected = {**baseline["operations"], "total": baseline["total"]}
+
+    for name, result in results.items():
+        if name not in expected:
+            continue
+
+        before = expected[name]
+
+        if before["throughput"] and result["throughput"] < before["throughput"] * (1 - max_regression):
+            found.append(
+                f"{name} throughput {result['throughput']:.1f} < {before['throughput']:.1f} req/s")
+
+        for p in PERCENTILES:
+            key = f"p{p}_ms"
+
+            if before.get(key) and result.get(key) and result[key] > before[key] * (1 + max_regression):
+                found.append(
+                    f"{name} {key} {result[key]:.2f} > {before[key]:.2f}")
+
+        if result["errors"] > before["errors"]:
+            found.append(
+                f"{name} errors {result['errors']} > {before['errors']}")
+
+    return found
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--db-latency", type=float, default=0.005)
+    parser.add_argument("--db-jitter", type=float, default=0.002)
+    parser.add_argument("--users-latency", type=float, default=0.005)
+    parser.add_argument("--expo-latency", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--baseline", help="Fail if the run regressed past this report")
+    parser.add_argument("--max-regression", type=float, default=0.1,
+                        help="Allowed relative regression of each metric")
+    args = parser.parse_args()
+    parse_mix(args.mix)
+
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+
+    if args.output:
+        with open(os.path.join(CWD, args.output), "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(os.path.join(CWD, args.baseline)) as file:
+            found = regressions(report, json.load(file), args.max_regression)
+
+        for regression in found:
+            print(f"regression: {regression}", file=sys.stderr)
+
+        if found:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
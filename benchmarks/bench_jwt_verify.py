@@ -0,0 +1,49 @@
+"""
+Compare cached and uncached JWT verification throughput
+
+Usage:
+    python benchmarks/bench_jwt_verify.py [--iterations N] [--tokens N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from service.jwt_service import JWTService  # noqa: E402
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--tokens", type=int, default=100,
+                        help="distinct tokens verified round robin")
+    args = parser.parse_args()
+
+    cached = JWTService()
+    uncached = JWTService(cache_size=0)
+
+    tokens = [
+        cached.sign({  # type: ignore
+            "type": "user", "userId": user_id, "email": f"user{user_id}@gmail.com", "username": f"user{user_id}"
+        })
+        for user_id in range(args.tokens)
+    ]
+
+    for name, service in (("uncached", uncached), ("cached", cached)):
+        position = iter(range(args.iterations))
+
+        def verify() -> None:
+            service.verify(tokens[next(position) % len(tokens)])
+
+        elapsed = timeit.timeit(verify, number=args.iterations)
+
+        print(
+            f"{name:>8}: {args.iterations / elapsed:>12,.0f} verifications/s"
+            f" ({elapsed / args.iterations * 1e6:.2f} us each)"
+        )
+
+
+if __name__ == "__main__":
+    main()
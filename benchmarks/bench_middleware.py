@@ -0,0 +1,161 @@
+"""
+Measure the overhead of the old and new authentication middleware stacks
+
+The old stack is CORS + BaseHTTPMiddleware(dispatch=JWTMiddleware) + the
+@app.middleware("http") New Relic hook, the new one is CORS + the pure ASGI
+JWTMiddleware. Both run in-process with a stubbed JWT service and a warm
+users service cache, so the numbers only reflect middleware overhead.
+
+Usage:
+    python benchmarks/bench_middleware.py [--requests N] [--concurrency N]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fastapi import FastAPI, Request  # noqa: E402
+from fastapi.middleware.cors import CORSMiddleware  # noqa: E402
+from fastapi.security import HTTPBearer  # noqa: E402
+from starlette.middleware.base import BaseHTTPMiddleware  # noqa: E402
+import httpx  # noqa: E402
+import newrelic.agent  # noqa: E402
+
+from middleware.auth_middleware import JWTMiddleware  # noqa: E402
+from service.jwt_service import JWTService  # noqa: E402
+from service.users_service import UsersService  # noqa: E402
+
+
+class StubJWTService(JWTService):
+    def __init__(self):
+        pass
+
+    def verify(self, token: str) -> dict:
+        return {"type": "user", "userId": 1, "email": "bench@gmail.com", "username": "bench"}
+
+
+def build_users_service() -> UsersService:
+    service = UsersService(
+        httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, json={}))),
+        "http://users-service"
+    )
+    service.cache.set("bench", 200)
+
+    return service
+
+
+class LegacyJWTDispatch:
+    """The BaseHTTPMiddleware dispatch this service used before"""
+
+    def __init__(self):
+        self.jwt_service = StubJWTService()
+        self.security = HTTPBearer()
+        self.users_service = build_users_service()
+
+    async def __call__(self, request: Request, call_next):
+        if request.method == "OPTIONS" or request.method == "REDIRECT":
+            return await call_next(request)
+
+        credentials = await self.security(request)
+        token = credentials.credentials  # type: ignore
+        payload = self.jwt_service.verify(token)
+
+        await self.users_service.check_blocked(payload["username"], token)
+
+        request.state.user = payload
+        return await call_next(request)
+
+
+def add_route(app: FastAPI) -> None:
+    @app.get("/chats/{id}")
+    async def get_chat(id: str, request: Request) -> dict:
+        return {"id": id, "user": request.state.user["userId"]}
+
+
+def add_cors(app: FastAPI) -> None:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+
+def build_legacy_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.middleware("http")
+    async def add_new_relic_transaction(request, call_next):
+        transaction = newrelic.agent.current_transaction()
+        if transaction:
+            newrelic.agent.set_transaction_name(
+                f"{request.method} {request.url.path}")
+        return await call_next(request)
+
+    add_cors(app)
+    app.add_middleware(BaseHTTPMiddleware, dispatch=LegacyJWTDispatch())
+    add_route(app)
+
+    return app
+
+
+def build_asgi_app() -> FastAPI:
+    app = FastAPI()
+
+    add_cors(app)
+    app.add_middleware(JWTMiddleware, jwt_service=StubJWTService(),
+                       users_service=build_users_service())
+    add_route(app)
+
+    return app
+
+
+async def run(app: FastAPI, requests: int, concurrency: int) -> list[float]:
+    latencies: list[float] = []
+    pending = iter(range(requests))
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        async def worker() -> None:
+            for n in pending:
+                start = time.perf_counter()
+                response = await client.get(f"/chats/{n}", headers={"Authorization": "Bearer bench"})
+                latencies.append(time.perf_counter() - start)
+                assert response.status_code == 200, response.text
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    return latencies
+
+
+def report(name: str, latencies: list[float], elapsed: float) -> None:
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[int(len(latencies) * 0.99)]
+
+    print(
+        f"{name:>6}: {len(latencies) / elapsed:>9,.0f} req/s"
+        f"  p50 {p50 * 1e6:>7.1f} us  p99 {p99 * 1e6:>7.1f} us"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    for name, app in (("legacy", build_legacy_app()), ("asgi", build_asgi_app())):
+        await run(app, 200, args.concurrency)
+
+        start = time.perf_counter()
+        latencies = await run(app, args.requests, args.concurrency)
+        report(name, latencies, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
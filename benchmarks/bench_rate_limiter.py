@@ -0,0 +1,59 @@
+"""
+Measure the cost of the write rate limiter per request
+
+Each check takes a token from the bucket of a user and of a chat, spread
+over many keys so the buckets do not fit in a handful of cache lines.
+Limits are high enough for every check to pass, which is the common path.
+
+Usage:
+    python benchmarks/bench_rate_limiter.py [--iterations N] [--users N] [--chats N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from utils.rate_limiter import RateLimiter  # noqa: E402
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--chats", type=int, default=50000)
+    args = parser.parse_args()
+
+    limiter = RateLimiter(user_rate=1e9, user_burst=1e9,
+                          chat_rate=1e9, chat_burst=1e9)
+    keys = [
+        (n % args.users, f"chat{n % args.chats}")
+        for n in range(max(args.users, args.chats))
+    ]
+
+    for user_id, chat_id in keys:
+        limiter.check(user_id, chat_id)
+
+    position = iter(range(args.iterations))
+
+    def check() -> None:
+        user_id, chat_id = keys[next(position) % len(keys)]
+        limiter.check(user_id, chat_id)
+
+    def baseline() -> None:
+        keys[next(position) % len(keys)]
+
+    elapsed = timeit.timeit(check, number=args.iterations)
+    position = iter(range(args.iterations))
+    overhead = timeit.timeit(baseline, number=args.iterations)
+
+    print(
+        f"{args.iterations / elapsed:>12,.0f} checks/s"
+        f" ({(elapsed - overhead) / args.iterations * 1e6:.3f} us each,"
+        f" excluding {overhead / args.iterations * 1e6:.3f} us of loop overhead)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+One-off backfills of the RTDB indexes
+
+Run from the repository root:
+    PYTHONPATH=src python -m commands.backfill chat-pairs [--dry-run]
+    PYTHONPATH=src python -m commands.backfill user-chats [--dry-run]
+"""
+import argparse
+import logging
+from typing import Any, Iterator
+
+import dotenv
+from firebase_admin import db
+
+from repository.firebase_db import init_firebase
+from repository.rtdb_paths import chat_pair_key, user_chat_entry
+
+PAGE_SIZE = 500
+
+
+def iter_chats(root: db.Reference, page_size: int = PAGE_SIZE) -> Iterator[tuple[str, dict]]:
+    """Iterate every chat in key order, one page at a time"""
+    chats_ref = root.child('chats')
+    last_key: str | None = None
+
+    while True:
+        query = chats_ref.order_by_key()
+
+        if last_key is not None:
+            query = query.start_at(last_key)
+
+        page: dict[str, Any] = query.limit_to_first(page_size + 1).get() or {}  # type: ignore
+
+        keys = sorted(page)
+        has_more = len(keys) > page_size
+
+        # start_at is inclusive, the first key was already yielded
+        if last_key is not None and keys and keys[0] == last_key:
+            keys = keys[1:]
+
+        keys = keys[:page_size]
+
+        for key in keys:
+            yield key, page[key]
+
+        if not has_more or not keys:
+            return
+
+        last_key = keys[-1]
+
+
+def build_chat_pairs(chats: Iterator[tuple[str, dict]], existing: dict[str, str]) -> dict[str, str]:
+    """
+    Build the missing chat_pairs entries
+
+    Chats are expected in key order, so when a pair has duplicated chats the
+    oldest one wins.
+
+    Returns:
+        dict[str, str]: Multi-path update of the missing entries
+    """
+    updates: dict[str, str] = {}
+    seen = set(existing)
+
+    for chat_id, chat in chats:
+        participants = chat.get("participants")
+
+        if not participants:
+            logging.warning(f"chat {chat_id} has no participants, skipping")
+            continue
+
+        pair_key = chat_pair_key(
+            participants["user1"]["id"], participants["user2"]["id"])
+
+        if pair_key in seen:
+            continue
+
+        seen.add(pair_key)
+        updates[f"chat_pairs/{pair_key}"] = chat_id
+
+    return updates
+
+
+def build_user_chats(chats: Iterator[tuple[str, dict]]) -> dict[str, Any]:
+    """
+    Build the user_chats entries of both participants of every chat
+
+    Fields are written one path each, so the unread counter and the read
+    watermark of entries already in use are kept.
+
+    Returns:
+        dict[str, Any]: Multi-path update of the entries
+    """
+    updates: dict[str, Any] = {}
+
+    for chat_id, chat in chats:
+        participants = chat.get("participants")
+
+        if not participants or not chat.get("created_at"):
+            logging.warning(f"chat {chat_id} is incomplete, skipping")
+            continue
+
+        entry = user_chat_entry(chat)
+
+        for user in ("user1", "user2"):
+            for field, value in entry.items():
+                updates[f"user_chats/{participants[user]['id']}/{chat_id}/{field}"] = value
+
+    return updates
+
+
+def write_updates(root: db.Reference, updates: dict[str, Any], chunk_size: int = PAGE_SIZE) -> None:
+    paths = list(updates)
+
+    for start in range(0, len(paths), chunk_size):
+        root.update({path: updates[path]
+                    for path in paths[start:start + chunk_size]})
+
+
+def backfill_chat_pairs(root: db.Reference, dry_run: bool = False) -> int:
+    existing: dict[str, str] = root.child('chat_pairs').get() or {}  # type: ignore
+
+    updates = build_chat_pairs(iter_chats(root), existing)
+
+    if not dry_run:
+        write_updates(root, updates)
+
+    return len(updates)
+
+
+def backfill_user_chats(root: db.Reference, dry_run: bool = False) -> int:
+    updates = build_user_chats(iter_chats(root))
+
+    if not dry_run:
+        write_updates(root, updates)
+
+    return len(updates)
+
+
+BACKFILLS = {
+    "chat-pairs": backfill_chat_pairs,
+    "user-chats": backfill_user_chats
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Backfill RTDB indexes")
+    parser.add_argument("index", choices=sorted(BACKFILLS))
+    parser.add_argument("--dry-run", action="store_true",
+                        help="count the missing entries without writing them")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    dotenv.load_dotenv()
+    init_firebase()
+
+    written = BACKFILLS[args.index](db.reference('/'), args.dry_run)
+
+    logging.info(
+        f"{args.index}: {written} entries {'missing' if args.dry_run else 'written'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+Broker of the socket event bus, run it next to the workers of a host
+started with EVENT_BUS=socket
+
+Run from the repository root:
+    PYTHONPATH=src python -m commands.event_broker [--socket PATH]
+"""
+import argparse
+import asyncio
+import logging
+
+import dotenv
+
+from utils.event_bus import EventBroker
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Route chat events between the workers of a host")
+    parser.add_argument("--socket", default=None,
+                        help="Unix socket to listen on, defaults to EVENT_BUS_SOCKET")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    dotenv.load_dotenv()
+
+    broker = EventBroker(args.socket)
+    logging.info(f"routing events on {broker.path}")
+
+    asyncio.run(broker.serve_forever())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
-import base64
-import json
+from contextlib import asynccontextmanager
 import logging
 from os import getenv
 import dotenv
@@ -9,26 +8,34 @@ from fastapi.responses import JSONResponse
 import uvicorn
 
 import routes.chat_routes as chat_routes
+import routes.metrics_routes as metrics_routes
+import routes.user_routes as user_routes
 from middleware.auth_middleware import JWTMiddleware
 from middleware.error_handler import error_handler
-from starlette.middleware.base import BaseHTTPMiddleware
-import firebase_admin
-from firebase_admin import credentials, db
+from middleware.metrics_middleware import MetricsMiddleware
+from service.container import Container
 
 import newrelic.agent
 newrelic.agent.initialize('newrelic.ini')
 
-app = FastAPI()
+# Loaded at import so `uvicorn main:app` gets the same settings
+dotenv.load_dotenv()
 
+container = Container()
 
-@app.middleware("http")
-async def add_new_relic_transaction(request, call_next):
-    transaction = newrelic.agent.current_transaction()
-    if transaction:
-        newrelic.agent.set_transaction_name(
-            f"{request.method} {request.url.path}")
-    response = await call_next(request)
-    return response
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs once per worker, whatever launched it
+    await app.state.container.start()
+
+    yield
+
+    await app.state.container.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+app.state.container = container
 
 
 @app.exception_handler(HTTPException)
@@ -44,36 +51,27 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Add JWT middleware
-app.add_middleware(BaseHTTPMiddleware, dispatch=JWTMiddleware())
+# Add JWT middleware, it also names the New Relic transaction
+app.add_middleware(JWTMiddleware, public_paths=["/health", "/metrics"])
 
+# Added last so it is the outermost middleware and times everything
+app.add_middleware(MetricsMiddleware)
 
-app.include_router(chat_routes.router, prefix="/chats", tags=["chats"])
 
+@app.get("/health", summary="Health check", include_in_schema=False)
+async def health() -> dict:
+    return {"status": "ok"}
 
-def init_firebase():
-    try:
-        cred = credentials.Certificate('src/serviceAccountKey.json')
 
-    except:
-        cred = credentials.Certificate(json.loads(
-            base64.b64decode(getenv("SERVICE_ACCOUNT_KEY")).decode('utf-8')))  # type: ignore
-
-    firebase_admin.initialize_app(cred, {
-        'databaseURL': getenv("DATABASE_URL")
-    })
-
-    logging.info("Firebase initialized")
+app.include_router(chat_routes.router, prefix="/chats", tags=["chats"])
+app.include_router(user_routes.router, prefix="/users", tags=["users"])
+app.include_router(metrics_routes.router, prefix="/metrics", tags=["metrics"])
 
 
 if __name__ == "__main__":
     logging.basicConfig(
         level=logging.INFO, format='%(name)s - %(levelname)s - %(message)s - %(asctime)s', filename='logs.log')
 
-    dotenv.load_dotenv()
-
-    init_firebase()
-
     HOST: str = getenv("HOST") or "0.0.0.0"
     PORT: int = int(getenv("PORT") or 8082)
 
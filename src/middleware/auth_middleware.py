@@ -1,61 +1,117 @@
-from os import getenv
-from fastapi import HTTPException, Request
+from typing import Iterable
+from fastapi import HTTPException, Request, WebSocket, status
+from fastapi.requests import HTTPConnection
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-import httpx
-from models.errors.errors import AuthenticationError, BlockedError, NotFoundError, ServiceUnavailableError, ValidationError
+from starlette.types import ASGIApp, Receive, Scope, Send
+from middleware.error_handler import error_handler
+from models.errors.errors import AuthenticationError
 from models.jwt import JwtCustomPayload
+from routes.dependencies import get_users_service
 from service.jwt_service import JWTService
-import requests
-import logging
+from service.users_service import UsersService
+from utils.metrics import timed
+
+import newrelic.agent
 
 
 class JWTMiddleware:
-    def __init__(self, jwt_service: JWTService | None = None, security: HTTPBearer | None = None):
+    def __init__(self, app: ASGIApp, jwt_service: JWTService | None = None, security: HTTPBearer | None = None, users_service: UsersService | None = None, public_paths: Iterable[str] = ()):
+        """
+        Pure ASGI middleware that names the New Relic transaction,
+        authenticates the bearer token and checks the user is not blocked
+
+        WebSockets are authenticated the same way before the handshake is
+        accepted. Browsers can not set headers on them, so their token may
+        also come in the `token` query parameter.
+
+        Args:
+            app: The wrapped ASGI application
+            jwt_service: Service used to verify tokens
+            security: Extracts the bearer credentials from the request
+            users_service: Service used to check the user is not blocked,
+                defaults to the one of the app's container, looked up on
+                every request so replacing the container is enough
+            public_paths: Paths served without authentication, e.g. a health check
+        """
+        self.app = app
         self.jwt_service = jwt_service or JWTService()
         self.security = security or HTTPBearer()
+        self.users_service = users_service
+        self.public_paths = frozenset(public_paths)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "websocket":
+            await self._authenticate_websocket(scope, receive, send)
+            return
+
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        self._set_transaction_name(scope)
+
+        if scope["method"] == "OPTIONS" or scope["method"] == "REDIRECT" or scope["path"] in self.public_paths:
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope)
+
+        try:
+            payload = await self._authenticate(request)
+        except HTTPException as e:
+            response = error_handler(request, e)
+            await response(scope, receive, send)
+            return
 
-    async def __call__(self, request: Request, call_next):
-        if request.method == "OPTIONS" or request.method == "REDIRECT":
-            response = await call_next(request)
-            return response
+        scope.setdefault("state", {})["user"] = payload
 
-        credentials: HTTPAuthorizationCredentials | None = await self.security(request)
+        await self.app(scope, receive, send)
 
-        if not credentials:
-            raise AuthenticationError()
+    async def _authenticate_websocket(self, scope: Scope, receive: Receive, send: Send) -> None:
+        websocket = WebSocket(scope, receive, send)
+
+        try:
+            payload = await self._authenticate(websocket)
+        except HTTPException:
+            # Closing before accepting rejects the handshake
+            await websocket.close(status.WS_1008_POLICY_VIOLATION)
+            return
+
+        scope.setdefault("state", {})["user"] = payload
+
+        await self.app(scope, receive, send)
+
+    async def _authenticate(self, connection: HTTPConnection) -> JwtCustomPayload:
+        token = connection.query_params.get(
+            "token") if connection.scope["type"] == "websocket" else None
+
+        if token is None:
+            credentials: HTTPAuthorizationCredentials | None = await self.security(connection)  # type: ignore
+
+            if not credentials:
+                raise AuthenticationError()
+
+            token = credentials.credentials
 
-        token = credentials.credentials
         payload = self.jwt_service.verify(token)
 
-        await self._check_blocked(payload, token)  # type: ignore
+        await self._check_blocked(connection, payload, token)  # type: ignore
 
-        request.state.user = payload
-        response = await call_next(request)
-        return response
+        return payload  # type: ignore
 
-    async def _check_blocked(self, decodedToken: JwtCustomPayload, token: str) -> None:
+    @timed("users_service", "check_blocked")
+    async def _check_blocked(self, connection: HTTPConnection, decodedToken: JwtCustomPayload, token: str) -> None:
         if decodedToken["type"] == 'admin':
             return
 
-        response = requests.get(
-            f"{getenv('USERS_SERVICE_URL')}/users/{decodedToken['username']}",
-            headers={"Authorization": f"Bearer {token}"}
-        )
+        users_service = self.users_service or get_users_service(connection)
 
-        data = response.json()
+        await users_service.check_blocked(
+            decodedToken['username'], token
+        )
 
-        match response.status_code:
-            case 400:
-                raise ValidationError(
-                    title=data["title"],
-                    detail=data["detail"]
-                )
-            case 401:
-                raise AuthenticationError()
-            case 403:
-                raise BlockedError()
-            case 404:
-                raise NotFoundError(
-                    f'username {decodedToken["username"]} not found')
-            case 500:
-                raise ServiceUnavailableError()
+    def _set_transaction_name(self, scope: Scope) -> None:
+        transaction = newrelic.agent.current_transaction()
+        if transaction:
+            newrelic.agent.set_transaction_name(
+                f"{scope['method']} {scope['path']}")
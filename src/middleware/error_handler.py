@@ -20,7 +20,8 @@ def error_handler(request: Request, e: Exception) -> JSONResponse:
 
             return JSONResponse(
                 status_code=e.status_code,
-                content=content
+                content=content,
+                headers=e.headers
             )
 
         case HTTPException():
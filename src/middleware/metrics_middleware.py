@@ -0,0 +1,80 @@
+import time
+
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils.metrics import REQUEST_LATENCY, REQUESTS_IN_PROGRESS
+
+# Label of requests that match no route, so unknown paths can not blow up
+# the amount of series
+UNMATCHED_ROUTE = "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        """
+        Pure ASGI middleware recording the latency of every request by
+        method, route template and status, and the requests in progress
+
+        It must be the outermost middleware so requests rejected by the
+        authentication are measured too.
+
+        Args:
+            app: The wrapped ASGI application
+        """
+        self.app = app
+        self._children: dict[tuple[str, str, int], object] = {}
+        self._in_progress: dict[str, object] = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+
+            await send(message)
+
+        in_progress = self._in_progress.get(method)
+        if in_progress is None:
+            in_progress = self._in_progress[method] = REQUESTS_IN_PROGRESS.labels(
+                method)
+
+        in_progress.inc()  # type: ignore
+        start = time.perf_counter()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            in_progress.dec()  # type: ignore
+
+            key = (method, self._route(scope), status_code)
+            child = self._children.get(key)
+
+            if child is None:
+                child = self._children[key] = REQUEST_LATENCY.labels(*key)
+
+            child.observe(elapsed)  # type: ignore
+
+    def _route(self, scope: Scope) -> str:
+        route = scope.get("route")
+
+        if route is not None:
+            return route.path
+
+        # Requests answered before routing, e.g. by the authentication
+        for route in scope["app"].router.routes if "app" in scope else ():
+            match, _ = route.matches(scope)
+
+            if match == Match.FULL:
+                return route.path
+
+        return UNMATCHED_ROUTE
@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic import BaseModel
 
 from models.user import User
@@ -10,3 +11,24 @@ class ChatBase(BaseModel):
 
 class Chat(ChatBase):
     id: str
+
+
+class LastMessage(BaseModel):
+    id: str
+    content: str
+    sender_id: int
+    created_at: str
+
+
+class InboxChat(Chat):
+    created_at: str
+    updated_at: Optional[str] = None
+    last_message: Optional[LastMessage] = None
+    # Messages of the other participant sent after the user last read the chat
+    unread: int = 0
+    last_read_id: Optional[str] = None
+
+
+class ChatPage(BaseModel):
+    chats: list[InboxChat]
+    next_cursor: Optional[str] = None
@@ -6,7 +6,8 @@ class CustomHTTPException(HTTPException):
     def __init__(self, **kwargs):
         super().__init__(
             kwargs.get("status") or status.HTTP_400_BAD_REQUEST,
-            kwargs.get("detail") or ""
+            kwargs.get("detail") or "",
+            kwargs.get("headers")
         )
         self.title = kwargs.get("title") or "CustomHTTPException"
 
@@ -47,6 +48,15 @@ class BlockedError(CustomHTTPException):
         )
 
 
+class ForbiddenError(CustomHTTPException):
+    def __init__(self, detail: Optional[str] = None):
+        super().__init__(
+            status=status.HTTP_403_FORBIDDEN,
+            detail=detail if detail else "You are not allowed to do this",
+            title="ForbiddenError"
+        )
+
+
 class NotFoundError(CustomHTTPException):
     def __init__(self, detail: Optional[str] = None):
         super().__init__(
@@ -63,3 +73,13 @@ class ServiceUnavailableError(CustomHTTPException):
             detail="Service unavailable",
             title="ServiceUnavailableError"
         )
+
+
+class TooManyRequestsError(CustomHTTPException):
+    def __init__(self, retry_after: int, detail: Optional[str] = None):
+        super().__init__(
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=detail if detail else "Too many requests, try again later",
+            title="TooManyRequestsError",
+            headers={"Retry-After": str(retry_after)}
+        )
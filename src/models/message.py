@@ -11,3 +11,33 @@ class Message(MessageBase):
     id: str
     sender_id: int
     created_at: str
+    edited_at: Optional[str] = None
+
+
+class MessagePage(BaseModel):
+    messages: list[Message]
+    next_cursor: Optional[str] = None
+
+
+# Messages a client can send in one batch
+MAX_BATCH_SIZE = 100
+
+
+class MessageBatch(BaseModel):
+    messages: list[MessageBase] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+    receiver_expo_token: Optional[str] = Field(default=None, exclude=True)
+
+
+class MessageError(BaseModel):
+    title: str
+    detail: str
+
+
+class MessageBatchItem(BaseModel):
+    status: int
+    message: Optional[Message] = None
+    error: Optional[MessageError] = None
+
+
+class MessageBatchResult(BaseModel):
+    results: list[MessageBatchItem]
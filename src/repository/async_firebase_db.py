@@ -0,0 +1,716 @@
+import asyncio
+import datetime
+from importlib.util import find_spec
+import json
+import logging
+from os import getenv
+import time
+from typing import Any, Awaitable, Callable
+
+import anyio
+import firebase_admin
+import httpx
+
+from models.errors.errors import AuthenticationError, NotFoundError, ServiceUnavailableError
+from models.user import User
+from repository.chat_repository import IChatRepository
+from repository.updated_at_buffer import UpdatedAtBuffer
+from repository.firebase_db import ParticipantsCache, participants_cache
+from repository.rtdb_paths import (
+    LAST_MESSAGE_PREVIEW_LENGTH, chat_pair_key, chat_updated_at_paths, inbox_page,
+    messages_page, new_chat, new_messages,
+    previous_message_preview, read_entry, user_chat_entry, validate_sender
+)
+from utils.metrics import timed
+from utils.push_id import generate_push_id
+from utils.single_flight import SingleFlight
+
+# HTTP/2 needs the optional h2 package, without it httpx speaks HTTP/1.1
+HTTP2_AVAILABLE = find_spec("h2") is not None
+
+
+class AccessTokenCache:
+    def __init__(self, credential: Callable[[], Any] | None = None, refresh_margin: float | None = None):
+        """
+        OAuth access token of the Firebase service account
+
+        The token is refreshed in a worker thread shortly before it expires
+        and concurrent refreshes share a single call.
+
+        Args:
+            credential: Factory of the firebase_admin credential, defaults to the one of the default app
+            refresh_margin: Seconds before expiry a token is refreshed, defaults to RTDB_TOKEN_REFRESH_MARGIN
+        """
+        self._credential = credential or (
+            lambda: firebase_admin.get_app().credential)
+        self.refresh_margin = refresh_margin if refresh_margin is not None else float(
+            getenv("RTDB_TOKEN_REFRESH_MARGIN") or 300)
+        self._token: str | None = None
+        self._expires_at = 0.0
+        self._refreshes = SingleFlight()
+
+    async def get(self) -> str:
+        if self._token is not None and time.time() < self._expires_at - self.refresh_margin:
+            return self._token
+
+        return await self._refreshes.do("token", self._refresh)
+
+    def invalidate(self) -> None:
+        self._token = None
+
+    async def _refresh(self) -> str:
+        info = await anyio.to_thread.run_sync(self._credential().get_access_token)
+
+        # google-auth reports expiry as a naive UTC datetime
+        expiry: datetime.datetime | None = info.expiry
+        self._expires_at = expiry.replace(tzinfo=datetime.timezone.utc).timestamp(
+        ) if expiry else time.time() + 3600
+        self._token = info.access_token
+
+        return info.access_token
+
+
+class RTDBClient:
+    def __init__(self, client: httpx.AsyncClient | None = None, database_url: str | None = None, tokens: AccessTokenCache | None = None):
+        """
+        Client of the Realtime Database REST API
+
+        The underlying httpx client is shared by every request of the app,
+        keeps connections alive and uses HTTP/2 when h2 is installed, so a
+        single connection multiplexes concurrent reads and writes.
+
+        Args:
+            client: Preconfigured async client, mostly useful for tests
+            database_url: Database url, defaults to the one of the default app or DATABASE_URL
+            tokens: Source of the OAuth access tokens
+        """
+        self._client = client
+        self._database_url = database_url
+        self.tokens = tokens or AccessTokenCache()
+
+    @property
+    def database_url(self) -> str:
+        if self._database_url is None:
+            try:
+                self._database_url = firebase_admin.get_app().options.get('databaseURL')
+            except ValueError:
+                self._database_url = getenv("DATABASE_URL")
+
+        return (self._database_url or "").rstrip("/")
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=httpx.Timeout(
+                    float(getenv("RTDB_READ_TIMEOUT") or 10.0),
+                    connect=float(getenv("RTDB_CONNECT_TIMEOUT") or 5.0)
+                ),
+                limits=httpx.Limits(
+                    max_connections=int(
+                        getenv("RTDB_MAX_CONNECTIONS") or 100),
+                    max_keepalive_connections=int(
+                        getenv("RTDB_MAX_KEEPALIVE_CONNECTIONS") or 20),
+                    keepalive_expiry=float(
+                        getenv("RTDB_KEEPALIVE_EXPIRY") or 60.0)
+                )
+            )
+
+        return self._client
+
+    async def send(self, method: str, path: str, params: dict | None = None, body: Any = None, headers: dict[str, str] | None = None, accept: tuple[int, ...] = ()) -> httpx.Response:
+        """
+        Send a request to the REST API and return the raw response
+
+        Args:
+            method: GET, PUT, PATCH or DELETE
+            path: Location in the database, without the .json suffix
+            params: Query parameters
+            body: JSON body of writes
+            headers: Extra headers, like the ETag ones
+            accept: Error statuses returned instead of raised
+
+        Returns:
+            httpx.Response: The answer of the database
+
+        Raises:
+            ServiceUnavailableError: If the database can not be reached or fails
+        """
+        url = f"{self.database_url}/{path.strip('/')}.json"
+
+        for attempt in range(2):
+            token = await self.tokens.get()
+
+            try:
+                response = await self.client.request(
+                    method,
+                    url,
+                    params=params,
+                    # Writes always have a body, a JSON null deletes the
+                    # location while httpx sends nothing for json=None
+                    content=json.dumps(body) if method in ("PUT", "PATCH", "POST") else None,
+                    headers={**(headers or {}), "Authorization": f"Bearer {token}"}
+                )
+            except httpx.HTTPError as e:
+                logging.error(f"database request failed: {e!r}")
+                raise ServiceUnavailableError()
+
+            if response.status_code == 401 and attempt == 0:
+                # The token may have been revoked before it expired
+                self.tokens.invalidate()
+                continue
+
+            break
+
+        if not response.is_success and response.status_code not in accept:
+            logging.error(
+                f"database {method} {path} failed with {response.status_code}: {response.text}")
+            raise ServiceUnavailableError()
+
+        return response
+
+    async def request(self, method: str, path: str, params: dict | None = None, body: Any = None) -> Any:
+        """
+        Send a request to the REST API
+
+        Args:
+            method: GET, PUT, PATCH or DELETE
+            path: Location in the database, without the .json suffix
+            params: Query parameters
+            body: JSON body of writes
+
+        Returns:
+            Any: The decoded JSON answer
+
+        Raises:
+            ServiceUnavailableError: If the database can not be reached or fails
+        """
+        response = await self.send(method, path, params, body)
+
+        return response.json() if response.content else None
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+rtdb_client = RTDBClient()
+
+
+class AsyncReference:
+    def __init__(self, rtdb: RTDBClient, path: str = "", params: dict | None = None):
+        """
+        Async counterpart of firebase_admin.db.Reference over the REST API
+
+        Query methods return a new reference, values are encoded as JSON as
+        the REST API expects.
+
+        Args:
+            rtdb: Client the requests are sent through
+            path: Location in the database
+            params: Query parameters
+        """
+        self.rtdb = rtdb
+        self.path = path.strip("/")
+        self.params = params or {}
+
+    def child(self, key: str) -> "AsyncReference":
+        return AsyncReference(self.rtdb, f"{self.path}/{key}".lstrip("/"))
+
+    def _query(self, **params: Any) -> "AsyncReference":
+        return AsyncReference(self.rtdb, self.path, {**self.params, **params})
+
+    def order_by_key(self) -> "AsyncReference":
+        return self._query(orderBy=json.dumps("$key"))
+
+    def order_by_child(self, path: str) -> "AsyncReference":
+        return self._query(orderBy=json.dumps(path))
+
+    def start_at(self, value: Any) -> "AsyncReference":
+        return self._query(startAt=json.dumps(value))
+
+    def end_at(self, value: Any) -> "AsyncReference":
+        return self._query(endAt=json.dumps(value))
+
+    def equal_to(self, value: Any) -> "AsyncReference":
+        return self._query(equalTo=json.dumps(value))
+
+    def limit_to_first(self, limit: int) -> "AsyncReference":
+        return self._query(limitToFirst=limit)
+
+    def limit_to_last(self, limit: int) -> "AsyncReference":
+        return self._query(limitToLast=limit)
+
+    async def get(self, etag: bool = False) -> Any:
+        """
+        Read the value of the location
+
+        Args:
+            etag: Also return the ETag of the value, for set_if_unchanged
+
+        Returns:
+            Any: The value, or a (value, etag) tuple when `etag` is set
+        """
+        if not etag:
+            return await self.rtdb.request("GET", self.path, self.params)
+
+        response = await self.rtdb.send(
+            "GET", self.path, self.params, headers={"X-Firebase-ETag": "true"})
+
+        return (response.json() if response.content else None), response.headers["ETag"]
+
+    async def set(self, value: Any) -> None:
+        await self.rtdb.request("PUT", self.path, {"print": "silent"}, value)
+
+    async def set_if_unchanged(self, expected_etag: str, value: Any) -> tuple[bool, Any, str]:
+        """
+        Write the location only if it still has the ETag read before
+
+        Args:
+            expected_etag: ETag returned by get(etag=True)
+            value: The value to write
+
+        Returns:
+            tuple[bool, Any, str]: Whether the value was written, the value
+            now stored and its ETag
+        """
+        response = await self.rtdb.send(
+            "PUT", self.path, body=value, headers={"if-match": expected_etag}, accept=(412,))
+
+        # A mismatch answers 412 with the current value
+        return response.status_code != 412, response.json(), response.headers["ETag"]
+
+    async def update(self, value: dict[str, Any]) -> None:
+        """Write several locations at once, None values delete them"""
+        # print=silent answers 204 instead of echoing the written data
+        await self.rtdb.request("PATCH", self.path, {"print": "silent"}, value)
+
+    async def push(self, value: Any = None) -> "AsyncReference":
+        """Create a child with a new push id"""
+        if value is None:
+            return self.child(generate_push_id())
+
+        created = await self.rtdb.request("POST", self.path, body=value)
+
+        return self.child(created["name"])
+
+
+class AsyncFirebaseDB(IChatRepository):
+    def __init__(self, root: AsyncReference | None = None, participants: ParticipantsCache | None = None, updated_at: UpdatedAtBuffer | None = None):
+        """
+        Chats repository over the Realtime Database REST API
+
+        Args:
+            root: Reference to the database root, defaults to the shared client
+            participants: Cache of the participants of each chat
+            updated_at: Writes the updated_at of the chats behind, they are
+                written with every update when not given
+        """
+        self.root = root or AsyncReference(rtdb_client)
+        self.participants = participants or participants_cache
+        self.updated_at = updated_at
+
+    async def start(self) -> None:
+        if self.updated_at is not None:
+            await self.updated_at.start()
+
+    async def aclose(self) -> None:
+        if self.updated_at is not None:
+            await self.updated_at.stop()
+
+    def _updated_at_paths(self, chat_id: str, participants: tuple[int, int], timestamp: str) -> dict[str, Any]:
+        """Paths bumping updated_at to write with an update, none when written behind"""
+        if self.updated_at is not None:
+            return {}
+
+        return chat_updated_at_paths(chat_id, participants, timestamp)
+
+    def _touch(self, chat_id: str, participants: tuple[int, int], timestamp: str) -> None:
+        """Buffer the updated_at bump of a committed update"""
+        if self.updated_at is not None:
+            self.updated_at.touch(chat_id, participants, timestamp)
+
+    async def _get_participants(self, chat_id: str) -> tuple[int, int]:
+        participants = self.participants.get(chat_id)
+
+        if participants is None:
+            participants_value = await self.root.child("chats").child(
+                chat_id).child("participants").get()
+
+            if not participants_value:
+                raise NotFoundError("Chat not found")
+
+            participants = self.participants.set(chat_id, participants_value)
+
+        return participants
+
+    async def _validate_participant(self, chat_id: str, user_id: int, detail: str = "To update a chat you must be in it") -> tuple[int, int]:
+        participants = await self._get_participants(chat_id)
+
+        if user_id not in participants:
+            raise AuthenticationError(detail)
+
+        return participants
+
+    @timed("firebase")
+    async def validate_participant(self, chat_id: str, user_id: int) -> None:
+        """
+        Check a user is a participant of a chat
+
+        Raises:
+            NotFoundError: The chat does not exist
+            AuthenticationError: The user is not a participant
+        """
+        await self._validate_participant(
+            chat_id, user_id, "To read a chat you must be in it")
+
+    @timed("firebase")
+    async def edit_message(self, chat_id: str, message_id: str, new_message: str, user_id: int) -> dict:
+        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+        participants = await self._validate_participant(chat_id, user_id)
+
+        message: dict = await self.root.child(
+            'messages').child(chat_id).child(message_id).get() or {}
+
+        validate_sender(message.get('sender_id'), user_id)
+
+        message_path = f"messages/{chat_id}/{message_id}"
+        await self.root.update({
+            f"{message_path}/content": new_message,
+            f"{message_path}/edited_at": timestamp,
+            **self._updated_at_paths(chat_id, participants, timestamp)
+        })
+        self._touch(chat_id, participants, timestamp)
+
+        async def edited(preview: dict) -> dict:
+            return {**preview, 'content': new_message[:LAST_MESSAGE_PREVIEW_LENGTH]}
+
+        await self._replace_preview(chat_id, participants, message_id, edited)
+
+        return {
+            'id': message_id,
+            **message,
+            'content': new_message,
+            'edited_at': timestamp
+        }
+
+    @timed("firebase")
+    async def delete_message(self, chat_id: str, message_id: str, user_id: int) -> None:
+        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+        participants = await self._validate_participant(chat_id, user_id)
+
+        validate_sender(await self.root.child('messages').child(
+            chat_id).child(message_id).child('sender_id').get(), user_id)
+
+        # The unread counter of the receiver is left as is, a deleted unread
+        # message keeps counting until the chat is read
+        await self.root.update({
+            f"messages/{chat_id}/{message_id}": None,
+            **self._updated_at_paths(chat_id, participants, timestamp)
+        })
+        self._touch(chat_id, participants, timestamp)
+
+        async def previous(preview: dict) -> dict | None:
+            # The previous message becomes the preview, if there is one
+            latest: dict[str, Any] = await self.root.child('messages').child(
+                chat_id).order_by_key().limit_to_last(2).get() or {}
+
+            return previous_message_preview(latest, message_id)
+
+        await self._replace_preview(chat_id, participants, message_id, previous)
+
+    async def _replace_preview(self, chat_id: str, participants: tuple[int, int], message_id: str, replacement: Callable[[dict], Awaitable[dict | None]]) -> None:
+        """
+        Replace the last message preview of a chat where it still shows a message
+
+        The chat and both inbox entries hold a copy, each written only if
+        unchanged since read. A message sent meanwhile wrote a newer preview,
+        which must not be overwritten.
+
+        Args:
+            chat_id: The chat
+            participants: Its participants
+            message_id: The message edited or deleted
+            replacement: Builds the new preview from the current one, only
+                called when a copy shows the message
+        """
+        references = [self.root.child('chats').child(chat_id).child('last_message')] + [
+            self.root.child('user_chats').child(str(user_id)).child(chat_id).child('last_message')
+            for user_id in participants
+        ]
+        copies = await asyncio.gather(*(reference.get(etag=True) for reference in references))
+        shown = [preview for preview, _ in copies
+                 if preview and preview.get('id') == message_id]
+
+        if not shown:
+            return
+
+        preview = await replacement(shown[0])
+
+        async def replace(reference: AsyncReference, current: Any, etag: str) -> None:
+            while current and current.get('id') == message_id:
+                written, current, etag = await reference.set_if_unchanged(etag, preview)
+
+                if written:
+                    return
+
+        await asyncio.gather(*(
+            replace(reference, current, etag)
+            for reference, (current, etag) in zip(references, copies)
+        ))
+
+    @timed("firebase")
+    async def send_message(self, chat_id: str, user_id: int, message: str) -> dict:
+        """Send a message in a chat"""
+        return (await self._send_messages(chat_id, user_id, [message]))[0]
+
+    @timed("firebase")
+    async def send_messages(self, chat_id: str, user_id: int, messages: list[str]) -> list[dict]:
+        """Send several messages in a chat, in order"""
+        return await self._send_messages(chat_id, user_id, messages)
+
+    async def _send_messages(self, chat_id: str, user_id: int, messages: list[str]) -> list[dict]:
+        participants = await self._validate_participant(chat_id, user_id)
+
+        created, updates = new_messages(
+            chat_id, participants, user_id, messages, self.updated_at is None)
+
+        if updates:
+            # The messages, the chat timestamp and its preview are committed atomically
+            await self.root.update(updates)
+            self._touch(chat_id, participants, created[-1]['created_at'])
+
+        return created
+
+    @timed("firebase")
+    async def mark_read(self, chat_id: str, user_id: int) -> str | None:
+        """
+        Mark a chat as read up to its last message
+
+        Args:
+            chat_id: The chat read
+            user_id: The participant reading it
+
+        Returns:
+            str | None: The id of the last message read, None if the chat has no messages
+        """
+        await self._validate_participant(
+            chat_id, user_id, "To read a chat you must be in it")
+
+        entry_ref = self.root.child('user_chats').child(
+            str(user_id)).child(chat_id)
+        # The entry holds the counter and the last message id, read together
+        entry, etag = await entry_ref.get(etag=True)
+
+        while entry:
+            read, message_id = read_entry(entry)
+
+            if read == entry:
+                return message_id
+
+            # Clearing the counter with a blind write would drop the messages
+            # counted since it was read, a concurrent update fails this one
+            written, entry, etag = await entry_ref.set_if_unchanged(etag, read)
+
+            if written:
+                return message_id
+
+        return None
+
+    @timed("firebase")
+    async def get_messages(self, chat_id: str, user_id: int, before: str | None = None, limit: int = 50) -> tuple[list[dict], str | None]:
+        """
+        Get a page of messages of a chat, oldest first
+
+        Args:
+            chat_id: The chat to read
+            user_id: The user reading, must be a participant
+            before: Only return messages whose id is lower than this one
+            limit: Maximum amount of messages returned
+
+        Returns:
+            tuple[list[dict], str | None]: The messages and the id to pass as
+            `before` to get the previous page, None if there is none
+        """
+        await self._validate_participant(
+            chat_id, user_id, "To read a chat you must be in it")
+
+        query = self.root.child('messages').child(chat_id).order_by_key()
+
+        if before:
+            # endAt is inclusive, fetch one extra to skip the cursor itself
+            query = query.end_at(before)
+
+        page: dict[str, Any] = await query.limit_to_last(
+            limit + (2 if before else 1)).get() or {}
+
+        return messages_page(page, before, limit)
+
+    @timed("firebase")
+    async def create_chat(self, user1: User, user2: User) -> str:
+        """
+        Create a new chat between two users, or return the one they already have
+
+        The chat is written first and the pair then claimed with a
+        conditional write, so concurrent requests for the same users agree
+        on one chat and a pair never points to a chat still being created.
+        A pair left pointing to a chat that does not exist is claimed again.
+        """
+        pair = self.root.child('chat_pairs').child(
+            chat_pair_key(user1.id, user2.id))
+        existent_chat_key, etag = await pair.get(etag=True)
+
+        if existent_chat_key and await self._chat_exists(existent_chat_key):
+            return existent_chat_key
+
+        chat_id, chat_data, updates = new_chat(user1, user2)
+        chat = self.root.child('chats').child(chat_id)
+        await chat.set(chat_data)
+
+        claimed, existent_chat_key, etag = await pair.set_if_unchanged(etag, chat_id)
+
+        while not claimed:
+            if existent_chat_key and await self._chat_exists(existent_chat_key):
+                # Another request created the chat first
+                await chat.set(None)
+                return existent_chat_key
+
+            # The other request gave its claim up, try again
+            claimed, existent_chat_key, etag = await pair.set_if_unchanged(etag, chat_id)
+
+        try:
+            await self.root.update(updates)
+        except ServiceUnavailableError:
+            # Free the pair, or it would point to a chat missing from the inboxes
+            await pair.set_if_unchanged(etag, None)
+            await chat.set(None)
+            raise
+
+        self.participants.set(chat_id, chat_data["participants"])
+
+        return chat_id
+
+    async def _chat_exists(self, chat_id: str) -> bool:
+        try:
+            await self._get_participants(chat_id)
+        except NotFoundError:
+            return False
+
+        return True
+
+    @timed("firebase")
+    async def get_inbox(self, user_id: int, before: tuple[str, str] | None = None, limit: int = 20) -> tuple[list[dict], tuple[str, str] | None]:
+        """
+        Get a page of the chats of a user, most recently updated first
+
+        Args:
+            user_id: The user whose chats are listed
+            before: Only return chats sorted after this (updated_at, chat_id)
+            limit: Maximum amount of chats returned
+
+        Returns:
+            tuple[list[dict], tuple[str, str] | None]: The chats, each with
+            its last_message preview, and the position to pass as `before`
+            to get the next page, None if there is none
+        """
+        query = self.root.child('user_chats').child(
+            str(user_id)).order_by_child('updated_at')
+
+        if before is not None:
+            # endAt is inclusive, fetch one extra to skip the cursor itself
+            query = query.end_at(before[0])
+
+        fetched = limit + (2 if before else 1)
+        rows: dict[str, Any] = await query.limit_to_last(fetched).get() or {}
+
+        # endAt only bounds updated_at, chats tied with the cursor but sorted
+        # after it take room in the window, so widen it until the page fills
+        while before is not None and len(rows) >= fetched and sum(
+                ((row.get('updated_at') or ''), chat_id) < tuple(before)
+                for chat_id, row in rows.items()) <= limit:
+            fetched *= 2
+            rows = await query.limit_to_last(fetched).get() or {}
+
+        if self.updated_at is not None:
+            rows = await self._with_pending_updated_at(
+                user_id, rows, before, len(rows) >= fetched)
+
+        chats, next_before = inbox_page(rows, before, limit)
+
+        return await self._with_chat_details(chats), next_before
+
+    async def _with_chat_details(self, chats: list[dict]) -> list[dict]:
+        """
+        Complete the inbox rows of chats created before the inbox index
+
+        Until the backfill runs, a message to such a chat writes the preview,
+        the counter and updated_at of its entries but not the participants,
+        so they are read from the chat itself.
+        """
+        partial = [chat for chat in chats if 'participants' not in chat]
+
+        if not partial:
+            return chats
+
+        found = await asyncio.gather(
+            *(self.root.child('chats').child(chat['id']).get() for chat in partial))
+        details = {
+            chat['id']: user_chat_entry(chat_data)
+            for chat, chat_data in zip(partial, found) if chat_data
+        }
+
+        return [
+            {**details[chat['id']], **chat} if 'participants' not in chat else chat
+            for chat in chats
+            if 'participants' in chat or chat['id'] in details
+        ]
+
+    async def _with_pending_updated_at(self, user_id: int, rows: dict[str, Any], before: tuple[str, str] | None, full: bool) -> dict[str, Any]:
+        """
+        Apply the updated_at not written yet to inbox rows
+
+        A pending bump can move a chat into the page from further down, so
+        those chats are fetched too. Chats it moves above `before` are
+        dropped by inbox_page, they were on a previous page.
+
+        Args:
+            user_id: The user whose inbox is read
+            rows: The fetched rows
+            before: The cursor of the query
+            full: Whether older rows than the fetched ones exist
+        """
+        # Copied, flushes change it while the missing rows are fetched
+        pending = dict(self.updated_at.pending(user_id))  # type: ignore
+
+        if not pending:
+            return rows
+
+        # Rows sorted below the last fetched one can not make it to the page
+        floor = min(((row.get('updated_at') or '', chat_id)
+                    for chat_id, row in rows.items()), default=None) if full else None
+
+        missing = [
+            chat_id for chat_id, timestamp in pending.items()
+            if chat_id not in rows
+            and (before is None or (timestamp, chat_id) < tuple(before))
+            and (floor is None or (timestamp, chat_id) > floor)
+        ]
+
+        user_chats = self.root.child('user_chats').child(str(user_id))
+        entries = await asyncio.gather(
+            *(user_chats.child(chat_id).get() for chat_id in missing))
+
+        rows = {
+            **rows,
+            **{chat_id: entry for chat_id, entry in zip(missing, entries) if entry}
+        }
+
+        return {
+            chat_id: {**row, 'updated_at': pending[chat_id]}
+            if pending.get(chat_id, '') > (row.get('updated_at') or '') else row
+            for chat_id, row in rows.items()
+        }
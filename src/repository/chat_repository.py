@@ -0,0 +1,47 @@
+from abc import ABC, abstractmethod
+
+from models.user import User
+
+
+class IChatRepository(ABC):
+    async def start(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+    @abstractmethod
+    async def create_chat(self, user1: User, user2: User) -> str:
+        pass
+
+    @abstractmethod
+    async def validate_participant(self, chat_id: str, user_id: int) -> None:
+        pass
+
+    @abstractmethod
+    async def send_message(self, chat_id: str, user_id: int, message: str) -> dict:
+        pass
+
+    @abstractmethod
+    async def send_messages(self, chat_id: str, user_id: int, messages: list[str]) -> list[dict]:
+        pass
+
+    @abstractmethod
+    async def edit_message(self, chat_id: str, message_id: str, new_message: str, user_id: int) -> dict:
+        pass
+
+    @abstractmethod
+    async def delete_message(self, chat_id: str, message_id: str, user_id: int) -> None:
+        pass
+
+    @abstractmethod
+    async def mark_read(self, chat_id: str, user_id: int) -> str | None:
+        pass
+
+    @abstractmethod
+    async def get_messages(self, chat_id: str, user_id: int, before: str | None = None, limit: int = 50) -> tuple[list[dict], str | None]:
+        pass
+
+    @abstractmethod
+    async def get_inbox(self, user_id: int, before: tuple[str, str] | None = None, limit: int = 20) -> tuple[list[dict], tuple[str, str] | None]:
+        pass
@@ -1,161 +1,56 @@
-import datetime
-from re import S
-from typing import Any
+import base64
+import json
+import logging
 from os import getenv
-from json import dumps
-from firebase_admin import db
+from cachetools import LRUCache
+import firebase_admin
+from firebase_admin import credentials
 
-from models.errors.errors import AuthenticationError, NotFoundError
-from models.user import User
 
+def init_firebase():
+    try:
+        firebase_admin.get_app()
+        return
+    except ValueError:
+        # Not initialized yet in this worker
+        pass
 
-class FirebaseDB:
-    def __init__(self):
-        """Initialize Firebase connection"""
-        self.root = db.reference('/')
+    try:
+        cred = credentials.Certificate('src/serviceAccountKey.json')
 
-    def _set_chat_updated_at(self, chat_id: str, user_id: int, timestamp: str | None = None):
-        chat_ref = self.root.child("chats").child(chat_id)
+    except:
+        cred = credentials.Certificate(json.loads(
+            base64.b64decode(getenv("SERVICE_ACCOUNT_KEY")).decode('utf-8')))  # type: ignore
 
-        chat_value = chat_ref.get()
+    firebase_admin.initialize_app(cred, {
+        'databaseURL': getenv("DATABASE_URL")
+    })
 
-        if not chat_value:
-            raise NotFoundError("Chat not found")
+    logging.info("Firebase initialized")
 
-        if chat_value["participants"]["user1"]["id"] != user_id and chat_value["participants"]["user2"]["id"] != user_id:  # type: ignore
-            raise AuthenticationError(
-                "To update a chat you must be in it"
-            )
 
-        chat_value.update(  # type: ignore
-            {"updated_at": datetime.datetime.now(datetime.timezone.utc).isoformat() if not timestamp else timestamp})  # type: ignore
+class ParticipantsCache:
+    def __init__(self, maxsize: int | None = None):
+        """
+        LRU cache of the participant ids of each chat
 
-        chat_ref.set(chat_value)
+        Participants never change after a chat is created, so entries never
+        need to be invalidated.
 
-    def _validate_sender(self, message_ref: db.Reference, user_id: int):
-        original_sender = message_ref.child('sender_id').get()
+        Args:
+            maxsize: Maximum amount of chats kept, defaults to PARTICIPANTS_CACHE_MAXSIZE
+        """
+        self._cache: LRUCache = LRUCache(
+            maxsize or int(getenv("PARTICIPANTS_CACHE_MAXSIZE") or 100000))
 
-        if not original_sender:
-            raise NotFoundError("Message not found")
+    def get(self, chat_id: str) -> tuple[int, int] | None:
+        return self._cache.get(chat_id)
 
-        elif original_sender != user_id:
-            raise AuthenticationError(
-                "To update a message you must be the same user"
-            )
+    def set(self, chat_id: str, participants: dict) -> tuple[int, int]:
+        ids = (participants["user1"]["id"], participants["user2"]["id"])
+        self._cache[chat_id] = ids
 
-    def edit_message(self, chat_id: str, message_id: str, new_message: str, user_id: int) -> dict:
+        return ids
 
-        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
 
-        self._set_chat_updated_at(chat_id, user_id,  timestamp)
-
-        message_ref = self.root.child(
-            'messages').child(chat_id).child(message_id)
-
-        self._validate_sender(message_ref, user_id)
-
-        message_ref.update({
-            "content": new_message,
-            "edited_at": timestamp
-        })
-
-        message = message_ref.get()
-
-        return {
-            'id': message_id,
-            **message  # type: ignore
-        }
-
-    def delete_message(self, chat_id: str, message_id: str, user_id: int) -> None:
-
-        self._set_chat_updated_at(chat_id, user_id)
-
-        message_ref = self.root.child(
-            'messages').child(chat_id).child(message_id)
-
-        self._validate_sender(message_ref, user_id)
-
-        message_ref.delete()
-
-    def send_message(self, chat_id: str, user_id: int, message: str) -> dict:
-        """Send a message in a chat"""
-        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
-
-        self._set_chat_updated_at(chat_id, user_id, timestamp)
-
-        messages_ref = self.root.child('messages').child(chat_id)
-        message_data = {
-            'content': message,
-            'sender_id': user_id,
-            'created_at': timestamp
-        }
-
-        new_message = messages_ref.push(message_data)  # type: ignore
-
-        return {
-            'id': new_message.key,
-            **message_data
-        }
-
-    def __chat_exist(self, user1: User, user2: User) -> str:
-        chats: dict[str, Any] = self.get_user_chats(user1.id)
-
-        min_user = user1 if user1.id < user2.id else user2
-        max_user = user1 if user1.id > user2.id else user2
-
-        participants: dict = {
-            "user1": dict(min_user),
-            "user2": dict(max_user)
-        }
-
-        for key, chat in chats.items():
-            if chat["participants"] == participants:
-                return key
-
-        return ''
-
-    def create_chat(self, user1: User, user2: User) -> str:
-        """Create a new chat between two users"""
-        existent_chat_key = self.__chat_exist(user1, user2)
-
-        if len(existent_chat_key) > 0:
-            # paticipants_ref = self.root.child('chats').child(
-            #     existent_chat_key).child("participants")
-            # participants = paticipants_ref.get()
-
-            # print(participants)
-
-            # if participants["user1"]["username"] != min_user.username:  # type: ignore
-            #     paticipants_ref.child("user1").update(dict(min_user))
-
-            # elif participants["user2"]["username"] != max_user.username:  # type: ignore
-            #     paticipants_ref.child("user2").update(dict(max_user))
-
-            return existent_chat_key
-
-        min_user = user1 if user1.id < user2.id else user2
-        max_user = user1 if user1.id > user2.id else user2
-
-        chat_ref = self.root.child('chats')
-
-        chat_data = {
-            'participants': {
-                "user1": dict(min_user),
-                "user2": dict(max_user)
-            },
-            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat()
-        }
-        new_chat = chat_ref.push(chat_data)  # type: ignore
-        return new_chat.key  # type: ignore
-
-    def get_user_chats(self, user_id: int) -> dict[str, Any]:
-        """Get all chats for a user"""
-        chats = {}
-
-        chat_ref = self.root.child('chats')
-        chats.update(chat_ref.order_by_child(
-            f'participants/user1/id').equal_to(user_id).get())
-        chats.update(chat_ref.order_by_child(
-            f'participants/user2/id').equal_to(user_id).get())
-
-        return chats
+participants_cache = ParticipantsCache()
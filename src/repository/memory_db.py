@@ -0,0 +1,321 @@
+import asyncio
+import copy
+import hashlib
+import json
+from os import getenv
+import random
+import re
+import time
+from typing import Any
+
+from models.errors.errors import ServiceUnavailableError
+from utils.push_id import generate_push_id
+
+_INT_KEY = re.compile(r"-?\d{1,10}")
+
+
+def _key_rank(key: str) -> tuple:
+    # Keys that parse as 32 bit integers sort first, numerically
+    if _INT_KEY.fullmatch(key) and -2 ** 31 <= int(key) < 2 ** 31:
+        return (0, int(key), "")
+
+    return (1, 0, key)
+
+
+def _value_rank(value: Any) -> tuple:
+    # null < false < true < numbers < strings < objects
+    if value is None:
+        return (0, 0)
+
+    if isinstance(value, bool):
+        return (1, value)
+
+    if isinstance(value, (int, float)):
+        return (2, value)
+
+    if isinstance(value, str):
+        return (3, value)
+
+    return (4, 0)
+
+
+def _split(path: str) -> list[str]:
+    return [key for key in path.split("/") if key]
+
+
+def _etag(value: Any) -> str:
+    return hashlib.md5(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def _normalize(value: Any) -> Any:
+    """Stored form of a value, the database keeps neither nulls nor empty objects"""
+    if isinstance(value, dict):
+        children = {str(key): _normalize(child)
+                    for key, child in value.items()}
+        children = {key: child for key,
+                    child in children.items() if child is not None}
+
+        return children or None
+
+    return value
+
+
+class MemoryDatabase:
+    def __init__(self, data: dict | None = None, latency: float | None = None, jitter: float | None = None, failure_rate: float | None = None, seed: int | None = None):
+        """
+        In-memory stand-in of the Realtime Database
+
+        References to it behave like AsyncReference, so AsyncFirebaseDB runs
+        on top of it unchanged: `AsyncFirebaseDB(MemoryDatabase().reference())`.
+        Every request can be delayed and can fail, to exercise timeouts and
+        retries without a Firebase project.
+
+        Args:
+            data: Initial content of the database
+            latency: Seconds every request takes, defaults to MEMORY_DB_LATENCY
+            jitter: Maximum random seconds added to the latency, defaults to MEMORY_DB_JITTER
+            failure_rate: Share of requests failing with ServiceUnavailableError, defaults to MEMORY_DB_FAILURE_RATE
+            seed: Seed of the jitter and failures, for reproducible runs
+        """
+        self.data: dict = _normalize(copy.deepcopy(data)) or {}
+        self.latency = latency if latency is not None else float(
+            getenv("MEMORY_DB_LATENCY") or 0)
+        self.jitter = jitter if jitter is not None else float(
+            getenv("MEMORY_DB_JITTER") or 0)
+        self.failure_rate = failure_rate if failure_rate is not None else float(
+            getenv("MEMORY_DB_FAILURE_RATE") or 0)
+        self.reads = 0
+        self.writes = 0
+        self._random = random.Random(seed)
+
+    def reference(self, path: str = "") -> "MemoryReference":
+        return MemoryReference(self, path)
+
+    async def round_trip(self) -> None:
+        """Simulate the network part of a request"""
+        delay = self.latency + \
+            (self._random.uniform(0, self.jitter) if self.jitter else 0)
+
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            raise ServiceUnavailableError()
+
+    def get(self, path: str) -> Any:
+        node: Any = self.data
+
+        for key in _split(path):
+            if not isinstance(node, dict) or key not in node:
+                return None
+
+            node = node[key]
+
+        return copy.deepcopy(node) if node != {} else None
+
+    def set(self, path: str, value: Any) -> None:
+        keys = _split(path)
+        value = _normalize(self._server_values(path, copy.deepcopy(value)))
+
+        if not keys:
+            self.data = value if isinstance(value, dict) else {}
+            return
+
+        parents = [self.data]
+        for key in keys[:-1]:
+            child = parents[-1].get(key)
+
+            if not isinstance(child, dict):
+                if value is None:
+                    return
+
+                child = parents[-1][key] = {}
+
+            parents.append(child)
+
+        if value is None:
+            parents[-1].pop(keys[-1], None)
+
+            # Prune the parents left empty
+            for parent, key in zip(reversed(parents[:-1]), reversed(keys[:-1])):
+                if parent[key]:
+                    break
+
+                del parent[key]
+        else:
+            parents[-1][keys[-1]] = value
+
+    def _server_values(self, path: str, value: Any) -> Any:
+        """Resolve the {".sv": ...} placeholders of a value written at `path`"""
+        if not isinstance(value, dict):
+            return value
+
+        if ".sv" not in value:
+            return {key: self._server_values(f"{path}/{key}", child) for key, child in value.items()}
+
+        server_value = value[".sv"]
+
+        if server_value == "timestamp":
+            return int(time.time() * 1000)
+
+        if isinstance(server_value, dict) and "increment" in server_value:
+            current = self.get(path)
+
+            # Anything but a number counts as 0
+            if isinstance(current, bool) or not isinstance(current, (int, float)):
+                current = 0
+
+            return current + server_value["increment"]
+
+        raise ValueError(f"Unknown server value {server_value}")
+
+    def update(self, path: str, values: dict[str, Any]) -> None:
+        """
+        Write several locations atomically, None values delete them
+
+        Raises:
+            ValueError: If a location is an ancestor of another one, as the
+            database rejects such updates
+        """
+        locations = sorted(
+            ("/".join(_split(path) + _split(key)), value) for key, value in values.items())
+
+        for (first, _), (second, _) in zip(locations, locations[1:]):
+            if first == second or second.startswith(f"{first}/") or not first:
+                raise ValueError(
+                    f"Path {first or '/'} is an ancestor of {second} in the same update")
+
+        for location, value in locations:
+            self.set(location, value)
+
+
+class MemoryReference:
+    def __init__(self, database: MemoryDatabase, path: str = "", query: dict | None = None):
+        """
+        Reference to a location of a MemoryDatabase, with the API of AsyncReference
+
+        Args:
+            database: The database it points into
+            path: Location in the database
+            query: Ordering, filters and limits of the reference
+        """
+        self.database = database
+        self.path = "/".join(_split(path))
+        self.query = query or {}
+
+    def child(self, key: str) -> "MemoryReference":
+        return MemoryReference(self.database, f"{self.path}/{key}")
+
+    def _query(self, **query: Any) -> "MemoryReference":
+        if "limit_to_first" in {**self.query, **query} and "limit_to_last" in {**self.query, **query}:
+            raise ValueError("Cannot set both first and last limits")
+
+        return MemoryReference(self.database, self.path, {**self.query, **query})
+
+    def order_by_key(self) -> "MemoryReference":
+        return self._query(order_by=None)
+
+    def order_by_child(self, path: str) -> "MemoryReference":
+        return self._query(order_by=path)
+
+    def start_at(self, value: Any) -> "MemoryReference":
+        return self._query(start_at=value)
+
+    def end_at(self, value: Any) -> "MemoryReference":
+        return self._query(end_at=value)
+
+    def equal_to(self, value: Any) -> "MemoryReference":
+        return self._query(start_at=value, end_at=value)
+
+    def limit_to_first(self, limit: int) -> "MemoryReference":
+        return self._query(limit_to_first=limit)
+
+    def limit_to_last(self, limit: int) -> "MemoryReference":
+        return self._query(limit_to_last=limit)
+
+    def _run_query(self, value: Any) -> Any:
+        if not self.query:
+            return value
+
+        if "order_by" not in self.query:
+            raise ValueError("Queries must be ordered")
+
+        if not isinstance(value, dict):
+            return None
+
+        order_by = self.query["order_by"]
+
+        def rank(key: str) -> tuple:
+            if order_by is None:
+                return _key_rank(key)
+
+            child = value[key]
+            for part in _split(order_by):
+                child = child.get(part) if isinstance(child, dict) else None
+
+            return _value_rank(child)
+
+        def bound(limit: Any) -> tuple:
+            return _key_rank(str(limit)) if order_by is None else _value_rank(limit)
+
+        keys = sorted(value, key=lambda key: (rank(key), _key_rank(key)))
+
+        if "start_at" in self.query:
+            keys = [key for key in keys if rank(key) >= bound(self.query["start_at"])]
+
+        if "end_at" in self.query:
+            keys = [key for key in keys if rank(key) <= bound(self.query["end_at"])]
+
+        if "limit_to_first" in self.query:
+            keys = keys[:self.query["limit_to_first"]]
+
+        if "limit_to_last" in self.query:
+            keys = keys[-self.query["limit_to_last"]:] if self.query["limit_to_last"] else []
+
+        return {key: value[key] for key in keys} or None
+
+    async def get(self, etag: bool = False) -> Any:
+        await self.database.round_trip()
+        self.database.reads += 1
+
+        value = self._run_query(self.database.get(self.path))
+
+        return (value, _etag(value)) if etag else value
+
+    async def set_if_unchanged(self, expected_etag: str, value: Any) -> tuple[bool, Any, str]:
+        """Write the location only if it still has the ETag read before"""
+        await self.database.round_trip()
+
+        current = self.database.get(self.path)
+
+        if _etag(current) != expected_etag:
+            return False, current, _etag(current)
+
+        self.database.set(self.path, value)
+        self.database.writes += 1
+
+        current = self.database.get(self.path)
+
+        return True, current, _etag(current)
+
+    async def set(self, value: Any) -> None:
+        await self.database.round_trip()
+
+        self.database.set(self.path, value)
+        self.database.writes += 1
+
+    async def update(self, value: dict[str, Any]) -> None:
+        """Write several locations at once, None values delete them"""
+        await self.database.round_trip()
+
+        self.database.update(self.path, value)
+        self.database.writes += 1
+
+    async def push(self, value: Any = None) -> "MemoryReference":
+        """Create a child with a new push id"""
+        reference = self.child(generate_push_id())
+
+        if value is not None:
+            await reference.set(value)
+
+        return reference
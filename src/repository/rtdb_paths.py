@@ -0,0 +1,239 @@
+import datetime
+from typing import Any
+
+from models.errors.errors import AuthenticationError, NotFoundError
+from models.user import User
+from utils.push_id import generate_push_id
+
+# Characters of the content kept in chats/{id}/last_message
+LAST_MESSAGE_PREVIEW_LENGTH = 100
+
+
+def user_chat_entry(chat: dict) -> dict:
+    """
+    Entry of a chat in the user_chats/{user_id} index
+
+    It is ordered by updated_at and denormalizes what the inbox shows, so
+    listing chats is a single ordered read.
+    """
+    entry = {
+        'participants': chat['participants'],
+        'created_at': chat['created_at'],
+        'updated_at': chat.get('updated_at') or chat['created_at']
+    }
+
+    if chat.get('last_message'):
+        entry['last_message'] = chat['last_message']
+
+    return entry
+
+
+def chat_pair_key(user1_id: int, user2_id: int) -> str:
+    """Key of the chat_pairs index, the same whatever the order of the users"""
+    return f"{min(user1_id, user2_id)}_{max(user1_id, user2_id)}"
+
+
+def chat_updated_at_paths(chat_id: str, participants: tuple[int, int], timestamp: str) -> dict[str, Any]:
+    """Paths to write when the chat is updated, its node and both inbox entries"""
+    paths = [f"chats/{chat_id}/updated_at"] + \
+        [f"user_chats/{user_id}/{chat_id}/updated_at" for user_id in participants]
+
+    return {path: timestamp for path in paths}
+
+
+def last_message_paths(chat_id: str, participants: tuple[int, int], path: str, value: Any) -> dict[str, Any]:
+    """Paths to write to update `path` of the last message preview"""
+    paths = [f"chats/{chat_id}/{path}"] + \
+        [f"user_chats/{user_id}/{chat_id}/{path}" for user_id in participants]
+
+    return {path: value for path in paths}
+
+
+def unread_paths(chat_id: str, participants: tuple[int, int], sender_id: int, count: int) -> dict[str, Any]:
+    """Paths incrementing the unread counter of the participants other than the sender"""
+    return {
+        f"user_chats/{user_id}/{chat_id}/unread": {".sv": {"increment": count}}
+        for user_id in participants if user_id != sender_id
+    }
+
+
+def read_entry(entry: dict) -> tuple[dict, str | None]:
+    """
+    Mark the inbox entry of a participant as read
+
+    Returns:
+        tuple[dict, str | None]: The entry with its unread counter cleared
+        and its read watermark on the last message, and the id of that message
+    """
+    message_id = (entry.get('last_message') or {}).get('id')
+    read = {key: value for key, value in entry.items() if key != 'unread'}
+
+    if message_id is not None:
+        read['last_read_id'] = message_id
+
+    return read, message_id
+
+
+def last_message_preview(message_id: str, message: dict) -> dict:
+    return {
+        'id': message_id,
+        'content': message['content'][:LAST_MESSAGE_PREVIEW_LENGTH],
+        'sender_id': message['sender_id'],
+        'created_at': message['created_at']
+    }
+
+
+def previous_message_preview(latest: dict[str, Any], message_id: str) -> dict | None:
+    """
+    Preview of the message sent before `message_id`
+
+    Args:
+        latest: The last two messages of the chat
+        message_id: The message being deleted
+
+    Returns:
+        dict | None: The preview, None if it was the only message
+    """
+    previous_ids = sorted(key for key in latest if key != message_id)
+
+    if not previous_ids:
+        return None
+
+    return last_message_preview(previous_ids[-1], latest[previous_ids[-1]])
+
+
+def validate_sender(original_sender: Any, user_id: int) -> None:
+    if not original_sender:
+        raise NotFoundError("Message not found")
+
+    elif original_sender != user_id:
+        raise AuthenticationError(
+            "To update a message you must be the same user"
+        )
+
+
+def new_chat(user1: User, user2: User) -> tuple[str, dict, dict[str, Any]]:
+    """
+    Build a chat between two users
+
+    Returns:
+        tuple[str, dict, dict[str, Any]]: The chat id, the chat and the
+        multi-path update of its inbox entries, the chat itself is written
+        and the pair index claimed apart
+    """
+    min_user = user1 if user1.id < user2.id else user2
+    max_user = user1 if user1.id > user2.id else user2
+
+    chat_id = generate_push_id()
+    chat_data = {
+        'participants': {
+            "user1": dict(min_user),
+            "user2": dict(max_user)
+        },
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat()
+    }
+
+    return chat_id, chat_data, {
+        f"user_chats/{min_user.id}/{chat_id}": user_chat_entry(chat_data),
+        f"user_chats/{max_user.id}/{chat_id}": user_chat_entry(chat_data)
+    }
+
+
+def new_messages(chat_id: str, participants: tuple[int, int], user_id: int, messages: list[str], updated_at: bool = True) -> tuple[list[dict], dict[str, Any]]:
+    """
+    Build messages sent together by a user
+
+    They share one timestamp and get increasing push ids, so they keep
+    their order.
+
+    Args:
+        updated_at: Whether the update bumps the updated_at of the chat,
+            False when it is written behind
+
+    Returns:
+        tuple[list[dict], dict[str, Any]]: The messages and the multi-path
+        update committing them with one preview, unread and updated_at write
+    """
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    created = [
+        {'id': generate_push_id(), 'content': message,
+         'sender_id': user_id, 'created_at': timestamp}
+        for message in messages
+    ]
+
+    updates: dict[str, Any] = {
+        f"messages/{chat_id}/{message['id']}": {
+            key: value for key, value in message.items() if key != 'id'}
+        for message in created
+    }
+
+    if created:
+        updates.update(last_message_paths(chat_id, participants, "last_message",
+                                          last_message_preview(created[-1]['id'], created[-1])))
+        # Incremented by the server, concurrent senders do not overwrite each other
+        updates.update(unread_paths(
+            chat_id, participants, user_id, len(created)))
+
+        if updated_at:
+            updates.update(chat_updated_at_paths(
+                chat_id, participants, timestamp))
+
+    return created, updates
+
+
+def messages_page(page: dict[str, Any], before: str | None, limit: int) -> tuple[list[dict], str | None]:
+    """
+    Turn the result of a messages query into a page
+
+    Args:
+        page: Messages up to `before`, fetched with `limit + 2` if given or `limit + 1`
+        before: The cursor of the query
+        limit: Size of the page
+
+    Returns:
+        tuple[list[dict], str | None]: The messages, oldest first, and the
+        cursor of the previous page
+    """
+    keys = sorted(page)
+    if before and keys and keys[-1] == before:
+        keys = keys[:-1]
+
+    has_more = len(keys) > limit
+    keys = keys[-limit:]
+
+    return (
+        [{'id': key, **page[key]} for key in keys],
+        keys[0] if has_more else None
+    )
+
+
+def inbox_page(rows: dict[str, Any], before: tuple[str, str] | None, limit: int) -> tuple[list[dict], tuple[str, str] | None]:
+    """
+    Turn the result of a user_chats query into a page
+
+    Args:
+        rows: Entries up to `before`, with at least `limit + 1` of them
+            sorted after it unless there are no more
+        before: The cursor of the query
+        limit: Size of the page
+
+    Returns:
+        tuple[list[dict], tuple[str, str] | None]: The chats, most recently
+        updated first, and the cursor of the next page
+    """
+    chats = sorted(
+        (((chat.get('updated_at') or '', chat_id), chat_id, chat)
+         for chat_id, chat in rows.items()),
+        reverse=True
+    )
+
+    if before is not None:
+        chats = [chat for chat in chats if chat[0] < tuple(before)]
+
+    page = chats[:limit]
+
+    return (
+        [{'id': chat_id, **chat} for _, chat_id, chat in page],
+        page[-1][0] if len(chats) > limit else None
+    )
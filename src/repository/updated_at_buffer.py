@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from os import getenv
+from typing import Any
+
+from models.errors.errors import ServiceUnavailableError
+from repository.rtdb_paths import chat_updated_at_paths
+
+
+class UpdatedAtBuffer:
+    def __init__(self, root: Any, interval: float | None = None):
+        """
+        Write-behind buffer of the updated_at of the chats
+
+        A busy chat bumps its timestamp on every message. Bumps are kept by
+        chat, only the latest one, and flushed together in one multi-path
+        update every `interval` seconds and on stop. Until then `pending`
+        tells readers the value they would see.
+
+        Args:
+            root: Reference to the database root
+            interval: Seconds between flushes, defaults to CHAT_UPDATED_AT_FLUSH_INTERVAL
+        """
+        self.root = root
+        self.interval = interval or float(
+            getenv("CHAT_UPDATED_AT_FLUSH_INTERVAL") or 0.5)
+
+        # chat id -> (participants, timestamp)
+        self._pending: dict[str, tuple[tuple[int, int], str]] = {}
+        # user id -> chat id -> timestamp, waiting or being written, so
+        # inboxes do not scan every chat
+        self._by_user: dict[int, dict[str, str]] = {}
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def touch(self, chat_id: str, participants: tuple[int, int], timestamp: str) -> None:
+        """Record that a chat was updated at `timestamp`"""
+        current = self._pending.get(chat_id)
+
+        # ISO timestamps in UTC sort like the times they represent
+        if current is not None and current[1] >= timestamp:
+            return
+
+        self._pending[chat_id] = (participants, timestamp)
+
+        for user_id in participants:
+            self._by_user.setdefault(user_id, {})[chat_id] = timestamp
+
+    def pending(self, user_id: int) -> dict[str, str]:
+        """The updated_at not yet written of the chats of a user"""
+        return self._by_user.get(user_id, {})
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop flushing periodically and write what is left"""
+        if self._task is not None:
+            self._task.cancel()
+
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+            self._task = None
+
+        # Waits for a flush the loop left running, then writes the rest
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                # Stopping must not interrupt a write half way
+                await asyncio.shield(self.flush())
+            except Exception:
+                logging.exception("could not flush the updated_at of the chats")
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._pending:
+                return
+
+            written, self._pending = self._pending, {}
+
+            updates: dict[str, Any] = {}
+            for chat_id, (participants, timestamp) in written.items():
+                updates.update(chat_updated_at_paths(
+                    chat_id, participants, timestamp))
+
+            try:
+                await self.root.update(updates)
+            except BaseException as e:
+                # Whether the write failed or was cancelled, the bumps are
+                # merged back so the next flush writes them
+                for chat_id, (participants, timestamp) in written.items():
+                    self.touch(chat_id, participants, timestamp)
+
+                if not isinstance(e, ServiceUnavailableError):
+                    raise
+
+                logging.warning(
+                    f"could not write the updated_at of {len(written)} chats, retrying")
+            else:
+                self._forget(written)
+
+    def _forget(self, written: dict[str, tuple[tuple[int, int], str]]) -> None:
+        for chat_id, (participants, timestamp) in written.items():
+            for user_id in participants:
+                chats = self._by_user.get(user_id)
+
+                # A newer bump of the chat may be waiting already
+                if chats is not None and chats.get(chat_id) == timestamp:
+                    del chats[chat_id]
+
+                    if not chats:
+                        del self._by_user[user_id]
@@ -1,63 +1,212 @@
 from json import dumps
-from typing import Annotated
-from fastapi import APIRouter, Depends, Request, status
+from typing import Annotated, Awaitable, Callable
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, WebSocket, status
 from fastapi.responses import JSONResponse
 from controller.chat_controller import ChatController
-from models.chat import ChatBase, Chat
-from models.message import MessageBase, Message
+from models.chat import ChatBase, Chat, ChatPage
+from models.errors.errors import AuthenticationError
+from models.message import MessageBase, Message, MessageBatch, MessageBatchResult, MessagePage
+from routes.dependencies import get_chat_hub, get_chat_service, get_idempotency_cache, get_push_aggregator, get_rate_limiter, limit_writes
 from service.chat_service import ChatService
-from utils.sendNotification import send_push_notification
-from models.jwt import JwtUserPayload
+from utils.chat_hub import ChatHub
+from utils.idempotency import IdempotencyCache
+from utils.push_aggregator import PushAggregator
+from utils.rate_limiter import RateLimiter
+from models.jwt import JwtCustomPayload, JwtUserPayload
 
 router = APIRouter()
 
+ChatServiceDependency = Annotated[ChatService, Depends(get_chat_service)]
+PushAggregatorDependency = Annotated[PushAggregator, Depends(get_push_aggregator)]
+ChatHubDependency = Annotated[ChatHub, Depends(get_chat_hub)]
+IdempotencyCacheDependency = Annotated[IdempotencyCache, Depends(
+    get_idempotency_cache)]
+RateLimiterDependency = Annotated[RateLimiter, Depends(get_rate_limiter)]
+IdempotencyKeyHeader = Annotated[str | None, Header(
+    alias="Idempotency-Key",
+    max_length=255,
+    description="Retries sending the same key get the first response back"
+)]
+
+
+async def _idempotent(idempotency: IdempotencyCache, idempotency_key: str | None, key: tuple, fingerprint: str, status_code: int, fn: Callable[[], Awaitable[dict]]) -> JSONResponse:
+    if idempotency_key is None:
+        return JSONResponse(await fn(), status_code=status_code)
+
+    body, replayed = await idempotency.run(
+        (*key, idempotency_key), fingerprint, fn)
+
+    return JSONResponse(
+        body,
+        status_code=status_code,
+        headers={"Idempotent-Replayed": "true"} if replayed else None
+    )
+
+
+def _notification_data(chat_id: str, username: str) -> dict:
+    return {
+        "type": "message",
+        "params": {
+            "id": chat_id,
+            "user": username
+        }
+    }
+
 
 @router.post(
     "",
     summary="Create a chat and get its id",
+    dependencies=[Depends(limit_writes)],
     status_code=status.HTTP_201_CREATED,
     response_model=Chat
 )
-def create_chat(chat: ChatBase) -> Chat:
+async def create_chat(chat: ChatBase, chat_service: ChatServiceDependency) -> Chat:
     ChatController().validate_users(chat)
 
-    created_chat = ChatService().create_chat(chat)
+    created_chat = await chat_service.create_chat(chat)
 
     return created_chat
 
 
+@router.get(
+    "",
+    summary="Get a page of the chats of the user, most recently updated first",
+    status_code=status.HTTP_200_OK,
+    response_model=ChatPage
+)
+async def get_chats(
+    request: Request,
+    chat_service: ChatServiceDependency,
+    before: Annotated[str | None, Query(
+        description="Cursor returned as next_cursor by the previous page")] = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20
+) -> ChatPage:
+    authUser: JwtUserPayload = request.state.user
+
+    return await chat_service.get_chats(
+        authUser["userId"],
+        before,
+        limit
+    )
+
+
 @router.post(
     "/{id}",
     summary="Post a message in the chat {id}",
     status_code=status.HTTP_201_CREATED,
     response_model=Message
 )
-def send_message(message: MessageBase, request: Request, id: str) -> JSONResponse:
+async def send_message(message: MessageBase, request: Request, id: str, chat_service: ChatServiceDependency, push_aggregator: PushAggregatorDependency, idempotency: IdempotencyCacheDependency, rate_limiter: RateLimiterDependency, idempotency_key: IdempotencyKeyHeader = None) -> JSONResponse:
     authUser: JwtUserPayload = request.state.user
 
     message.content = message.content.strip()
 
-    created_message = ChatService().send_message(
-        message,
+    async def send() -> dict:
+        # Counted here, so replays of an Idempotency-Key are not
+        rate_limiter.check(authUser.get("userId"), id)
+
+        created_message = await chat_service.send_message(
+            message,
+            authUser["userId"],
+            id
+        )
+
+        if message.receiver_expo_token:
+            push_aggregator.notify(
+                message.receiver_expo_token,
+                id,
+                authUser["username"],
+                message.content,
+                data=_notification_data(id, authUser["username"])
+            )
+
+        return dict(created_message)
+
+    return await _idempotent(
+        idempotency,
+        idempotency_key,
+        (authUser["userId"], "send_message", id),
+        f"{message.content}\n{message.receiver_expo_token}",
+        status.HTTP_201_CREATED,
+        send
+    )
+
+
+@router.post(
+    "/{id}/messages:batch",
+    summary="Post several messages in the chat {id} at once, in order",
+    status_code=status.HTTP_200_OK,
+    response_model=MessageBatchResult
+)
+async def send_messages(batch: MessageBatch, request: Request, id: str, chat_service: ChatServiceDependency, push_aggregator: PushAggregatorDependency, rate_limiter: RateLimiterDependency) -> MessageBatchResult:
+    authUser: JwtUserPayload = request.state.user
+
+    # Every message of the batch counts as a write
+    rate_limiter.check(authUser.get("userId"), id, len(batch.messages))
+
+    for message in batch.messages:
+        message.content = message.content.strip()
+
+    results = await chat_service.send_messages(
+        batch.messages,
         authUser["userId"],
         id
     )
 
-    if message.receiver_expo_token:
-        send_push_notification(
-            message.receiver_expo_token,
-            f"{authUser['username']} sent a new message",
-            message.content,
-            data={
-                "type": "message",
-                "params": {
-                    "id": id,
-                    "user": authUser["username"]
-                }
-            }
+    sent = [result.message for result in results if result.message]
+
+    if batch.receiver_expo_token and sent:
+        # One notification for the whole batch
+        push_aggregator.notify(
+            batch.receiver_expo_token,
+            id,
+            authUser["username"],
+            sent[-1].content,
+            data=_notification_data(id, authUser["username"]),
+            count=len(sent)
         )
 
-    return JSONResponse(dict(created_message), status_code=status.HTTP_201_CREATED)
+    return MessageBatchResult(results=results)
+
+
+@router.post(
+    "/{id}/read",
+    summary="Mark the chat {id} as read up to its last message",
+    dependencies=[Depends(limit_writes)],
+    status_code=status.HTTP_204_NO_CONTENT,
+    response_model=None
+)
+async def mark_read(id: str, request: Request, chat_service: ChatServiceDependency) -> None:
+    authUser: JwtUserPayload = request.state.user
+
+    await chat_service.mark_read(
+        authUser["userId"],
+        id
+    )
+
+
+@router.get(
+    "/{id}/messages",
+    summary="Get a page of messages of the chat {id}, oldest first",
+    status_code=status.HTTP_200_OK,
+    response_model=MessagePage
+)
+async def get_messages(
+    id: str,
+    request: Request,
+    chat_service: ChatServiceDependency,
+    before: Annotated[str | None, Query(
+        description="Cursor returned as next_cursor by the previous page")] = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 50
+) -> MessagePage:
+    authUser: JwtUserPayload = request.state.user
+
+    return await chat_service.get_messages(
+        authUser["userId"],
+        id,
+        before,
+        limit
+    )
 
 
 @router.patch(
@@ -66,32 +215,72 @@ def send_message(message: MessageBase, request: Request, id: str) -> JSONRespons
     status_code=status.HTTP_200_OK,
     response_model=Message
 )
-def edit_message(message: MessageBase, id: str, chat_id: str, request: Request) -> JSONResponse:
+async def edit_message(message: MessageBase, id: str, chat_id: str, request: Request, chat_service: ChatServiceDependency, idempotency: IdempotencyCacheDependency, rate_limiter: RateLimiterDependency, idempotency_key: IdempotencyKeyHeader = None) -> JSONResponse:
     authUser = request.state.user
 
     message.content = message.content.strip()
 
-    created_message = ChatService().edit_message(
-        message,
-        authUser["userId"],
-        chat_id,
-        id
-    )
+    async def edit() -> dict:
+        # Counted here, so replays of an Idempotency-Key are not
+        rate_limiter.check(authUser.get("userId"), chat_id)
+
+        created_message = await chat_service.edit_message(
+            message,
+            authUser["userId"],
+            chat_id,
+            id
+        )
+
+        return dict(created_message)
 
-    return JSONResponse(dict(created_message), status_code=status.HTTP_200_OK)
+    return await _idempotent(
+        idempotency,
+        idempotency_key,
+        (authUser["userId"], "edit_message", chat_id, id),
+        message.content,
+        status.HTTP_200_OK,
+        edit
+    )
 
 
 @router.delete(
     "/{chat_id}/messages/{id}",
     summary="Delete a message",
+    dependencies=[Depends(limit_writes)],
     status_code=status.HTTP_204_NO_CONTENT,
     response_model=None
 )
-def delete_message(id: str, chat_id: str, request: Request) -> None:
+async def delete_message(id: str, chat_id: str, request: Request, chat_service: ChatServiceDependency) -> None:
     authUser = request.state.user
 
-    ChatService().delete_message(
+    await chat_service.delete_message(
         authUser["userId"],
         chat_id,
         id
     )
+
+
+@router.websocket("/{id}/ws")
+async def chat_events(websocket: WebSocket, id: str, chat_service: ChatServiceDependency, hub: ChatHubDependency) -> None:
+    """
+    Push the messages created, edited and deleted in the chat {id}
+
+    Events are JSON objects whose `type` is message.created, message.edited,
+    message.deleted, chat.read or ping. Only participants can connect.
+    """
+    authUser: JwtCustomPayload = websocket.state.user
+    user_id = authUser.get("userId")
+
+    try:
+        if user_id is None:
+            raise AuthenticationError("To read a chat you must be in it")
+
+        await chat_service.validate_participant(user_id, id)
+    except HTTPException as e:
+        await websocket.close(
+            status.WS_1011_INTERNAL_ERROR if e.status_code >= 500 else status.WS_1008_POLICY_VIOLATION
+        )
+        return
+
+    await websocket.accept()
+    await hub.serve(websocket, id, user_id)
@@ -0,0 +1,44 @@
+from fastapi.requests import HTTPConnection, Request
+
+from service.chat_service import ChatService
+from service.container import Container
+from service.users_service import UsersService
+from utils.chat_hub import ChatHub
+from utils.idempotency import IdempotencyCache
+from utils.push_aggregator import PushAggregator
+from utils.rate_limiter import RateLimiter
+
+
+def get_container(connection: HTTPConnection) -> Container:
+    return connection.app.state.container
+
+
+def get_chat_service(connection: HTTPConnection) -> ChatService:
+    return get_container(connection).chat_service
+
+
+def get_users_service(connection: HTTPConnection) -> UsersService:
+    return get_container(connection).users_service
+
+
+def get_push_aggregator(connection: HTTPConnection) -> PushAggregator:
+    return get_container(connection).push_aggregator
+
+
+def get_chat_hub(connection: HTTPConnection) -> ChatHub:
+    return get_container(connection).chat_hub
+
+
+def get_idempotency_cache(connection: HTTPConnection) -> IdempotencyCache:
+    return get_container(connection).idempotency_cache
+
+
+def get_rate_limiter(connection: HTTPConnection) -> RateLimiter:
+    return get_container(connection).rate_limiter
+
+
+async def limit_writes(request: Request) -> None:
+    """Apply the per user and per chat write limits, after authentication"""
+    chat_id = request.path_params.get("chat_id") or request.path_params.get("id")
+
+    get_rate_limiter(request).check(request.state.user.get("userId"), chat_id)
@@ -0,0 +1,14 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+router = APIRouter()
+
+
+@router.get(
+    "",
+    summary="Prometheus metrics",
+    include_in_schema=False
+)
+async def get_metrics() -> Response:
+    # Async so the thread pool gauges are read from the event loop
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
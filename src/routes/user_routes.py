@@ -0,0 +1,45 @@
+from typing import Annotated
+from fastapi import APIRouter, Depends, Request, status
+from models.errors.errors import ForbiddenError
+from models.jwt import JwtCustomPayload
+from routes.dependencies import get_chat_hub, get_users_service
+from service.users_service import UsersService
+from utils.chat_hub import ChatHub
+from utils.event_bus import USERS_CACHE_CHANNEL
+
+router = APIRouter()
+
+
+def _validate_admin(request: Request) -> None:
+    authUser: JwtCustomPayload = request.state.user
+
+    if authUser["type"] != 'admin':
+        raise ForbiddenError("Only admins can manage the users cache")
+
+
+@router.get(
+    "/cache/stats",
+    summary="Get hit/miss counters of the user status cache",
+    status_code=status.HTTP_200_OK
+)
+async def get_cache_stats(request: Request, users_service: Annotated[UsersService, Depends(get_users_service)]) -> dict:
+    _validate_admin(request)
+
+    return users_service.cache.stats()
+
+
+@router.delete(
+    "/cache/{username}",
+    summary="Evict the cached status of user {username}",
+    status_code=status.HTTP_204_NO_CONTENT,
+    response_model=None
+)
+async def invalidate_user(username: str, request: Request, hub: Annotated[ChatHub, Depends(get_chat_hub)]) -> None:
+    """
+    Evict the status in every worker, through the event bus. Workers the
+    bus does not reach, like those of other hosts with EVENT_BUS=socket,
+    keep it until it expires.
+    """
+    _validate_admin(request)
+
+    hub.bus.publish(USERS_CACHE_CHANNEL, {"username": username})
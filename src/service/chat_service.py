@@ -1,19 +1,33 @@
-from models.chat import Chat, ChatBase
-from models.errors.errors import MessageMaxLengthException
-from models.message import Message, MessageBase
-from repository.firebase_db import FirebaseDB
+from models.chat import Chat, ChatBase, ChatPage, InboxChat
+from models.errors.errors import CustomHTTPException, MessageMaxLengthException, ValidationError
+from models.message import Message, MessageBase, MessageBatchItem, MessageError, MessagePage
+from repository.async_firebase_db import AsyncFirebaseDB
+from repository.chat_repository import IChatRepository
+from utils.chat_hub import ChatHub
+from utils.cursor import decode_cursor, encode_cursor
 
 
 class ChatService:
-    def __init__(self, repository: FirebaseDB | None = None):
-        self.repository: FirebaseDB = repository or FirebaseDB()
+    def __init__(self, repository: IChatRepository | None = None, hub: ChatHub | None = None):
+        """
+        Args:
+            repository: Storage of the chats, defaults to AsyncFirebaseDB
+            hub: Receives the created, edited and deleted messages to push
+                them to the connected participants
+        """
+        self.repository: IChatRepository = repository or AsyncFirebaseDB()
+        self.hub = hub
+
+    def _publish(self, chat_id: str, event: str, **data) -> None:
+        if self.hub is not None:
+            self.hub.publish(chat_id, {"type": event, "chat_id": chat_id, **data})
 
     def validate_message(self, message: str):
         if len(message) > 280:
             raise MessageMaxLengthException()
 
-    def create_chat(self, chat: ChatBase) -> Chat:
-        chat_key: str = self.repository.create_chat(
+    async def create_chat(self, chat: ChatBase) -> Chat:
+        chat_key: str = await self.repository.create_chat(
             chat.user1, chat.user2
         )
 
@@ -22,25 +36,125 @@ class ChatService:
             id=chat_key
         )
 
-    def send_message(self, message: MessageBase, user_id: int, chat_id: str) -> Message:
+    async def send_message(self, message: MessageBase, user_id: int, chat_id: str) -> Message:
         self.validate_message(message.content)
 
-        created_message = self.repository.send_message(
+        created_message = await self.repository.send_message(
             chat_id, user_id, message.content
         )
 
-        return Message(**(dict(created_message)))
+        created = Message(**(dict(created_message)))
+        self._publish(chat_id, "message.created",
+                      message=created.model_dump())
+
+        return created
+
+    async def send_messages(self, messages: list[MessageBase], user_id: int, chat_id: str) -> list[MessageBatchItem]:
+        """
+        Send several messages at once, skipping the invalid ones
+
+        The valid messages are committed together, in order.
+
+        Returns:
+            list[MessageBatchItem]: The result of each message, in order
+        """
+        errors: list[MessageBatchItem | None] = []
+        contents: list[str] = []
+
+        for message in messages:
+            try:
+                self.validate_message(message.content)
+            except CustomHTTPException as e:
+                errors.append(MessageBatchItem(
+                    status=e.status_code,
+                    error=MessageError(title=e.title, detail=e.detail)
+                ))
+            else:
+                errors.append(None)
+                contents.append(message.content)
+
+        created = iter(await self.repository.send_messages(
+            chat_id, user_id, contents
+        ) if contents else [])
 
-    def edit_message(self, message: MessageBase, user_id: int, chat_id: str, message_id: str) -> Message:
+        results = [
+            error or MessageBatchItem(
+                status=201, message=Message(**next(created)))
+            for error in errors
+        ]
+
+        for result in results:
+            if result.message:
+                self._publish(chat_id, "message.created",
+                              message=result.message.model_dump())
+
+        return results
+
+    async def edit_message(self, message: MessageBase, user_id: int, chat_id: str, message_id: str) -> Message:
         self.validate_message(message.content)
 
-        updated_message = self.repository.edit_message(
+        updated_message = await self.repository.edit_message(
             chat_id, message_id, message.content, user_id
         )
 
-        return Message(**(dict(updated_message)))
+        updated = Message(**(dict(updated_message)))
+        self._publish(chat_id, "message.edited", message=updated.model_dump())
 
-    def delete_message(self, user_id: int, chat_id: str, message_id: str) -> None:
-        self.repository.delete_message(
+        return updated
+
+    async def delete_message(self, user_id: int, chat_id: str, message_id: str) -> None:
+        await self.repository.delete_message(
             chat_id, message_id, user_id
         )
+
+        self._publish(chat_id, "message.deleted", message_id=message_id)
+
+    async def mark_read(self, user_id: int, chat_id: str) -> None:
+        message_id = await self.repository.mark_read(chat_id, user_id)
+
+        self._publish(chat_id, "chat.read", user_id=user_id,
+                      message_id=message_id)
+
+    async def validate_participant(self, user_id: int, chat_id: str) -> None:
+        await self.repository.validate_participant(chat_id, user_id)
+
+    async def get_messages(self, user_id: int, chat_id: str, cursor: str | None = None, limit: int = 50) -> MessagePage:
+        before = decode_cursor(cursor, str) if cursor else None
+
+        messages, next_before = await self.repository.get_messages(
+            chat_id, user_id, before, limit
+        )
+
+        return MessagePage(
+            messages=[Message(**message) for message in messages],
+            next_cursor=encode_cursor(next_before) if next_before else None
+        )
+
+    async def get_chats(self, user_id: int, cursor: str | None = None, limit: int = 20) -> ChatPage:
+        before = decode_cursor(cursor, list) if cursor else None
+
+        if before is not None and (len(before) != 2 or not all(isinstance(value, str) for value in before)):
+            raise ValidationError(
+                title="Invalid cursor",
+                detail="The cursor is not valid, use the one returned by the previous page"
+            )
+
+        chats, next_before = await self.repository.get_inbox(
+            user_id, tuple(before) if before else None, limit  # type: ignore
+        )
+
+        return ChatPage(
+            chats=[
+                InboxChat(
+                    **chat["participants"],
+                    id=chat["id"],
+                    created_at=chat["created_at"],
+                    updated_at=chat.get("updated_at"),
+                    last_message=chat.get("last_message"),
+                    unread=chat.get("unread") or 0,
+                    last_read_id=chat.get("last_read_id")
+                )
+                for chat in chats
+            ],
+            next_cursor=encode_cursor(next_before) if next_before else None
+        )
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+
+import httpx
+
+from models.errors.errors import ServiceUnavailableError
+from repository.async_firebase_db import AsyncFirebaseDB, AsyncReference, RTDBClient, rtdb_client
+from repository.chat_repository import IChatRepository
+from repository.firebase_db import init_firebase
+from repository.updated_at_buffer import UpdatedAtBuffer
+from service.chat_service import ChatService
+from service.users_service import UsersService
+from utils.chat_hub import ChatHub
+from utils.event_bus import USERS_CACHE_CHANNEL, create_event_bus
+from utils.idempotency import IdempotencyCache
+from utils.push_aggregator import PushAggregator
+from utils.push_dispatcher import PushDispatcher
+from utils.rate_limiter import RateLimiter
+
+
+class Container:
+    def __init__(self, users_service: UsersService | None = None, repository: IChatRepository | None = None, push_dispatcher: PushDispatcher | None = None, rtdb: RTDBClient | None = None, rate_limiter: RateLimiter | None = None):
+        """
+        Services shared by every request of a worker
+
+        Building it is cheap, clients connect lazily. `start` initializes
+        Firebase, starts the background tasks and warms the connections,
+        `aclose` stops and closes everything.
+
+        Args:
+            users_service: Client of the users service
+            repository: Chats repository, defaults to AsyncFirebaseDB over `rtdb`
+            push_dispatcher: Sender of the push notifications
+            rtdb: Client of the Realtime Database, only used when no repository is given
+            rate_limiter: Limits of the write routes
+        """
+        self.users_service = users_service or UsersService()
+        # Firebase is only needed when the repository talks to it
+        self.rtdb: RTDBClient | None = None
+
+        if repository is None:
+            self.rtdb = rtdb or rtdb_client
+            root = AsyncReference(self.rtdb)
+            # Busy chats bump their updated_at once per flush, not per message
+            repository = AsyncFirebaseDB(
+                root, updated_at=UpdatedAtBuffer(root))
+
+        self.repository = repository
+        # Pushes chat events to the websockets connected to this worker, and
+        # to the other workers through the bus selected by EVENT_BUS
+        self.chat_hub = ChatHub(bus=create_event_bus())
+        # Evictions of the users cache are published there too, so they
+        # reach the cache of every worker
+        self.chat_hub.bus.listen(USERS_CACHE_CHANNEL, self._invalidate_user)
+        self.chat_service = ChatService(self.repository, self.chat_hub)
+        # Responses of recent requests sent with an Idempotency-Key
+        self.idempotency_cache = IdempotencyCache()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.push_dispatcher = push_dispatcher or PushDispatcher()
+        self.push_aggregator = PushAggregator(self.push_dispatcher)
+
+    def _invalidate_user(self, event: dict) -> None:
+        self.users_service.cache.invalidate(event["username"])
+
+    async def start(self, warm_up: bool = True) -> None:
+        if self.rtdb is not None:
+            init_firebase()
+
+        await self.repository.start()
+        await self.push_dispatcher.start()
+        await self.push_aggregator.start()
+        await self.chat_hub.start()
+
+        if warm_up:
+            await self.warm_up()
+
+    async def warm_up(self) -> None:
+        """Open the connections and fetch the tokens the first requests need"""
+        await asyncio.gather(self._warm_up_database(), self._warm_up_users_service())
+
+    async def _warm_up_database(self) -> None:
+        if self.rtdb is None:
+            return
+
+        try:
+            # Fetches the access token and opens the connection, shallow
+            # reads only return the keys of the root
+            await self.rtdb.request("GET", "", {"shallow": "true"})
+        except ServiceUnavailableError:
+            logging.warning("could not warm up the database connection")
+
+    async def _warm_up_users_service(self) -> None:
+        if not self.users_service.base_url:
+            return
+
+        try:
+            # Any answer leaves a pooled connection behind
+            await self.users_service.client.get(self.users_service.base_url)
+        except httpx.HTTPError as e:
+            logging.warning(
+                f"could not warm up the users service connection: {e!r}")
+
+    async def aclose(self) -> None:
+        await self.chat_hub.stop()
+        await self.push_aggregator.stop()
+        await self.push_dispatcher.stop()
+        await self.users_service.aclose()
+        # Writes the pending updated_at before the client closes
+        await self.repository.aclose()
+
+        if self.rtdb is not None:
+            await self.rtdb.aclose()
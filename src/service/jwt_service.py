@@ -1,9 +1,12 @@
 from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
+import hashlib
 import logging
 from os import getenv
+import time
 from typing import Optional, Union
 
+from cachetools import TLRUCache
 import jwt
 
 from models.errors.errors import AuthenticationError
@@ -27,7 +30,7 @@ class IJWTService(ABC):
 
 
 class JWTService(IJWTService):
-    def __init__(self):
+    def __init__(self, cache_size: Optional[int] = None):
         self.expires_in = timedelta(days=365)
         key = getenv('JWT_SECRET_KEY')
         self.secret: str = key if key else "mySup3rStr0ngDevSecretKey"
@@ -37,6 +40,20 @@ class JWTService(IJWTService):
 
         logging.info("JWT_SECRET_KEY set")
 
+        # Verified payloads keyed by token hash, each one dropped at its `exp`
+        self.cache_size = cache_size if cache_size is not None else int(
+            getenv('JWT_CACHE_MAXSIZE') or 10000)
+        self.verified: TLRUCache = TLRUCache(
+            max(self.cache_size, 1), ttu=self._expires_at, timer=time.time)
+
+    def _expires_at(self, _key: bytes, payload: dict, now: float) -> float:
+        exp = payload.get('exp')
+
+        if isinstance(exp, (int, float)):
+            return exp
+
+        return now + self.expires_in.total_seconds()
+
     def sign(self, payload: JwtCustomPayload) -> str:
         """
         Sign a JWT token with the given payload
@@ -55,6 +72,9 @@ class JWTService(IJWTService):
         """
         Verify a JWT token
 
+        Tokens that were already verified are served from a bounded LRU
+        cache until they expire, skipping the signature check.
+
         Args:
             token: The JWT token to verify
 
@@ -64,11 +84,22 @@ class JWTService(IJWTService):
         Raises:
             AuthenticationError: If the token is invalid or expired
         """
+        key = hashlib.sha256(token.encode()).digest()
+        payload = self.verified.get(key)
+
+        if payload is not None:
+            return dict(payload)
+
         try:
-            return jwt.decode(token, self.secret, algorithms=['HS256'])
+            payload = jwt.decode(token, self.secret, algorithms=['HS256'])
         except jwt.InvalidTokenError:
             raise AuthenticationError()
 
+        if self.cache_size > 0:
+            self.verified[key] = payload
+
+        return dict(payload)
+
     def decode(self, token: str) -> Optional[Union[dict, str]]:
         """
         Decode a JWT token without verification
@@ -0,0 +1,200 @@
+import logging
+from os import getenv
+import time
+
+from cachetools import TLRUCache
+import httpx
+
+from models.errors.errors import AuthenticationError, BlockedError, NotFoundError, ServiceUnavailableError, ValidationError
+from utils.single_flight import SingleFlight
+
+
+class UserStatusCache:
+    def __init__(self, maxsize: int | None = None, ttl: float | None = None, blocked_ttl: float | None = None, not_found_ttl: float | None = None):
+        """
+        LRU cache of users service status codes keyed by username
+
+        Successful lookups live for `ttl` seconds while blocked (403) and
+        not found (404) answers use their own, usually much shorter, TTLs.
+
+        Args:
+            maxsize: Maximum amount of usernames kept, defaults to USERS_CACHE_MAXSIZE
+            ttl: Seconds a 200 answer is kept, defaults to USERS_CACHE_TTL
+            blocked_ttl: Seconds a 403 answer is kept, defaults to USERS_CACHE_BLOCKED_TTL
+            not_found_ttl: Seconds a 404 answer is kept, defaults to USERS_CACHE_NOT_FOUND_TTL
+        """
+        self.maxsize = maxsize or int(getenv("USERS_CACHE_MAXSIZE") or 10000)
+        self.ttls: dict[int, float] = {
+            200: ttl if ttl is not None else float(getenv("USERS_CACHE_TTL") or 60),
+            403: blocked_ttl if blocked_ttl is not None else float(getenv("USERS_CACHE_BLOCKED_TTL") or 5),
+            404: not_found_ttl if not_found_ttl is not None else float(getenv("USERS_CACHE_NOT_FOUND_TTL") or 5)
+        }
+        self.hits = 0
+        self.misses = 0
+        self._cache: TLRUCache = TLRUCache(
+            self.maxsize, ttu=self._time_to_use, timer=time.monotonic)
+
+    def _time_to_use(self, _username: str, status_code: int, now: float) -> float:
+        return now + self.ttls[status_code]
+
+    def get(self, username: str) -> int | None:
+        status_code = self._cache.get(username)
+
+        if status_code is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return status_code
+
+    def set(self, username: str, status_code: int) -> None:
+        if status_code in self.ttls and self.ttls[status_code] > 0:
+            self._cache[username] = status_code
+
+    def invalidate(self, username: str) -> bool:
+        return self._cache.pop(username, None) is not None
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "size": len(self._cache),
+            "maxsize": self.maxsize,
+            "ttl": self.ttls[200],
+            "blocked_ttl": self.ttls[403],
+            "not_found_ttl": self.ttls[404]
+        }
+
+
+class UsersService:
+    def __init__(self, client: httpx.AsyncClient | None = None, base_url: str | None = None, cache: UserStatusCache | None = None):
+        """
+        Client for the users service
+
+        The underlying httpx client is shared by every request of the app so
+        connections to the users service are kept alive and pooled.
+
+        Args:
+            client: Preconfigured async client, mostly useful for tests
+            base_url: Users service url, defaults to USERS_SERVICE_URL
+            cache: Status cache used by `check_blocked`
+        """
+        self._client = client
+        self._base_url = base_url
+        self._cache = cache
+        self._lookups = SingleFlight()
+
+    @property
+    def base_url(self) -> str:
+        return self._base_url or getenv("USERS_SERVICE_URL") or ""
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    float(getenv("USERS_SERVICE_READ_TIMEOUT") or 5.0),
+                    connect=float(getenv("USERS_SERVICE_CONNECT_TIMEOUT") or 2.0)
+                ),
+                limits=httpx.Limits(
+                    max_connections=int(
+                        getenv("USERS_SERVICE_MAX_CONNECTIONS") or 100),
+                    max_keepalive_connections=int(
+                        getenv("USERS_SERVICE_MAX_KEEPALIVE_CONNECTIONS") or 20),
+                    keepalive_expiry=float(
+                        getenv("USERS_SERVICE_KEEPALIVE_EXPIRY") or 30.0)
+                )
+            )
+
+        return self._client
+
+    @property
+    def cache(self) -> UserStatusCache:
+        if self._cache is None:
+            self._cache = UserStatusCache()
+
+        return self._cache
+
+    async def get_user(self, username: str, token: str) -> httpx.Response:
+        """
+        Fetch a user from the users service
+
+        Args:
+            username: The username to look up
+            token: The bearer token of the caller
+
+        Returns:
+            httpx.Response: The raw users service response
+
+        Raises:
+            ServiceUnavailableError: If the users service can not be reached in time
+        """
+        try:
+            return await self.client.get(
+                f"{self.base_url}/users/{username}",
+                headers={"Authorization": f"Bearer {token}"}
+            )
+        except httpx.HTTPError as e:
+            logging.error(f"users service request failed: {e!r}")
+            raise ServiceUnavailableError()
+
+    async def check_blocked(self, username: str, token: str) -> None:
+        """
+        Make sure a user exists and is not blocked
+
+        Answers are served from the status cache when possible and
+        concurrent lookups of the same username share one request.
+
+        Args:
+            username: The username to check
+            token: The bearer token of the caller
+
+        Raises:
+            ValidationError: If the users service rejects the username
+            AuthenticationError: If the users service rejects the token
+            BlockedError: If the user is blocked
+            NotFoundError: If the user does not exist
+            ServiceUnavailableError: If the users service is failing
+        """
+        status_code = self.cache.get(username)
+
+        if status_code is None:
+            status_code = await self._lookups.do(
+                username, lambda: self._fetch_status(username, token)
+            )
+
+        match status_code:
+            case 401:
+                raise AuthenticationError()
+            case 403:
+                raise BlockedError()
+            case 404:
+                raise NotFoundError(
+                    f'username {username} not found')
+            case 500:
+                raise ServiceUnavailableError()
+
+    async def _fetch_status(self, username: str, token: str) -> int:
+        response = await self.get_user(username, token)
+
+        if response.status_code == 400:
+            data = response.json()
+            raise ValidationError(
+                title=data["title"],
+                detail=data["detail"]
+            )
+
+        self.cache.set(username, response.status_code)
+
+        return response.status_code
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
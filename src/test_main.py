@@ -1,29 +1,53 @@
 # test_chat_routes.py
+import asyncio
+from contextlib import contextmanager
+import hashlib
 import json
+import time
 from typing import Any, Coroutine, Literal, Optional, Union
 from fastapi.responses import JSONResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 import httpx
+import jwt
 import pytest
 from fastapi.testclient import TestClient
-from fastapi import FastAPI, Request
-from unittest.mock import Mock, patch
+from fastapi import Depends, FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from unittest.mock import Mock, create_autospec, patch
 from datetime import datetime
 
+from commands.backfill import build_chat_pairs, build_user_chats, iter_chats, write_updates
 from controller.chat_controller import ChatController
 from middleware.auth_middleware import JWTMiddleware
 from middleware.error_handler import error_handler
+from middleware.metrics_middleware import MetricsMiddleware
 from models.chat import Chat, ChatBase
 from models.message import Message, MessageBase
-from models.errors.errors import ValidationError, MessageMaxLengthException
+from models.errors.errors import AuthenticationError, BlockedError, NotFoundError, ValidationError, MessageMaxLengthException, ServiceUnavailableError, TooManyRequestsError
 from models.user import User
-from repository.firebase_db import FirebaseDB
+from repository.async_firebase_db import AccessTokenCache, AsyncFirebaseDB, AsyncReference, RTDBClient
+from repository.memory_db import MemoryDatabase, MemoryReference
+from repository.updated_at_buffer import UpdatedAtBuffer
+from repository.firebase_db import ParticipantsCache
+from repository.rtdb_paths import user_chat_entry
 from routes.chat_routes import router
-from starlette.middleware.base import BaseHTTPMiddleware
+from routes.dependencies import get_chat_service
+from routes.metrics_routes import router as metrics_router
+from routes.user_routes import router as user_router
 from service.chat_service import ChatService
+from service.container import Container
 from service.jwt_service import JWTService
+from service.users_service import UserStatusCache, UsersService
 from models.jwt import JwtCustomPayload
-import requests_mock
+from utils.push_aggregator import PushAggregator
+from utils.push_dispatcher import PushDispatcher
+from utils.chat_hub import ChatHub
+from utils.event_bus import USERS_CACHE_CHANNEL, EventBroker, InProcessEventBus, SocketEventBus, create_event_bus
+from utils.idempotency import IdempotencyCache
+from utils.rate_limiter import RateLimiter, TokenBuckets
+from utils.cursor import decode_cursor, encode_cursor
+from utils.metrics import timed
+from utils.push_id import PushIdGenerator, generate_push_id
+from utils.single_flight import SingleFlight
 import dotenv
 # Fixtures
 from os import getenv
@@ -61,10 +85,55 @@ class MockHTTPBearer(HTTPBearer):
         )
 
 
+class MockUsersServiceTransport(httpx.MockTransport):
+    def __init__(self):
+        super().__init__(self.respond)
+        self.status_code = 200
+        self.json: dict = {"id": 1, "username": "test"}
+        self.requests: list[httpx.Request] = []
+
+    def respond(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        return httpx.Response(self.status_code, json=self.json)
+
+
+users_service_transport = MockUsersServiceTransport()
+
+
+@contextmanager
+def mock_users_service(json: dict, status_code: int = 200):
+    users_service_transport.status_code = status_code
+    users_service_transport.json = json
+    users_service_transport.requests = []
+    users_service.cache.clear()
+
+    yield users_service_transport
+
+    users_service_transport.status_code = 200
+    users_service_transport.json = {"id": 1, "username": "test"}
+
+
+def build_users_service() -> UsersService:
+    return UsersService(
+        httpx.AsyncClient(transport=users_service_transport),
+        "http://users-service"
+    )
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
 @pytest.fixture(autouse=True)
 def mock_firebase():
-    with patch('service.chat_service.FirebaseDB') as mock:
-        yield mock
+    mock = create_autospec(AsyncFirebaseDB)
+    app.dependency_overrides[get_chat_service] = lambda: ChatService(
+        mock.return_value, container.chat_hub)
+
+    yield mock
+
+    app.dependency_overrides.clear()
 
 
 @pytest.fixture
@@ -87,90 +156,1969 @@ def sample_message_data():
     }
 
 
-app = FastAPI()
+app = FastAPI()
+
+users_service = build_users_service()
+container = Container(
+    users_service=users_service,
+    repository=create_autospec(AsyncFirebaseDB, instance=True),
+    push_dispatcher=Mock(spec=PushDispatcher),
+    # Tests write as the same user much faster than allowed
+    rate_limiter=RateLimiter(user_rate=1e9, user_burst=1e9,
+                             chat_rate=1e9, chat_burst=1e9)
+)
+app.state.container = container
+
+app.add_middleware(JWTMiddleware, jwt_service=MockJWTService(),
+                   security=MockHTTPBearer(), public_paths=["/metrics"])
+app.add_middleware(MetricsMiddleware)
+
+
+app.include_router(router, prefix="/chats", tags=["chats"])
+app.include_router(user_router, prefix="/users", tags=["users"])
+app.include_router(metrics_router, prefix="/metrics", tags=["metrics"])
+
+
+@app.exception_handler(HTTPException)
+@app.exception_handler(Exception)
+async def exception_handler(request: Request, exc: Exception) -> JSONResponse:
+    return error_handler(request, exc)
+
+
+client = TestClient(app)
+
+
+# Unit Tests
+
+class TestChatController:
+    def test_validate_users_success(self):
+        chat = ChatBase(user1=User(id=1, username="test1"),
+                        user2=User(id=2, username="test2"))
+        # Should not raise any exception
+        ChatController().validate_users(chat)
+
+    def test_validate_users_id_failure(self):
+        chat = ChatBase(user1=User(id=0, username="test1"),
+                        user2=User(id=2, username="test2"))
+        with pytest.raises(ValidationError):
+            ChatController().validate_users(chat)
+
+    def test_validate_users_username_failure(self):
+        chat = ChatBase(user1=User(id=1, username=""),
+                        user2=User(id=2, username="test2"))
+        with pytest.raises(ValidationError):
+            ChatController().validate_users(chat)
+
+
+class TestChatService:
+    def test_validate_message_success(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        service = ChatService(mock_instance)
+        # Should not raise any exception
+        service.validate_message("Valid message")
+
+    def test_validate_message_too_long(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        service = ChatService(mock_instance)
+
+        with pytest.raises(MessageMaxLengthException):
+            service.validate_message("x" * 281)
+
+    @pytest.mark.anyio
+    async def test_create_chat(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.create_chat.return_value = "chat123"
+
+        service = ChatService(mock_instance)
+        chat = ChatBase(user1=User(id=1, username="test1"),
+                        user2=User(id=2, username="test2"))
+        result = await service.create_chat(chat)
+
+        assert isinstance(result, Chat)
+        assert result.id == "chat123"
+        mock_instance.create_chat.assert_called_once_with(
+            User(id=1, username="test1"), User(id=2, username="test2"))
+
+    @pytest.mark.anyio
+    async def test_send_message(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.send_message.return_value = {
+            "id": "msg123",
+            "content": "Hello",
+            "sender_id": 1,
+            "created_at": datetime.now().isoformat()
+        }
+
+        service = ChatService(mock_instance)
+        message = MessageBase(content="Hello")
+        result = await service.send_message(message, 1, "chat123")
+
+        assert isinstance(result, Message)
+        assert result.content == "Hello"
+        mock_instance.send_message.assert_called_once_with(
+            "chat123", 1, "Hello")
+
+    @pytest.mark.anyio
+    async def test_get_messages(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.get_messages.return_value = ([{
+            "id": "msg123",
+            "content": "Hello",
+            "sender_id": 1,
+            "created_at": datetime.now().isoformat()
+        }], "msg123")
+
+        service = ChatService(mock_instance)
+        page = await service.get_messages(1, "chat123", encode_cursor("msg200"), 1)
+
+        assert page.messages[0].id == "msg123"
+        assert decode_cursor(page.next_cursor, str) == "msg123"  # type: ignore
+        mock_instance.get_messages.assert_called_once_with(
+            "chat123", 1, "msg200", 1)
+
+    @pytest.mark.anyio
+    async def test_get_chats(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.get_inbox.return_value = ([{
+            "id": "chat123",
+            "participants": {
+                "user1": {"id": 1, "username": "test1"},
+                "user2": {"id": 2, "username": "test2"}
+            },
+            "created_at": "2024-01-01T00:00:00",
+            "updated_at": "2024-01-02T00:00:00",
+            "last_message": {"id": "msg123", "content": "Hello", "sender_id": 2, "created_at": "2024-01-02T00:00:00"},
+            "unread": 3,
+            "last_read_id": "msg100"
+        }], ("2024-01-02T00:00:00", "chat123"))
+
+        service = ChatService(mock_instance)
+        page = await service.get_chats(1, encode_cursor(["2024-01-03T00:00:00", "chat999"]), 1)
+
+        assert page.chats[0].unread == 3
+        assert page.chats[0].last_read_id == "msg100"
+        assert page.chats[0].user2.username == "test2"
+        assert page.chats[0].last_message.content == "Hello"  # type: ignore
+        assert decode_cursor(page.next_cursor, list) == [  # type: ignore
+            "2024-01-02T00:00:00", "chat123"]
+        mock_instance.get_inbox.assert_called_once_with(
+            1, ("2024-01-03T00:00:00", "chat999"), 1)
+
+    @pytest.mark.anyio
+    async def test_send_messages_all_invalid(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        service = ChatService(mock_instance)
+
+        results = await service.send_messages([MessageBase(content="x" * 281)], 1, "chat123")
+
+        assert results[0].status == 400
+        mock_instance.send_messages.assert_not_called()
+
+    @pytest.mark.anyio
+    async def test_get_chats_invalid_cursor(self, mock_firebase):
+        service = ChatService(mock_firebase.return_value)
+
+        with pytest.raises(ValidationError):
+            await service.get_chats(1, encode_cursor(["chat999"]))
+
+
+class FakeKeyQuery:
+    def __init__(self, value: dict, child: str | None = None):
+        self.value = value
+        self.child = child
+        self.end: str | None = None
+        self.last: int | None = None
+
+    def sort_key(self, key: str) -> tuple:
+        if self.child is None:
+            return (key, key)
+
+        return ((self.value[key].get(self.child) or ""), key)
+
+    def end_at(self, key: str) -> "FakeKeyQuery":
+        self.end = key
+        return self
+
+    def limit_to_last(self, limit: int) -> "FakeKeyQuery":
+        self.last = limit
+        return self
+
+    def get(self) -> dict:
+        keys = sorted(
+            (key for key in self.value if self.end is None or self.sort_key(key)[0] <= self.end),
+            key=self.sort_key
+        )
+        return {key: self.value[key] for key in keys[-self.last:]}  # type: ignore
+
+
+def build_memory_firebase_db(data: dict[str, Any]) -> tuple[AsyncFirebaseDB, MemoryDatabase]:
+    database = MemoryDatabase(data)
+
+    return AsyncFirebaseDB(database.reference(), ParticipantsCache()), database
+
+
+class TestFirebaseDB:
+    participants = {
+        "user1": {"id": 1, "username": "test1"},
+        "user2": {"id": 2, "username": "test2"}
+    }
+
+    @pytest.mark.anyio
+    async def test_send_message_is_one_write(self):
+        repository, database = build_memory_firebase_db(
+            {"chats": {"chat123": {"participants": self.participants}}})
+
+        first = await repository.send_message("chat123", 1, "Hello")
+        second = await repository.send_message("chat123", 2, "Hi")
+
+        assert database.reads == 1
+        assert database.writes == 2
+        assert first["id"] < second["id"]
+
+        last_message = {
+            "id": second["id"], "content": "Hi", "sender_id": 2, "created_at": second["created_at"]
+        }
+        assert database.get(f"messages/chat123/{second['id']}") == {
+            "content": "Hi", "sender_id": 2, "created_at": second["created_at"]
+        }
+        assert database.get("chats/chat123") == {
+            "participants": self.participants,
+            "last_message": last_message,
+            "updated_at": second["created_at"]
+        }
+        assert database.get("user_chats/1/chat123") == {
+            "last_message": last_message, "unread": 1, "updated_at": second["created_at"]
+        }
+        assert database.get("user_chats/2/chat123") == {
+            "last_message": last_message, "unread": 1, "updated_at": second["created_at"]
+        }
+
+    @pytest.mark.anyio
+    async def test_edit_message_does_not_read_back(self):
+        repository, database = build_memory_firebase_db({
+            "chats": {"chat123": {"participants": self.participants}},
+            "messages": {"chat123": {"msg123": {
+                "content": "Hello", "sender_id": 1, "created_at": "2024-01-01T00:00:00"
+            }}}
+        })
+
+        message = await repository.edit_message("chat123", "msg123", "Bye", 1)
+
+        # The participants, the message and the three copies of the preview
+        assert database.reads == 5
+        assert database.writes == 1
+        assert message == {
+            "id": "msg123",
+            "content": "Bye",
+            "sender_id": 1,
+            "created_at": "2024-01-01T00:00:00",
+            "edited_at": message["edited_at"]
+        }
+        assert database.get("messages/chat123/msg123") == {
+            "content": "Bye",
+            "sender_id": 1,
+            "created_at": "2024-01-01T00:00:00",
+            "edited_at": message["edited_at"]
+        }
+        assert database.get("chats/chat123/updated_at") == message["edited_at"]
+        assert database.get("user_chats/1/chat123/updated_at") == message["edited_at"]
+        assert database.get("user_chats/2/chat123/updated_at") == message["edited_at"]
+        assert database.get("chats/chat123/last_message") is None
+
+    @pytest.mark.anyio
+    async def test_edit_last_message_updates_preview(self):
+        preview = {"id": "msg123", "content": "Hello", "sender_id": 1}
+        repository, database = build_memory_firebase_db({
+            "chats": {"chat123": {"participants": self.participants, "last_message": preview}},
+            "user_chats": {"1": {"chat123": {"last_message": preview}}, "2": {"chat123": {"last_message": preview}}},
+            "messages": {"chat123": {"msg123": {
+                "content": "Hello", "sender_id": 1, "created_at": "2024-01-01T00:00:00"
+            }}}
+        })
+
+        await repository.edit_message("chat123", "msg123", "Bye", 1)
+
+        assert database.get("chats/chat123/last_message/content") == "Bye"
+        assert database.get("user_chats/1/chat123/last_message/content") == "Bye"
+        assert database.get("user_chats/2/chat123/last_message/content") == "Bye"
+
+    @pytest.mark.anyio
+    async def test_delete_last_message_updates_preview(self):
+        preview = {"id": "m2", "content": "Hello", "sender_id": 1}
+        repository, database = build_memory_firebase_db({
+            "chats": {"chat123": {"participants": self.participants, "last_message": preview}},
+            "user_chats": {"1": {"chat123": {"last_message": preview}}, "2": {"chat123": {"last_message": preview}}},
+            "messages": {"chat123": {
+                "m1": {"content": "x" * 300, "sender_id": 2, "created_at": "2024-01-01T00:00:00"},
+                "m2": {"content": "Hello", "sender_id": 1, "created_at": "2024-01-02T00:00:00"}
+            }}
+        })
+
+        await repository.delete_message("chat123", "m2", 1)
+
+        assert database.get("messages/chat123/m2") is None
+        assert database.get("chats/chat123/last_message") == {
+            "id": "m1", "content": "x" * 100, "sender_id": 2, "created_at": "2024-01-01T00:00:00"
+        }
+        assert database.get("user_chats/1/chat123/last_message") == database.get(
+            "chats/chat123/last_message")
+        assert database.get("user_chats/2/chat123/last_message") == database.get(
+            "chats/chat123/last_message")
+
+    @pytest.mark.anyio
+    async def test_delete_does_not_overwrite_a_newer_preview(self, monkeypatch):
+        repository, database = build_memory_firebase_db(
+            {"chats": {"chat123": {"participants": self.participants}}})
+        await repository.send_message("chat123", 1, "Z")
+        sent = await repository.send_message("chat123", 1, "A")
+
+        get = MemoryReference.get
+        newer: list[dict] = []
+
+        async def racing(self, etag: bool = False) -> Any:
+            if etag and not newer:
+                # B is sent while A is being deleted
+                newer.append(await repository.send_message("chat123", 2, "B"))
+
+            return await get(self, etag)
+
+        monkeypatch.setattr(MemoryReference, "get", racing)
+        await repository.delete_message("chat123", sent["id"], 1)
+
+        for path in ("chats/chat123", "user_chats/1/chat123", "user_chats/2/chat123"):
+            assert database.get(f"{path}/last_message/id") == newer[0]["id"]
+
+    @pytest.mark.anyio
+    async def test_edit_does_not_overwrite_a_newer_preview(self, monkeypatch):
+        repository, database = build_memory_firebase_db(
+            {"chats": {"chat123": {"participants": self.participants}}})
+        sent = await repository.send_message("chat123", 1, "A")
+
+        set_if_unchanged = MemoryReference.set_if_unchanged
+        newer: list[dict] = []
+
+        async def racing(self, expected_etag: str, value: Any) -> tuple[bool, Any, str]:
+            if not newer:
+                # B is sent between the read of the preview and its write
+                newer.append(await repository.send_message("chat123", 2, "B"))
+
+            return await set_if_unchanged(self, expected_etag, value)
+
+        monkeypatch.setattr(MemoryReference, "set_if_unchanged", racing)
+        await repository.edit_message("chat123", sent["id"], "A2", 1)
+
+        for path in ("chats/chat123", "user_chats/1/chat123", "user_chats/2/chat123"):
+            assert database.get(f"{path}/last_message") == {
+                "id": newer[0]["id"], "content": "B", "sender_id": 2, "created_at": newer[0]["created_at"]
+            }
+        assert database.get(f"messages/chat123/{sent['id']}/content") == "A2"
+
+    @pytest.mark.anyio
+    async def test_delete_only_message_clears_preview(self):
+        preview = {"id": "m1", "content": "Hello", "sender_id": 1}
+        repository, database = build_memory_firebase_db({
+            "chats": {"chat123": {"participants": self.participants, "last_message": preview}},
+            "user_chats": {"1": {"chat123": {"last_message": preview, "updated_at": "2024-01-01"}}},
+            "messages": {"chat123": {
+                "m1": {"content": "Hello", "sender_id": 1, "created_at": "2024-01-01T00:00:00"}
+            }}
+        })
+
+        await repository.delete_message("chat123", "m1", 1)
+
+        assert database.get("chats/chat123/last_message") is None
+        assert database.get("user_chats/1/chat123/last_message") is None
+
+    @pytest.mark.anyio
+    async def test_get_inbox_pages(self):
+        repository, database = build_memory_firebase_db({"user_chats": {"1": {
+            "chat1": {"participants": self.participants, "created_at": "2024-01-01", "updated_at": "2024-01-05"},
+            "chat2": {"participants": self.participants, "created_at": "2024-01-02", "updated_at": "2024-01-02"},
+            "chat3": {"participants": self.participants, "created_at": "2024-01-03", "updated_at": "2024-01-04"}
+        }}})
+
+        chats, before = await repository.get_inbox(1, None, 2)
+        assert [chat["id"] for chat in chats] == ["chat1", "chat3"]
+        assert before == ("2024-01-04", "chat3")
+
+        chats, before = await repository.get_inbox(1, before, 2)
+        assert [chat["id"] for chat in chats] == ["chat2"]
+        assert before is None
+
+        # One query per page, the participants come with the rows
+        assert database.reads == 2
+
+    @pytest.mark.anyio
+    async def test_get_inbox_pages_through_ties(self):
+        repository, _ = build_memory_firebase_db({"user_chats": {"1": {
+            f"c{n}": {"participants": self.participants, "created_at": "2024-01-01", "updated_at": "2024-01-02"}
+            for n in range(1, 6)
+        } | {
+            "c0": {"participants": self.participants, "created_at": "2024-01-01", "updated_at": "2024-01-01"}
+        }}})
+
+        seen: list[str] = []
+        before = None
+
+        while True:
+            chats, before = await repository.get_inbox(1, before, 2)
+            seen += [chat["id"] for chat in chats]
+
+            if before is None:
+                break
+
+        assert seen == ["c5", "c4", "c3", "c2", "c1", "c0"]
+
+    @pytest.mark.anyio
+    async def test_get_inbox_of_chat_not_backfilled(self):
+        repository, _ = build_memory_firebase_db({"chats": {
+            "chat1": {"participants": self.participants, "created_at": "2024-01-01T00:00:00"}
+        }})
+
+        sent = await repository.send_message("chat1", 1, "Hello")
+        page = await ChatService(repository).get_chats(2)
+
+        assert [chat.id for chat in page.chats] == ["chat1"]
+        assert page.chats[0].user1.username == "test1"
+        assert page.chats[0].created_at == "2024-01-01T00:00:00"
+        assert page.chats[0].updated_at == sent["created_at"]
+        assert page.chats[0].last_message.id == sent["id"]  # type: ignore
+        assert page.chats[0].unread == 1
+
+    @pytest.mark.anyio
+    async def test_get_inbox_of_other_user_is_empty(self):
+        repository, _ = build_memory_firebase_db({"user_chats": {"1": {
+            "chat1": {"participants": self.participants, "created_at": "2024-01-01", "updated_at": "2024-01-01"}
+        }}})
+
+        assert await repository.get_inbox(3) == ([], None)
+
+    @pytest.mark.anyio
+    async def test_delete_message(self):
+        repository, database = build_memory_firebase_db({
+            "chats": {"chat123": {"participants": self.participants}},
+            "messages": {"chat123": {"msg123": {"sender_id": 1}, "msg124": {"sender_id": 2}}}
+        })
+
+        await repository.delete_message("chat123", "msg123", 1)
+
+        assert database.get("messages/chat123") == {"msg124": {"sender_id": 2}}
+        assert database.get("chats/chat123/updated_at") is not None
+
+    @pytest.mark.anyio
+    async def test_edit_message_of_other_user(self):
+        repository, database = build_memory_firebase_db({
+            "chats": {"chat123": {"participants": self.participants}},
+            "messages": {"chat123": {"msg123": {
+                "content": "Hello", "sender_id": 2, "created_at": "2024-01-01T00:00:00"
+            }}}
+        })
+
+        with pytest.raises(AuthenticationError):
+            await repository.edit_message("chat123", "msg123", "Bye", 1)
+
+        assert database.writes == 0
+
+    @pytest.mark.anyio
+    async def test_send_message_not_participant(self):
+        repository, database = build_memory_firebase_db(
+            {"chats": {"chat123": {"participants": self.participants}}})
+
+        with pytest.raises(AuthenticationError):
+            await repository.send_message("chat123", 3, "Hello")
+
+        assert database.writes == 0
+
+    @pytest.mark.anyio
+    async def test_send_message_chat_not_found(self):
+        repository, database = build_memory_firebase_db({})
+
+        with pytest.raises(NotFoundError):
+            await repository.send_message("chat123", 1, "Hello")
+
+        assert database.writes == 0
+
+    @pytest.mark.anyio
+    async def test_create_chat_existing_pair(self):
+        repository, database = build_memory_firebase_db({
+            "chat_pairs": {"1_2": "chat123"},
+            "chats": {"chat123": {"participants": self.participants}}
+        })
+
+        chat_id = await repository.create_chat(
+            User(id=2, username="renamed"), User(id=1, username="test1"))
+
+        assert chat_id == "chat123"
+        assert database.reads == 2
+        assert database.writes == 0
+
+    @pytest.mark.anyio
+    async def test_create_chat_replaces_a_dead_pair(self):
+        # The pair was claimed, but the chat never written
+        repository, database = build_memory_firebase_db(
+            {"chat_pairs": {"1_2": "chat123"}})
+
+        chat_id = await repository.create_chat(
+            User(id=1, username="test1"), User(id=2, username="test2"))
+
+        assert chat_id != "chat123"
+        assert database.get("chat_pairs/1_2") == chat_id
+        assert list(database.get("chats")) == [chat_id]
+        assert list(database.get("user_chats/1")) == [chat_id]
+
+    @pytest.mark.anyio
+    async def test_create_chat_writes_pair_index(self):
+        repository, database = build_memory_firebase_db({})
+
+        chat_id = await repository.create_chat(
+            User(id=2, username="test2"), User(id=1, username="test1"))
+
+        chat = database.get(f"chats/{chat_id}")
+        assert database.get("chat_pairs/1_2") == chat_id
+        assert chat["participants"] == self.participants
+        assert database.get(f"user_chats/1/{chat_id}") == user_chat_entry(chat)
+        assert database.get(f"user_chats/2/{chat_id}") == user_chat_entry(chat)
+        assert repository.participants.get(chat_id) == (1, 2)
+
+    @pytest.mark.anyio
+    async def test_concurrent_create_chat_makes_one_chat(self):
+        database = MemoryDatabase(latency=0.01, jitter=0.01, seed=1)
+        repository = AsyncFirebaseDB(database.reference(), ParticipantsCache())
+
+        chat_ids = await asyncio.gather(*(
+            repository.create_chat(User(id=1, username="test1"), User(id=2, username="test2"))
+            for _ in range(5)
+        ))
+
+        assert len(set(chat_ids)) == 1
+        assert list(database.get("chats")) == [chat_ids[0]]
+        assert list(database.get("user_chats/1")) == [chat_ids[0]]
+        assert list(database.get("user_chats/2")) == [chat_ids[0]]
+
+    @pytest.mark.anyio
+    async def test_failed_create_chat_frees_the_pair(self):
+        repository, database = build_memory_firebase_db({})
+        update = database.update
+
+        def fail(path: str, values: dict[str, Any]) -> None:
+            raise ServiceUnavailableError()
+
+        database.update = fail  # type: ignore
+
+        with pytest.raises(ServiceUnavailableError):
+            await repository.create_chat(User(id=1, username="test1"), User(id=2, username="test2"))
+
+        assert database.get("chat_pairs") is None
+
+        database.update = update  # type: ignore
+        chat_id = await repository.create_chat(
+            User(id=1, username="test1"), User(id=2, username="test2"))
+
+        assert database.get("chat_pairs/1_2") == chat_id
+        assert database.get(f"chats/{chat_id}") is not None
+
+    @pytest.mark.anyio
+    async def test_get_messages_pages(self):
+        repository, _ = build_memory_firebase_db({
+            "chats": {"chat123": {"participants": self.participants}},
+            "messages": {"chat123": {
+                f"m{n}": {"content": f"message {n}", "sender_id": 1, "created_at": "2024-01-01T00:00:00"}
+                for n in range(1, 6)
+            }}
+        })
+
+        messages, before = await repository.get_messages("chat123", 1, None, 2)
+        assert [message["id"] for message in messages] == ["m4", "m5"]
+        assert before == "m4"
+
+        messages, before = await repository.get_messages("chat123", 1, before, 2)
+        assert [message["id"] for message in messages] == ["m2", "m3"]
+        assert before == "m2"
+
+        messages, before = await repository.get_messages("chat123", 1, before, 2)
+        assert [message["id"] for message in messages] == ["m1"]
+        assert before is None
+
+    @pytest.mark.anyio
+    async def test_get_messages_not_participant(self):
+        repository, _ = build_memory_firebase_db(
+            {"chats": {"chat123": {"participants": self.participants}}})
+
+        with pytest.raises(AuthenticationError):
+            await repository.get_messages("chat123", 3)
+
+
+class FakeCredential:
+    def __init__(self):
+        self.refreshes = 0
+
+    def get_access_token(self) -> Mock:
+        self.refreshes += 1
+        return Mock(access_token=f"token-{self.refreshes}", expiry=datetime(2999, 1, 1))
+
+
+class MockRTDBTransport(httpx.MockTransport):
+    def __init__(self, values: dict[str, Any]):
+        super().__init__(self.respond)
+        self.values = values
+        self.requests: list[httpx.Request] = []
+        self.status_codes: list[int] = []
+
+    def respond(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        status_code = self.status_codes.pop(0) if self.status_codes else 200
+        path = request.url.path.removesuffix(".json").strip("/")
+
+        if status_code != 200:
+            return httpx.Response(status_code)
+
+        value = self.values.get(path)
+        etag = hashlib.md5(json.dumps(value).encode()).hexdigest()
+
+        if request.method == "PUT" and "if-match" in request.headers:
+            if request.headers["if-match"] != etag:
+                return httpx.Response(412, json=value, headers={"ETag": etag})
+
+            value = self.values[path] = json.loads(request.content)
+            return httpx.Response(200, json=value, headers={"ETag": hashlib.md5(request.content).hexdigest()})
+
+        if request.method != "GET":
+            return httpx.Response(204)
+
+        params = request.url.params
+
+        if "orderBy" in params:
+            order_by = json.loads(params["orderBy"])
+            query = FakeKeyQuery(value or {}, None if order_by == "$key" else order_by)
+            if "endAt" in params:
+                query.end_at(json.loads(params["endAt"]))
+            value = query.limit_to_last(int(params["limitToLast"])).get()
+
+        return httpx.Response(200, json=value, headers={"ETag": etag})
+
+
+def build_async_firebase_db(values: dict[str, Any]) -> tuple[AsyncFirebaseDB, MockRTDBTransport, FakeCredential]:
+    transport = MockRTDBTransport(values)
+    credential = FakeCredential()
+    rtdb = RTDBClient(
+        httpx.AsyncClient(transport=transport),
+        "https://db.firebaseio.com",
+        AccessTokenCache(lambda: credential)
+    )
+
+    return AsyncFirebaseDB(AsyncReference(rtdb), ParticipantsCache()), transport, credential
+
+
+class TestAsyncFirebaseDB:
+    participants = TestFirebaseDB.participants
+
+    @pytest.mark.anyio
+    async def test_send_message_is_one_patch(self):
+        repository, transport, credential = build_async_firebase_db(
+            {"chats/chat123/participants": self.participants})
+
+        first, second = await asyncio.gather(
+            repository.send_message("chat123", 1, "Hello"),
+            repository.send_message("chat123", 2, "Hi")
+        )
+
+        assert credential.refreshes == 1
+        assert [request.method for request in transport.requests].count("PATCH") == 2
+        assert all(request.headers["Authorization"] == "Bearer token-1"
+                   for request in transport.requests)
+
+        patch = transport.requests[-1]
+        assert patch.url.path == "/.json"
+        assert patch.url.params["print"] == "silent"
+        body = json.loads(patch.content)
+        assert body[f"messages/chat123/{second['id']}"]["content"] == "Hi"
+        assert body["user_chats/1/chat123/updated_at"] == second["created_at"]
+
+        await repository.send_message("chat123", 1, "Again")
+        assert transport.requests[-2].method == "PATCH"
+
+    @pytest.mark.anyio
+    async def test_get_inbox_pages(self):
+        repository, transport, _ = build_async_firebase_db({"user_chats/1": {
+            "chat1": {"participants": self.participants, "created_at": "2024-01-01", "updated_at": "2024-01-05"},
+            "chat2": {"participants": self.participants, "created_at": "2024-01-02", "updated_at": "2024-01-02"},
+            "chat3": {"participants": self.participants, "created_at": "2024-01-03", "updated_at": "2024-01-04"}
+        }})
+
+        chats, before = await repository.get_inbox(1, ("2024-01-05", "chat1"), 1)
+
+        assert [chat["id"] for chat in chats] == ["chat3"]
+        assert before == ("2024-01-04", "chat3")
+        assert dict(transport.requests[0].url.params) == {
+            "orderBy": '"updated_at"', "endAt": '"2024-01-05"', "limitToLast": "3"
+        }
+
+    @pytest.mark.anyio
+    async def test_get_messages_not_participant(self):
+        repository, transport, _ = build_async_firebase_db(
+            {"chats/chat123/participants": self.participants})
+
+        with pytest.raises(AuthenticationError):
+            await repository.get_messages("chat123", 3)
+
+        assert len(transport.requests) == 1
+
+    @pytest.mark.anyio
+    async def test_rejected_token_is_refreshed(self):
+        repository, transport, credential = build_async_firebase_db({
+            "chat_pairs/1_2": "chat123",
+            "chats/chat123/participants": self.participants
+        })
+        transport.status_codes = [401]
+
+        chat_id = await repository.create_chat(
+            User(id=1, username="test1"), User(id=2, username="test2"))
+
+        assert chat_id == "chat123"
+        assert credential.refreshes == 2
+        assert transport.requests[1].headers["Authorization"] == "Bearer token-2"
+        assert transport.requests[1].headers["X-Firebase-ETag"] == "true"
+
+    @pytest.mark.anyio
+    async def test_create_chat_claims_the_pair_if_unchanged(self):
+        repository, transport, _ = build_async_firebase_db({})
+
+        chat_id = await repository.create_chat(
+            User(id=1, username="test1"), User(id=2, username="test2"))
+
+        # The chat is written before the pair points to it
+        assert transport.requests[1].method == "PUT"
+        assert transport.requests[1].url.path == f"/chats/{chat_id}.json"
+        claim = transport.requests[2]
+        assert claim.method == "PUT"
+        assert claim.url.path == "/chat_pairs/1_2.json"
+        # The ETag read for the missing pair
+        assert claim.headers["if-match"] == hashlib.md5(b"null").hexdigest()
+        assert transport.values["chat_pairs/1_2"] == chat_id
+        assert transport.requests[3].method == "PATCH"
+
+    @pytest.mark.anyio
+    async def test_create_chat_lost_claim_returns_the_winner(self):
+        repository, transport, _ = build_async_firebase_db(
+            {"chats/chat123/participants": self.participants})
+
+        def respond(request: httpx.Request) -> httpx.Response:
+            if request.url.path == "/chat_pairs/1_2.json" and request.method == "PUT":
+                # Another request claimed the pair since it was read
+                transport.values["chat_pairs/1_2"] = "chat123"
+
+            return MockRTDBTransport.respond(transport, request)
+
+        transport.handler = respond  # type: ignore
+
+        chat_id = await repository.create_chat(
+            User(id=1, username="test1"), User(id=2, username="test2"))
+
+        assert chat_id == "chat123"
+        # The chat written before the claim is removed again
+        assert [request.method for request in transport.requests] == [
+            "GET", "PUT", "PUT", "GET", "PUT"]
+        assert transport.requests[-1].url.path == transport.requests[1].url.path
+        assert transport.requests[-1].content == b"null"
+
+    @pytest.mark.anyio
+    async def test_errors_are_service_unavailable(self):
+        repository, transport, _ = build_async_firebase_db({})
+        transport.status_codes = [500]
+
+        with pytest.raises(ServiceUnavailableError):
+            await repository.get_inbox(1)
+
+        def fail(request: httpx.Request) -> httpx.Response:
+            raise httpx.ConnectTimeout("timeout")
+
+        transport.handler = fail  # type: ignore
+
+        with pytest.raises(ServiceUnavailableError):
+            await repository.get_inbox(1)
+
+
+class TestMemoryDatabase:
+    participants = TestFirebaseDB.participants
+
+    @pytest.mark.anyio
+    async def test_queries(self):
+        database = MemoryDatabase({"users": {
+            "b": {"age": 30}, "a": {"age": 20}, "c": {"age": "x"}, "10": {}, "9": {"age": 30}
+        }})
+        users = database.reference("users")
+
+        assert list((await users.order_by_key().get()).keys()) == ["9", "a", "b", "c"]
+        assert list(await users.order_by_child("age").get()) == ["a", "9", "b", "c"]
+        assert list(await users.order_by_child("age").equal_to(30).get()) == ["9", "b"]
+        assert list(await users.order_by_child("age").end_at(30).limit_to_last(2).get()) == ["9", "b"]
+        assert list(await users.order_by_key().start_at("a").limit_to_first(1).get()) == ["a"]
+        assert await users.order_by_key().start_at("z").get() is None
+
+        with pytest.raises(ValueError):
+            users.limit_to_first(1).limit_to_last(1)
+
+        with pytest.raises(ValueError):
+            await users.limit_to_first(1).get()
+
+    @pytest.mark.anyio
+    async def test_multi_path_update(self):
+        database = MemoryDatabase({"chats": {"c1": {"title": "x", "updated_at": "1"}}})
+        root = database.reference()
+
+        await root.update({"chats/c1/title": None, "chats/c2": {"title": "y", "empty": {}}})
+
+        assert database.data == {"chats": {"c1": {"updated_at": "1"}, "c2": {"title": "y"}}}
+
+        await root.update({"chats/c1/updated_at": None, "chats/c2/title": None})
+        assert database.data == {}
+
+        with pytest.raises(ValueError):
+            await root.update({"chats/c1": {}, "chats/c1/title": "x"})
+
+        pushed = await root.child("chats").push({"title": "z"})
+        assert await pushed.child("title").get() == "z"
+        assert database.reads == 1 and database.writes == 3
+
+    @pytest.mark.anyio
+    async def test_injected_latency_and_failures(self):
+        database = MemoryDatabase(latency=0.01, failure_rate=0.5, seed=1)
+        reference = database.reference("x")
+
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(reference.get() for _ in range(20)), return_exceptions=True)
+
+        assert time.perf_counter() - start < 0.1
+        failures = sum(isinstance(result, ServiceUnavailableError)
+                       for result in results)
+        assert 0 < failures < 20
+
+    @pytest.mark.anyio
+    async def test_send_messages_is_one_write(self):
+        database = MemoryDatabase()
+        repository = AsyncFirebaseDB(database.reference(), ParticipantsCache())
+        chat_id = await repository.create_chat(
+            User(id=1, username="test1"), User(id=2, username="test2"))
+        writes = database.writes
+
+        sent = await repository.send_messages(chat_id, 1, ["one", "two", "three"])
+
+        assert database.writes == writes + 1
+        assert [message["id"] for message in sent] == sorted(message["id"] for message in sent)
+        messages, _ = await repository.get_messages(chat_id, 2)
+        assert [message["content"] for message in messages] == ["one", "two", "three"]
+        chats, _ = await repository.get_inbox(2)
+        assert chats[0]["last_message"]["id"] == sent[-1]["id"]
+        assert chats[0]["updated_at"] == sent[0]["created_at"]
+
+        assert await repository.send_messages(chat_id, 1, []) == []
+        assert database.writes == writes + 1
+
+    @pytest.mark.anyio
+    async def test_chat_repository(self):
+        repository = AsyncFirebaseDB(MemoryDatabase().reference(), ParticipantsCache())
+
+        chat_id = await repository.create_chat(
+            User(id=2, username="test2"), User(id=1, username="test1"))
+        assert await repository.create_chat(
+            User(id=1, username="test1"), User(id=2, username="test2")) == chat_id
+
+        sent = [await repository.send_message(chat_id, 1 + n % 2, f"message {n}") for n in range(5)]
+        await repository.edit_message(chat_id, sent[-1]["id"], "edited", 1)
+        await repository.delete_message(chat_id, sent[-1]["id"], 1)
+
+        messages, before = await repository.get_messages(chat_id, 2, None, 3)
+        assert [message["content"] for message in messages] == [
+            "message 1", "message 2", "message 3"]
+        assert before == sent[1]["id"]
+
+        chats, _ = await repository.get_inbox(2)
+        assert chats[0]["id"] == chat_id
+        assert chats[0]["participants"] == self.participants
+        assert chats[0]["last_message"]["content"] == "message 3"
+
+
+    @pytest.mark.anyio
+    async def test_server_values(self):
+        database = MemoryDatabase({"counters": {"a": 2, "b": "x"}})
+        reference = database.reference()
+
+        await reference.update({
+            "counters/a": {".sv": {"increment": 3}},
+            "counters/b": {".sv": {"increment": 1}},
+            "counters/c": {".sv": {"increment": 1}},
+            "meta": {"written_at": {".sv": "timestamp"}}
+        })
+
+        assert await reference.child("counters").get() == {"a": 5, "b": 1, "c": 1}
+        assert isinstance(await reference.child("meta/written_at").get(), int)
+
+        with pytest.raises(ValueError):
+            await reference.update({"counters/a": {".sv": "unknown"}})
+
+    @pytest.mark.anyio
+    async def test_unread_counters(self):
+        database = MemoryDatabase()
+        repository = AsyncFirebaseDB(database.reference(), ParticipantsCache())
+        chat_id = await repository.create_chat(
+            User(id=1, username="test1"), User(id=2, username="test2"))
+
+        await repository.send_message(chat_id, 1, "one")
+        sent = await repository.send_messages(chat_id, 1, ["two", "three"])
+        await repository.send_message(chat_id, 2, "four")
+
+        (mine,), _ = await repository.get_inbox(1)
+        (theirs,), _ = await repository.get_inbox(2)
+        assert mine["unread"] == 1
+        assert theirs["unread"] == 3
+
+        writes = database.writes
+        last = await repository.send_message(chat_id, 1, "five")
+
+        assert await repository.mark_read(chat_id, 2) == last["id"]
+        assert database.writes == writes + 2
+
+        (theirs,), _ = await repository.get_inbox(2)
+        assert theirs.get("unread") is None
+        assert theirs["last_read_id"] == last["id"]
+        assert sent[-1]["id"] < theirs["last_read_id"]
+
+        with pytest.raises(AuthenticationError):
+            await repository.mark_read(chat_id, 3)
+
+        # Nothing left to clear, nothing is written
+        writes = database.writes
+        assert await repository.mark_read(chat_id, 2) == last["id"]
+        assert database.writes == writes
+
+    @pytest.mark.anyio
+    async def test_mark_read_keeps_messages_sent_meanwhile(self, monkeypatch):
+        database = MemoryDatabase()
+        repository = AsyncFirebaseDB(database.reference(), ParticipantsCache())
+        chat_id = await repository.create_chat(
+            User(id=1, username="test1"), User(id=2, username="test2"))
+        await repository.send_message(chat_id, 1, "one")
+
+        set_if_unchanged = MemoryReference.set_if_unchanged
+        sent: list[dict] = []
+
+        async def racing(self, expected_etag: str, value: Any) -> tuple[bool, Any, str]:
+            if not sent:
+                # A message arrives between the read and the write
+                sent.append(await repository.send_message(chat_id, 1, "two"))
+
+            return await set_if_unchanged(self, expected_etag, value)
+
+        monkeypatch.setattr(MemoryReference, "set_if_unchanged", racing)
+
+        assert await repository.mark_read(chat_id, 2) == sent[0]["id"]
+
+        (theirs,), _ = await repository.get_inbox(2)
+        assert theirs.get("unread") is None
+        assert theirs["last_read_id"] == sent[0]["id"]
+
+
+class TestUpdatedAtBuffer:
+    @pytest.mark.anyio
+    async def test_keeps_the_latest_bump_until_written(self):
+        database = MemoryDatabase()
+        buffer = UpdatedAtBuffer(database.reference(), interval=60)
+
+        buffer.touch("c1", (1, 2), "2024-01-01T00:00:01")
+        buffer.touch("c1", (1, 2), "2024-01-01T00:00:03")
+        buffer.touch("c1", (1, 2), "2024-01-01T00:00:02")
+        buffer.touch("c2", (1, 3), "2024-01-01T00:00:02")
+
+        assert buffer.pending(1) == {
+            "c1": "2024-01-01T00:00:03", "c2": "2024-01-01T00:00:02"}
+
+        database.failure_rate = 1
+        await buffer.flush()
+
+        assert len(buffer) == 2 and database.writes == 0
+
+        database.failure_rate = 0
+        await buffer.stop()
+
+        assert len(buffer) == 0 and buffer.pending(1) == {}
+        assert database.writes == 1
+        assert await database.reference("chats/c1/updated_at").get() == "2024-01-01T00:00:03"
+        assert await database.reference("user_chats/2/c1/updated_at").get() == "2024-01-01T00:00:03"
+        assert await database.reference("user_chats/3/c2/updated_at").get() == "2024-01-01T00:00:02"
+
+    @pytest.mark.anyio
+    async def test_flushes_periodically(self):
+        database = MemoryDatabase()
+        buffer = UpdatedAtBuffer(database.reference(), interval=0.01)
+        await buffer.start()
+
+        buffer.touch("c1", (1, 2), "2024-01-01T00:00:01")
+        await eventually(lambda: database.writes == 1)
+        await buffer.stop()
+
+        assert database.writes == 1
+
+    @pytest.mark.anyio
+    async def test_stop_during_a_slow_write_keeps_the_bump(self):
+        database = MemoryDatabase(latency=0.05)
+        buffer = UpdatedAtBuffer(database.reference(), interval=0.01)
+        await buffer.start()
+
+        buffer.touch("c1", (1, 2), "2024-01-01T00:00:01")
+        # The loop is writing the bump
+        await eventually(lambda: len(buffer) == 0)
+        await buffer.stop()
+
+        assert len(buffer) == 0
+        assert database.get("chats/c1/updated_at") == "2024-01-01T00:00:01"
+
+    @pytest.mark.anyio
+    async def test_cancelled_flush_keeps_the_bump(self):
+        database = MemoryDatabase(latency=0.05)
+        buffer = UpdatedAtBuffer(database.reference(), interval=60)
+
+        buffer.touch("c1", (1, 2), "2024-01-01T00:00:01")
+        flush = asyncio.create_task(buffer.flush())
+        await eventually(lambda: len(buffer) == 0)
+        flush.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await flush
+
+        assert buffer.pending(1) == {"c1": "2024-01-01T00:00:01"}
+
+        await buffer.stop()
+        assert database.get("chats/c1/updated_at") == "2024-01-01T00:00:01"
+
+    @pytest.mark.anyio
+    async def test_keeps_flushing_after_unexpected_errors(self):
+        database = MemoryDatabase()
+        buffer = UpdatedAtBuffer(database.reference(), interval=0.01)
+        update = database.update
+        failures = [RuntimeError("boom")]
+
+        def fail_once(path: str, values: dict[str, Any]) -> None:
+            if failures:
+                raise failures.pop()
+
+            update(path, values)
+
+        database.update = fail_once  # type: ignore
+        await buffer.start()
+
+        buffer.touch("c1", (1, 2), "2024-01-01T00:00:01")
+        await eventually(lambda: database.writes == 1)
+        await buffer.stop()
+
+        assert not failures
+        assert database.get("chats/c1/updated_at") == "2024-01-01T00:00:01"
+
+    @pytest.mark.anyio
+    async def test_inbox_sees_pending_bumps(self):
+        database = MemoryDatabase()
+        repository = AsyncFirebaseDB(
+            database.reference(), ParticipantsCache(), UpdatedAtBuffer(database.reference(), interval=60))
+        chats = [
+            await repository.create_chat(User(id=1, username="test1"), User(id=n, username=f"test{n}"))
+            for n in (2, 3, 4)
+        ]
+
+        # The oldest chat becomes the most recent one, before any flush
+        await repository.send_message(chats[0], 1, "hello")
+        sent = await repository.send_message(chats[0], 2, "hi")
+        writes = database.writes
+
+        first, before = await repository.get_inbox(1, None, 1)
+        rest, _ = await repository.get_inbox(1, before, 10)
+
+        assert [chat["id"] for chat in first] == [chats[0]]
+        assert first[0]["updated_at"] == sent["created_at"]
+        assert [chat["id"] for chat in rest] == [chats[2], chats[1]]
+
+        await repository.aclose()
+
+        assert database.writes == writes + 1
+        chats_after, _ = await repository.get_inbox(1)
+        assert [chat["id"] for chat in chats_after] == [chats[0], chats[2], chats[1]]
+
+
+class TestBackfill:
+    def test_build_chat_pairs(self):
+        chats = [
+            ("chat1", {"participants": {"user1": {"id": 1}, "user2": {"id": 2}}}),
+            ("chat2", {"participants": {"user1": {"id": 1}, "user2": {"id": 2}}}),
+            ("chat3", {"participants": {"user1": {"id": 1}, "user2": {"id": 3}}}),
+            ("chat4", {"participants": {"user1": {"id": 2}, "user2": {"id": 3}}}),
+            ("chat5", {})
+        ]
+
+        updates = build_chat_pairs(iter(chats), {"2_3": "chat0"})
+
+        assert updates == {
+            "chat_pairs/1_2": "chat1",
+            "chat_pairs/1_3": "chat3"
+        }
+
+    def test_build_user_chats(self):
+        chat = {
+            "participants": {"user1": {"id": 1}, "user2": {"id": 2}},
+            "created_at": "2024-01-01",
+            "last_message": {"id": "m1", "content": "Hello", "sender_id": 1, "created_at": "2024-01-02"},
+            "updated_at": "2024-01-02"
+        }
+
+        updates = build_user_chats(iter([("chat1", chat), ("chat2", {})]))
+
+        assert updates == {
+            f"user_chats/{user_id}/chat1/{field}": value
+            for user_id in (1, 2) for field, value in user_chat_entry(chat).items()
+        }
+        assert updates["user_chats/1/chat1/updated_at"] == "2024-01-02"
+
+    @pytest.mark.anyio
+    async def test_build_user_chats_keeps_read_state(self):
+        chat = {
+            "participants": {"user1": {"id": 1}, "user2": {"id": 2}},
+            "created_at": "2024-01-01"
+        }
+        database = MemoryDatabase({"user_chats": {"2": {"chat1": {
+            "updated_at": "2024-01-02", "unread": 3, "last_read_id": "m1"
+        }}}})
+
+        await database.reference().update(build_user_chats(iter([("chat1", chat)])))
+
+        assert database.get("user_chats/2/chat1") == {
+            **user_chat_entry(chat), "unread": 3, "last_read_id": "m1"
+        }
+
+    def test_iter_chats_pages(self):
+        root = Mock()
+        query = root.child.return_value.order_by_key.return_value
+        query.limit_to_first.return_value.get.return_value = {
+            "a": {}, "b": {}}
+        query.start_at.return_value.limit_to_first.return_value.get.side_effect = [
+            {"a": {}, "b": {}}, {"b": {}, "c": {}}, {"c": {}}
+        ]
+
+        assert [key for key, _ in iter_chats(root, page_size=1)] == [
+            "a", "b", "c"]
+
+    def test_write_updates_in_chunks(self):
+        root = Mock()
+
+        write_updates(root, {f"chat_pairs/{n}": n for n in range(5)}, 2)
+
+        assert root.update.call_count == 3
+
+
+class TestPushId:
+    def test_ids_sort_in_generation_order(self):
+        ids = [generate_push_id() for _ in range(1000)]
+
+        assert all(len(push_id) == 20 for push_id in ids)
+        assert ids == sorted(ids)
+        assert len(set(ids)) == len(ids)
+
+    def test_increment_carries_over(self):
+        generator = PushIdGenerator()
+        generator._last_random = [0] * 10 + [5, 63]
+        generator._increment_random()
+
+        assert generator._last_random == [0] * 10 + [6, 0]
+
+
+class TestJWTService:
+    def test_verify_is_cached(self):
+        service = JWTService()
+        token = service.sign({  # type: ignore
+            "userId": 1, "username": "test", 'email': "test@gmail.com", "type": "user"
+        })
+
+        with patch("service.jwt_service.jwt.decode", wraps=jwt.decode) as decode:
+            first = service.verify(token)
+            second = service.verify(token)
+
+        assert first == second
+        assert first is not second
+        assert decode.call_count == 1
+
+    def test_invalid_token(self):
+        with pytest.raises(AuthenticationError):
+            JWTService().verify("not-a-token")
+
+    def test_cache_entries_expire_with_token(self, monkeypatch):
+        now = [time.time()]
+        monkeypatch.setattr("service.jwt_service.time.time", lambda: now[0])
+
+        service = JWTService()
+        token = jwt.encode(
+            {"userId": 1, "username": "test", "type": "user",
+                "exp": int(now[0]) + 60},
+            service.secret, algorithm='HS256'
+        )
+        key = hashlib.sha256(token.encode()).digest()
+
+        service.verify(token)
+        assert key in service.verified
+
+        now[0] += 120
+        assert key not in service.verified
+
+    def test_cache_is_bounded(self):
+        service = JWTService(cache_size=2)
+
+        for user_id in range(3):
+            service.verify(service.sign({  # type: ignore
+                "userId": user_id, "username": "test", 'email': "test@gmail.com", "type": "user"
+            }))
+
+        assert len(service.verified) == 2
+
+
+class TestCursor:
+    def test_round_trip(self):
+        cursor = encode_cursor(["2024-01-01T00:00:00", "chat123"])
+
+        assert "=" not in cursor
+        assert decode_cursor(cursor, list) == ["2024-01-01T00:00:00", "chat123"]
+
+    def test_invalid_cursor(self):
+        with pytest.raises(ValidationError):
+            decode_cursor("not a cursor!")
+
+        with pytest.raises(ValidationError):
+            decode_cursor(encode_cursor(1), str)
+
+
+class TestUsersService:
+    @pytest.mark.anyio
+    async def test_get_user_forwards_token(self):
+        with mock_users_service(json={"id": 1, "username": "test"}) as transport:
+            response = await build_users_service().get_user("test", "test-token")
+
+            assert response.status_code == 200
+            assert str(transport.requests[0].url) == "http://users-service/users/test"
+            assert transport.requests[0].headers["Authorization"] == "Bearer test-token"
+
+    @pytest.mark.anyio
+    async def test_get_user_timeout(self):
+        def timeout(request: httpx.Request) -> httpx.Response:
+            raise httpx.ConnectTimeout("timed out", request=request)
+
+        service = UsersService(
+            httpx.AsyncClient(transport=httpx.MockTransport(timeout)),
+            "http://users-service"
+        )
+
+        with pytest.raises(ServiceUnavailableError):
+            await service.get_user("test", "test-token")
+
+    @pytest.mark.anyio
+    async def test_client_is_shared(self, monkeypatch):
+        monkeypatch.setenv("USERS_SERVICE_CONNECT_TIMEOUT", "1.5")
+        monkeypatch.setenv("USERS_SERVICE_READ_TIMEOUT", "3")
+
+        service = UsersService(base_url="http://users-service")
+        client = service.client
+
+        assert service.client is client
+        assert client.timeout.connect == 1.5
+        assert client.timeout.read == 3.0
+
+        await service.aclose()
+
+    @pytest.mark.anyio
+    async def test_check_blocked_is_cached(self):
+        service = build_users_service()
+
+        with mock_users_service(json={"id": 1, "username": "test"}) as transport:
+            await service.check_blocked("test", "test-token")
+            await service.check_blocked("test", "test-token")
+
+            assert len(transport.requests) == 1
+            assert service.cache.stats()["hits"] == 1
+            assert service.cache.stats()["misses"] == 1
+
+    @pytest.mark.anyio
+    async def test_check_blocked_negative_cache(self):
+        service = build_users_service()
+
+        with mock_users_service(json={"title": "User blocked", "detail": "Blocked error"}, status_code=403) as transport:
+            for _ in range(2):
+                with pytest.raises(BlockedError):
+                    await service.check_blocked("test", "test-token")
+
+            assert len(transport.requests) == 1
+
+    @pytest.mark.anyio
+    async def test_check_blocked_errors_are_not_cached(self):
+        service = build_users_service()
+
+        with mock_users_service(json={"title": "ServiceUnavailableError", "detail": "Service unavailable"}, status_code=500) as transport:
+            for _ in range(2):
+                with pytest.raises(ServiceUnavailableError):
+                    await service.check_blocked("test", "test-token")
+
+            assert len(transport.requests) == 2
+
+
+    @pytest.mark.anyio
+    async def test_concurrent_lookups_are_coalesced(self):
+        requests: list[httpx.Request] = []
+        release = asyncio.Event()
+
+        async def slow(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            await release.wait()
+            return httpx.Response(403, json={"title": "User blocked", "detail": "Blocked error"})
+
+        service = UsersService(
+            httpx.AsyncClient(transport=httpx.MockTransport(slow)),
+            "http://users-service"
+        )
+
+        lookups = [
+            asyncio.ensure_future(service.check_blocked("test", "test-token"))
+            for _ in range(5)
+        ]
+        await asyncio.sleep(0.01)
+        release.set()
+
+        results = await asyncio.gather(*lookups, return_exceptions=True)
+
+        assert len(requests) == 1
+        assert all(isinstance(result, BlockedError) for result in results)
+
+
+class MockExpoTransport(httpx.MockTransport):
+    def __init__(self, statuses: list[int] | None = None):
+        super().__init__(self.respond)
+        self.statuses = statuses or []
+        self.batches: list[list] = []
+
+    def respond(self, request: httpx.Request) -> httpx.Response:
+        self.batches.append(json.loads(request.content))
+        status_code = self.statuses.pop(0) if self.statuses else 200
+        return httpx.Response(status_code, json={"data": []})
+
+
+def build_push_dispatcher(transport: httpx.MockTransport, **kwargs) -> PushDispatcher:
+    return PushDispatcher(
+        httpx.AsyncClient(transport=transport),
+        flush_interval=kwargs.pop("flush_interval", 0.01),
+        retry_backoff=0,
+        **kwargs
+    )
+
+
+class TestPushDispatcher:
+    @pytest.mark.anyio
+    async def test_batches_messages(self):
+        transport = MockExpoTransport()
+        dispatcher = build_push_dispatcher(transport)
+        await dispatcher.start()
+
+        for n in range(150):
+            dispatcher.enqueue({"to": f"token{n}"})
+
+        await dispatcher.stop()
+
+        assert [len(batch) for batch in transport.batches] == [100, 50]
+        assert transport.batches[1][-1] == {"to": "token149"}
+
+    @pytest.mark.anyio
+    async def test_flushes_after_interval(self):
+        transport = MockExpoTransport()
+        dispatcher = build_push_dispatcher(transport)
+        await dispatcher.start()
+
+        dispatcher.enqueue({"to": "token"})
+        await asyncio.sleep(0.05)
+
+        assert transport.batches == [[{"to": "token"}]]
+
+        await dispatcher.stop()
+
+    @pytest.mark.anyio
+    async def test_retries_server_errors(self):
+        transport = MockExpoTransport([500, 429])
+        dispatcher = build_push_dispatcher(transport)
+        await dispatcher.start()
+
+        dispatcher.enqueue({"to": "token"})
+        await dispatcher.stop()
+
+        assert len(transport.batches) == 3
+
+    @pytest.mark.anyio
+    async def test_does_not_retry_client_errors(self):
+        transport = MockExpoTransport([400])
+        dispatcher = build_push_dispatcher(transport)
+        await dispatcher.start()
+
+        dispatcher.enqueue({"to": "token"})
+        await dispatcher.stop()
+
+        assert len(transport.batches) == 1
+
+    @pytest.mark.anyio
+    async def test_enqueue_from_thread(self):
+        transport = MockExpoTransport()
+        dispatcher = build_push_dispatcher(transport)
+        await dispatcher.start()
+
+        await asyncio.to_thread(dispatcher.enqueue, {"to": "token"})
+        await asyncio.sleep(0)
+        await dispatcher.stop()
+
+        assert transport.batches == [[{"to": "token"}]]
+
+    @pytest.mark.anyio
+    async def test_drops_when_not_running(self):
+        transport = MockExpoTransport()
+        dispatcher = build_push_dispatcher(transport)
+
+        dispatcher.enqueue({"to": "token"})
+        await dispatcher.start()
+        await dispatcher.stop()
+
+        assert transport.batches == []
+
+
+class TestPushAggregator:
+    def notify(self, aggregator: PushAggregator, content: str, chat_id: str = "chat123", token: str = "token") -> None:
+        aggregator.notify(token, chat_id, "alice", content, {
+            "type": "message", "params": {"id": chat_id, "user": "alice", "content": content}
+        })
+
+    def sent(self, dispatcher: Mock) -> list[dict]:
+        return [call.args[0] for call in dispatcher.enqueue.call_args_list]
+
+    @pytest.mark.anyio
+    async def test_collapses_bursts(self):
+        dispatcher = Mock(spec=PushDispatcher)
+        aggregator = PushAggregator(dispatcher, window=0.05)
+        await aggregator.start()
+
+        for n in range(6):
+            self.notify(aggregator, f"message {n}")
+
+        assert len(self.sent(dispatcher)) == 1
+
+        await asyncio.sleep(0.1)
+        sent = self.sent(dispatcher)
+
+        assert len(sent) == 2
+        assert sent[0]["title"] == "alice sent a new message"
+        assert sent[1]["title"] == "alice sent 5 new messages"
+        assert sent[1]["body"] == "message 5"
+        assert sent[1]["data"]["params"]["content"] == "message 5"
+
+        await aggregator.stop()
+
+    @pytest.mark.anyio
+    async def test_counts_batches(self):
+        dispatcher = Mock(spec=PushDispatcher)
+        aggregator = PushAggregator(dispatcher, window=0.05)
+        await aggregator.start()
+
+        aggregator.notify("token", "chat123", "alice", "first", {}, count=3)
+        aggregator.notify("token", "chat123", "alice", "second", {}, count=2)
+        aggregator.notify("token", "chat123", "alice", "third", {})
+        await asyncio.sleep(0.1)
+
+        assert [message["title"] for message in self.sent(dispatcher)] == [
+            "alice sent 3 new messages", "alice sent 3 new messages"]
+
+        await aggregator.stop()
+
+    @pytest.mark.anyio
+    async def test_keys_are_independent(self):
+        dispatcher = Mock(spec=PushDispatcher)
+        aggregator = PushAggregator(dispatcher, window=10)
+
+        self.notify(aggregator, "hi", chat_id="chat1")
+        self.notify(aggregator, "hi", chat_id="chat2")
+        self.notify(aggregator, "hi", chat_id="chat1", token="other")
+
+        assert len(self.sent(dispatcher)) == 3
+
+    @pytest.mark.anyio
+    async def test_idle_keys_are_evicted(self):
+        dispatcher = Mock(spec=PushDispatcher)
+        aggregator = PushAggregator(dispatcher, window=0.02)
+        await aggregator.start()
+
+        self.notify(aggregator, "hi")
+        assert len(aggregator) == 1
+
+        await asyncio.sleep(0.06)
+        assert len(aggregator) == 0
+
+        self.notify(aggregator, "hi again")
+        assert len(self.sent(dispatcher)) == 2
+
+        await aggregator.stop()
+
+    def test_memory_is_bounded(self):
+        dispatcher = Mock(spec=PushDispatcher)
+        aggregator = PushAggregator(dispatcher, window=10, max_keys=2)
+
+        self.notify(aggregator, "hi", chat_id="chat1")
+        self.notify(aggregator, "again", chat_id="chat1")
+        self.notify(aggregator, "hi", chat_id="chat2")
+        self.notify(aggregator, "hi", chat_id="chat3")
+
+        sent = self.sent(dispatcher)
+
+        assert len(aggregator) == 2
+        assert [message["data"]["params"]["id"] for message in sent] == [
+            "chat1", "chat2", "chat3", "chat1"]
+        assert sent[-1]["title"] == "alice sent a new message"
+
+    @pytest.mark.anyio
+    async def test_stop_flushes_pending(self):
+        dispatcher = Mock(spec=PushDispatcher)
+        aggregator = PushAggregator(dispatcher, window=10)
+        await aggregator.start()
+
+        self.notify(aggregator, "hi")
+        await asyncio.to_thread(self.notify, aggregator, "again")
+        await asyncio.sleep(0)
+        await aggregator.stop()
+
+        assert len(self.sent(dispatcher)) == 2
+
+
+class FakeWebSocket:
+    def __init__(self, send_delay: float = 0):
+        self.sent: list[dict] = []
+        self.close_code: int | None = None
+        self.send_delay = send_delay
+        self.disconnected = asyncio.Event()
+
+    async def send_json(self, data: dict) -> None:
+        await asyncio.sleep(self.send_delay)
+        self.sent.append(data)
+
+    async def receive(self) -> dict:
+        await self.disconnected.wait()
+        return {"type": "websocket.disconnect", "code": 1000}
+
+    async def close(self, code: int = 1000) -> None:
+        self.close_code = code
+
+
+class TestChatHub:
+    @pytest.mark.anyio
+    async def test_publishes_to_the_connections_of_the_chat(self):
+        hub = ChatHub()
+        alice, bob, other = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+        tasks = [
+            asyncio.create_task(hub.serve(alice, "chat123", 1)),
+            asyncio.create_task(hub.serve(bob, "chat123", 2)),
+            asyncio.create_task(hub.serve(other, "chat456", 3))
+        ]
+        await asyncio.sleep(0)
+
+        assert len(hub) == 3
+
+        hub.publish("chat123", {"type": "message.deleted"})
+        await asyncio.sleep(0.01)
+
+        assert alice.sent == bob.sent == [{"type": "message.deleted"}]
+        assert other.sent == []
+
+        for websocket in (alice, bob, other):
+            websocket.disconnected.set()
+
+        await asyncio.gather(*tasks)
+
+        assert len(hub) == 0
+        # The clients left, there is nothing to close
+        assert alice.close_code is None
+
+    @pytest.mark.anyio
+    async def test_drops_slow_consumers(self):
+        hub = ChatHub(queue_size=2, send_timeout=0.05)
+        slow = FakeWebSocket(send_delay=1)
+        task = asyncio.create_task(hub.serve(slow, "chat123", 1))
+        await asyncio.sleep(0)
+
+        for i in range(4):
+            hub.publish("chat123", {"type": "message.created", "i": i})
+            await asyncio.sleep(0)
+
+        await asyncio.wait_for(task, 1)
+
+        assert slow.close_code == 1013
+        assert len(hub) == 0
+
+    @pytest.mark.anyio
+    async def test_heartbeat_and_stop(self):
+        hub = ChatHub(heartbeat_interval=0.01)
+        await hub.start()
+        websocket = FakeWebSocket()
+        task = asyncio.create_task(hub.serve(websocket, "chat123", 1))
+
+        await asyncio.sleep(0.05)
+        await hub.stop()
+        await asyncio.wait_for(task, 1)
+
+        assert {"type": "ping"} in websocket.sent
+        assert websocket.close_code == 1001
+        assert not hub.running
+
+
+async def eventually(condition, timeout: float = 1) -> None:
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        await asyncio.sleep(0.005)
+
+
+class TestEventBus:
+    def test_create_event_bus(self, monkeypatch):
+        assert isinstance(create_event_bus(), InProcessEventBus)
+
+        monkeypatch.setenv("EVENT_BUS", "socket")
+        assert isinstance(create_event_bus(), SocketEventBus)
+
+        monkeypatch.setenv("EVENT_BUS", "kafka")
+        with pytest.raises(ValueError):
+            create_event_bus()
+
+    @pytest.mark.anyio
+    async def test_socket_bus_routes_by_subscription(self, tmp_path):
+        path = str(tmp_path / "events.sock")
+        broker = EventBroker(path)
+        await broker.start()
+
+        received: dict[str, list] = {"a": [], "b": []}
+        a, b = SocketEventBus(path, reconnect_delay=0.01), SocketEventBus(
+            path, reconnect_delay=0.01)
+        a.attach(lambda chat_id, event: received["a"].append((chat_id, event)))
+        b.attach(lambda chat_id, event: received["b"].append((chat_id, event)))
+
+        # Subscriptions made before connecting are sent on connection
+        b.subscribe("chat123")
+        await a.start()
+        await b.start()
+        await eventually(lambda: "chat123" in broker.routes and a.connected)
+
+        a.publish("chat123", {"type": "ping"})
+        a.publish("chat456", {"type": "ping"})
+        await eventually(lambda: len(received["b"]) == 1)
+
+        assert received["a"] == [
+            ("chat123", {"type": "ping"}), ("chat456", {"type": "ping"})]
+        assert received["b"] == [("chat123", {"type": "ping"})]
+
+        b.unsubscribe("chat123")
+        await eventually(lambda: "chat123" not in broker.routes)
+
+        await a.stop()
+        await b.stop()
+        await broker.stop()
+
+    @pytest.mark.anyio
+    async def test_users_cache_evictions_reach_every_worker(self, tmp_path, monkeypatch):
+        path = str(tmp_path / "events.sock")
+        broker = EventBroker(path)
+        await broker.start()
+
+        monkeypatch.setenv("EVENT_BUS", "socket")
+        monkeypatch.setenv("EVENT_BUS_SOCKET", path)
+        monkeypatch.setenv("EVENT_BUS_RECONNECT_DELAY", "0.01")
+        first, second = (
+            Container(users_service=build_users_service(),
+                      repository=create_autospec(AsyncFirebaseDB, instance=True))
+            for _ in range(2)
+        )
+        handler = Mock()
+        second.chat_hub.bus.attach(handler)
+
+        for worker in (first, second):
+            worker.users_service.cache.set("test", 200)
+            await worker.chat_hub.start()
+
+        await eventually(lambda: len(broker.routes.get(USERS_CACHE_CHANNEL, ())) == 2)
+
+        first.chat_hub.bus.publish(USERS_CACHE_CHANNEL, {"username": "test"})
+        await eventually(lambda: second.users_service.cache.get("test") is None)
+
+        assert first.users_service.cache.get("test") is None
+        # Channel events are not chat events
+        handler.assert_not_called()
+
+        for worker in (first, second):
+            await worker.chat_hub.stop()
+
+        await broker.stop()
+
+    @pytest.mark.anyio
+    async def test_hubs_share_events_through_the_broker(self, tmp_path):
+        path = str(tmp_path / "events.sock")
+        broker = EventBroker(path)
+        await broker.start()
+
+        first = ChatHub(bus=SocketEventBus(path, reconnect_delay=0.01))
+        second = ChatHub(bus=SocketEventBus(path, reconnect_delay=0.01))
+        await first.start()
+        await second.start()
+
+        websocket = FakeWebSocket()
+        task = asyncio.create_task(second.serve(websocket, "chat123", 2))
+        await eventually(lambda: "chat123" in broker.routes and first.bus.connected)  # type: ignore
+
+        first.publish("chat123", {"type": "message.deleted"})
+        await eventually(lambda: websocket.sent == [{"type": "message.deleted"}])
+
+        websocket.disconnected.set()
+        await task
+        await eventually(lambda: not broker.routes)
+
+        await first.stop()
+        await second.stop()
+        await broker.stop()
+
+
+class TestIdempotencyCache:
+    @pytest.mark.anyio
+    async def test_replays_the_first_response(self):
+        cache = IdempotencyCache(10, ttl=60)
+        calls = []
+
+        async def send() -> dict:
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"id": "msg123"}
+
+        # Concurrent retries wait for the first request
+        results = await asyncio.gather(*(cache.run("key", "Hello", send) for _ in range(3)))
+
+        assert [response for response, _ in results] == [{"id": "msg123"}] * 3
+        assert await cache.run("key", "Hello", send) == ({"id": "msg123"}, True)
+        assert len(calls) == 1
+
+    @pytest.mark.anyio
+    async def test_rejects_reused_keys(self):
+        cache = IdempotencyCache(10, ttl=60)
+
+        async def send() -> dict:
+            return {"id": "msg123"}
+
+        await cache.run("key", "Hello", send)
+
+        with pytest.raises(ValidationError):
+            await cache.run("key", "Bye", send)
+
+    @pytest.mark.anyio
+    async def test_rejects_concurrent_reused_keys(self):
+        cache = IdempotencyCache(10, ttl=60)
+        calls = []
+
+        async def send() -> dict:
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"id": "msg123"}
+
+        first, second = await asyncio.gather(
+            cache.run("key", "Hello", send), cache.run("key", "Bye", send),
+            return_exceptions=True)
+
+        assert first == ({"id": "msg123"}, False)
+        assert isinstance(second, ValidationError)
+        assert len(calls) == 1
+
+    @pytest.mark.anyio
+    async def test_does_not_keep_failures(self):
+        cache = IdempotencyCache(10, ttl=60)
+
+        async def fail() -> dict:
+            raise ServiceUnavailableError()
+
+        with pytest.raises(ServiceUnavailableError):
+            await cache.run("key", "Hello", fail)
+
+        assert len(cache) == 0
+
+    @pytest.mark.anyio
+    async def test_ttl(self, monkeypatch):
+        now = [0.0]
+        monkeypatch.setattr("utils.idempotency.time.monotonic", lambda: now[0])
+        cache = IdempotencyCache(10, ttl=60)
+
+        async def send() -> dict:
+            return {"id": "msg123"}
+
+        await cache.run("key", "Hello", send)
+        now[0] = 61.0
+
+        assert await cache.run("key", "Hello", send) == ({"id": "msg123"}, False)
+
+
+class TestRateLimiter:
+    def test_buckets_refill_lazily(self):
+        buckets = TokenBuckets(rate=2, burst=2, maxsize=10)
+
+        assert buckets.acquire(1, 0.0) == 0
+        assert buckets.acquire(1, 0.0) == 0
+        assert buckets.acquire(1, 0.0) == 0.5
+        assert buckets.acquire(1, 0.25) == 0.25
+        assert buckets.acquire(1, 0.5) == 0
+        # Refills never go over the burst
+        assert buckets.acquire(1, 100.0) == 0
+        assert buckets.acquire(1, 100.0) == 0
+        assert buckets.acquire(1, 100.0) > 0
+
+    def test_buckets_are_bounded(self):
+        buckets = TokenBuckets(rate=1, burst=1, maxsize=2)
+
+        for key in range(5):
+            buckets.acquire(key, 0.0)
+
+        assert len(buckets) == 2
+        # The oldest key was dropped and starts over with a full bucket
+        assert buckets.acquire(0, 0.0) == 0
+        assert buckets.acquire(4, 0.0) == 1
+
+    def test_buckets_drop_the_least_recently_used(self):
+        buckets = TokenBuckets(rate=1, burst=10, maxsize=2)
+
+        buckets.acquire("a", 0.0)
+        buckets.acquire("b", 0.0)
+        buckets.acquire("a", 0.0)
+        buckets.acquire("c", 0.0)
+
+        assert buckets.acquire("a", 0.0, 8) == 0
+        # b was dropped, a full bucket again
+        assert buckets.acquire("b", 0.0, 10) == 0
+
+    def test_buckets_cost(self):
+        buckets = TokenBuckets(rate=1, burst=5, maxsize=10)
+
+        assert buckets.acquire(1, 0.0, 3) == 0
+        assert buckets.acquire(1, 0.0, 3) == 1
+        assert buckets.acquire(1, 1.0, 3) == 0
+        # More than the burst takes the whole bucket
+        assert buckets.acquire(2, 0.0, 100) == 0
+        assert buckets.acquire(2, 0.0) == 1
+
+    def test_check(self):
+        limiter = RateLimiter(user_rate=1, user_burst=3, chat_rate=1, chat_burst=1)
+
+        limiter.check(1, "chat123")
+        limiter.check(1)
+
+        with pytest.raises(TooManyRequestsError) as e:
+            limiter.check(1, "chat123")
+
+        assert e.value.headers == {"Retry-After": "1"}
+
+        # Admins are not limited
+        for _ in range(10):
+            limiter.check(None, "chat123")
+
+    def test_check_takes_nothing_when_rejected(self):
+        limiter = RateLimiter(user_rate=1, user_burst=2, chat_rate=1, chat_burst=1)
+
+        limiter.check(1, "chat123")
+
+        with pytest.raises(TooManyRequestsError):
+            limiter.check(1, "chat123")
 
-app.add_middleware(BaseHTTPMiddleware,
-                   dispatch=JWTMiddleware(MockJWTService(), MockHTTPBearer()))
+        # The rejected write did not take the last token of the user
+        limiter.check(1, "chat456")
 
+    def test_check_cost(self):
+        limiter = RateLimiter(user_rate=1, user_burst=10, chat_rate=1, chat_burst=10)
 
-app.include_router(router, prefix="/chats", tags=["chats"])
+        limiter.check(1, "chat123", 6)
 
+        with pytest.raises(TooManyRequestsError) as e:
+            limiter.check(1, "chat123", 6)
 
-@app.exception_handler(Exception)
-async def exception_handler(request: Request, exc: Exception) -> JSONResponse:
-    return error_handler(request, exc)
+        assert e.value.headers == {"Retry-After": "2"}
 
 
-client = TestClient(app)
+class TestSingleFlight:
+    @pytest.mark.anyio
+    async def test_shares_exceptions(self):
+        calls = []
 
+        async def failing():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
 
-# Unit Tests
+        single_flight = SingleFlight()
+        results = await asyncio.gather(
+            *(single_flight.do("key", failing) for _ in range(3)),
+            return_exceptions=True
+        )
 
-class TestChatController:
-    def test_validate_users_success(self):
-        chat = ChatBase(user1=User(id=1, username="test1"),
-                        user2=User(id=2, username="test2"))
-        # Should not raise any exception
-        ChatController().validate_users(chat)
+        assert len(calls) == 1
+        assert all(isinstance(result, ValueError) for result in results)
+        assert len(single_flight) == 0
 
-    def test_validate_users_id_failure(self):
-        chat = ChatBase(user1=User(id=0, username="test1"),
-                        user2=User(id=2, username="test2"))
-        with pytest.raises(ValidationError):
-            ChatController().validate_users(chat)
+    @pytest.mark.anyio
+    async def test_cancelled_waiter_does_not_cancel_call(self):
+        async def slow():
+            await asyncio.sleep(0.01)
+            return "done"
 
-    def test_validate_users_username_failure(self):
-        chat = ChatBase(user1=User(id=1, username=""),
-                        user2=User(id=2, username="test2"))
-        with pytest.raises(ValidationError):
-            ChatController().validate_users(chat)
+        single_flight = SingleFlight()
+        first = asyncio.ensure_future(single_flight.do("key", slow))
+        second = asyncio.ensure_future(single_flight.do("key", slow))
+        await asyncio.sleep(0)
+        first.cancel()
 
+        assert await second == "done"
 
-class TestChatService:
-    def test_validate_message_success(self, mock_firebase):
-        mock_instance = mock_firebase.return_value
-        service = ChatService(mock_instance)
-        # Should not raise any exception
-        service.validate_message("Valid message")
 
-    def test_validate_message_too_long(self, mock_firebase):
-        mock_instance = mock_firebase.return_value
-        service = ChatService(mock_instance)
+class TestUserStatusCache:
+    def test_ttls(self, monkeypatch):
+        now = [0.0]
+        monkeypatch.setattr("service.users_service.time.monotonic", lambda: now[0])
 
-        with pytest.raises(MessageMaxLengthException):
-            service.validate_message("x" * 281)
+        cache = UserStatusCache(10, ttl=60, blocked_ttl=5, not_found_ttl=1)
+        cache.set("ok", 200)
+        cache.set("blocked", 403)
+        cache.set("missing", 404)
+        cache.set("failing", 500)
 
-    def test_create_chat(self, mock_firebase):
-        mock_instance = mock_firebase.return_value
-        mock_instance.create_chat.return_value = "chat123"
+        assert cache.get("failing") is None
 
-        service = ChatService(mock_instance)
-        chat = ChatBase(user1=User(id=1, username="test1"),
-                        user2=User(id=2, username="test2"))
-        result = service.create_chat(chat)
+        now[0] = 2.0
+        assert cache.get("missing") is None
+        assert cache.get("blocked") == 403
 
-        assert isinstance(result, Chat)
-        assert result.id == "chat123"
-        mock_instance.create_chat.assert_called_once_with(
-            User(id=1, username="test1"), User(id=2, username="test2"))
+        now[0] = 10.0
+        assert cache.get("blocked") is None
+        assert cache.get("ok") == 200
 
-    def test_send_message(self, mock_firebase):
-        mock_instance = mock_firebase.return_value
-        mock_instance.send_message.return_value = {
-            "id": "msg123",
-            "content": "Hello",
-            "sender_id": 1,
-            "created_at": datetime.now().isoformat()
-        }
+    def test_lru_eviction(self):
+        cache = UserStatusCache(2, ttl=60, blocked_ttl=5, not_found_ttl=5)
+        cache.set("a", 200)
+        cache.set("b", 200)
+        cache.get("a")
+        cache.set("c", 200)
 
-        service = ChatService(mock_instance)
-        message = MessageBase(content="Hello")
-        result = service.send_message(message, 1, "chat123")
+        assert cache.get("a") == 200
+        assert cache.get("b") is None
+        assert cache.stats()["size"] == 2
+
+    def test_invalidate(self):
+        cache = UserStatusCache(2, ttl=60, blocked_ttl=5, not_found_ttl=5)
+        cache.set("a", 200)
+
+        assert cache.invalidate("a")
+        assert not cache.invalidate("a")
+        assert cache.get("a") is None
 
-        assert isinstance(result, Message)
-        assert result.content == "Hello"
-        mock_instance.send_message.assert_called_once_with(
-            "chat123", 1, "Hello")
 
 # Integration Tests
 
@@ -180,11 +2128,7 @@ class TestChatRoutes:
         mock_instance = mock_firebase.return_value
         mock_instance.create_chat.return_value = "chat123"
 
-        with requests_mock.Mocker() as m:
-            m.get(
-                f"{getenv('USERS_SERVICE_URL')}/users/test",
-                json={"id": 1, "username": "test"}
-            )
+        with mock_users_service(json={"id": 1, "username": "test"}):
 
             response = client.post("/chats/", json=sample_chat_data)
 
@@ -197,11 +2141,7 @@ class TestChatRoutes:
             # missing user2_id
         }
 
-        with requests_mock.Mocker() as m:
-            m.get(
-                f"{getenv('USERS_SERVICE_URL')}/users/test",
-                json={"id": 1, "username": "test"}
-            )
+        with mock_users_service(json={"id": 1, "username": "test"}):
 
             response = client.post("/chats/", json=invalid_data)
             assert response.status_code == 422  # Validation error
@@ -215,11 +2155,7 @@ class TestChatRoutes:
             "created_at": datetime.now().isoformat()
         }
 
-        with requests_mock.Mocker() as m:
-            m.get(
-                f"{getenv('USERS_SERVICE_URL')}/users/test",
-                json={"id": 1, "username": "test"}
-            )
+        with mock_users_service(json={"id": 1, "username": "test"}):
 
             response = client.post(
                 "/chats/chat123",
@@ -229,6 +2165,249 @@ class TestChatRoutes:
             assert response.status_code == 201
             assert response.json()["content"] == sample_message_data["content"]
 
+    def test_send_message_queues_notification(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.send_message.return_value = {
+            "id": "msg123",
+            "content": "Hello",
+            "sender_id": 1,
+            "created_at": datetime.now().isoformat()
+        }
+        dispatcher = Mock(spec=PushDispatcher)
+        container.push_aggregator = PushAggregator(dispatcher)
+
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            response = client.post(
+                "/chats/chat123",
+                json={"content": "Hello", "receiver_expo_token": "ExponentPushToken[x]"}
+            )
+
+            assert response.status_code == 201
+            dispatcher.enqueue.assert_called_once_with({
+                "to": "ExponentPushToken[x]",
+                "sound": "default",
+                "title": "test sent a new message",
+                "body": "Hello",
+                "data": {"type": "message", "params": {"id": "chat123", "user": "test"}}
+            })
+
+    def test_send_message_idempotency_key(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.send_message.return_value = {
+            "id": "msg123",
+            "content": "Hello",
+            "sender_id": 1,
+            "created_at": "2024-01-01T00:00:00"
+        }
+        dispatcher = Mock(spec=PushDispatcher)
+        container.push_aggregator = PushAggregator(dispatcher)
+        body = {"content": "Hello", "receiver_expo_token": "ExponentPushToken[x]"}
+        headers = {"Idempotency-Key": "send-retry"}
+
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            first = client.post("/chats/chat123", json=body, headers=headers)
+            retry = client.post("/chats/chat123", json=body, headers=headers)
+            reused = client.post(
+                "/chats/chat123", json={"content": "Bye"}, headers=headers)
+
+        assert first.status_code == retry.status_code == 201
+        assert retry.json() == first.json()
+        assert "Idempotent-Replayed" not in first.headers
+        assert retry.headers["Idempotent-Replayed"] == "true"
+        assert reused.status_code == 400
+        mock_instance.send_message.assert_called_once()
+        dispatcher.enqueue.assert_called_once()
+
+    def test_edit_message_idempotency_key(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.edit_message.return_value = {
+            "id": "msg123",
+            "content": "Edited",
+            "sender_id": 1,
+            "created_at": "2024-01-01T00:00:00",
+            "edited_at": "2024-01-01T00:01:00"
+        }
+        headers = {"Idempotency-Key": "edit-retry"}
+
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            for _ in range(2):
+                response = client.patch(
+                    "/chats/chat123/messages/msg123", json={"content": "Edited"}, headers=headers)
+
+                assert response.status_code == 200
+                assert response.json()["content"] == "Edited"
+
+        mock_instance.edit_message.assert_called_once()
+
+    def test_send_message_rate_limited(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.send_message.return_value = {
+            "id": "msg123",
+            "content": "Hello",
+            "sender_id": 1,
+            "created_at": "2024-01-01T00:00:00"
+        }
+        limiter = container.rate_limiter
+        container.rate_limiter = RateLimiter(user_rate=0.1, user_burst=1)
+
+        try:
+            with mock_users_service(json={"id": 1, "username": "test"}):
+                first = client.post("/chats/chat123", json={"content": "Hello"})
+                second = client.post("/chats/chat123", json={"content": "Hello"})
+        finally:
+            container.rate_limiter = limiter
+
+        assert first.status_code == 201
+        assert second.status_code == 429
+        assert second.headers["Retry-After"] == "10"
+        assert second.json()["title"] == "TooManyRequestsError"
+        mock_instance.send_message.assert_called_once()
+
+    def test_replayed_idempotency_key_is_not_rate_limited(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.send_message.return_value = {
+            "id": "msg123",
+            "content": "Hello",
+            "sender_id": 1,
+            "created_at": "2024-01-01T00:00:00"
+        }
+        mock_instance.edit_message.return_value = {
+            **mock_instance.send_message.return_value,
+            "edited_at": "2024-01-01T00:01:00"
+        }
+        limiter = container.rate_limiter
+        container.rate_limiter = RateLimiter(user_rate=0.1, user_burst=2)
+
+        try:
+            with mock_users_service(json={"id": 1, "username": "test"}):
+                sent = [
+                    client.post("/chats/chat123", json={"content": "Hello"},
+                                headers={"Idempotency-Key": "limited-send-retry"})
+                    for _ in range(3)
+                ]
+                edited = [
+                    client.patch("/chats/chat123/messages/msg123", json={"content": "Hello"},
+                                 headers={"Idempotency-Key": "limited-edit-retry"})
+                    for _ in range(3)
+                ]
+                limited = client.post("/chats/chat123", json={"content": "Bye"})
+        finally:
+            container.rate_limiter = limiter
+
+        assert [response.status_code for response in sent] == [201, 201, 201]
+        assert [response.status_code for response in edited] == [200, 200, 200]
+        # Only the first send and the first edit took a token
+        assert limited.status_code == 429
+        mock_instance.send_message.assert_called_once()
+        mock_instance.edit_message.assert_called_once()
+
+    def test_mark_read(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.mark_read.return_value = "msg123"
+
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            with client.websocket_connect("/chats/chat123/ws") as websocket:
+                response = client.post("/chats/chat123/read")
+
+                assert websocket.receive_json() == {
+                    "type": "chat.read",
+                    "chat_id": "chat123",
+                    "user_id": 1,
+                    "message_id": "msg123"
+                }
+
+        assert response.status_code == 204
+        mock_instance.mark_read.assert_called_once_with("chat123", 1)
+
+    def test_send_messages_batch(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.send_messages.return_value = [
+            {"id": f"msg{n}", "content": f"message {n}", "sender_id": 1,
+                "created_at": "2024-01-01T00:00:00"}
+            for n in (1, 3)
+        ]
+        dispatcher = Mock(spec=PushDispatcher)
+        container.push_aggregator = PushAggregator(dispatcher)
+
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            response = client.post(
+                "/chats/chat123/messages:batch",
+                json={
+                    "messages": [{"content": " message 1 "}, {"content": "x" * 281}, {"content": "message 3"}],
+                    "receiver_expo_token": "ExponentPushToken[x]"
+                }
+            )
+
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [result["status"] for result in results] == [201, 400, 201]
+        assert results[0]["message"]["id"] == "msg1"
+        assert results[1]["error"]["title"] == "MAXIMUM 280 CHARACTERS"
+        mock_instance.send_messages.assert_called_once_with(
+            "chat123", 1, ["message 1", "message 3"])
+
+        dispatcher.enqueue.assert_called_once()
+        assert dispatcher.enqueue.call_args.args[0]["title"] == "test sent 2 new messages"
+        assert dispatcher.enqueue.call_args.args[0]["body"] == "message 3"
+
+    def test_send_messages_batch_rate_limited_per_message(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.send_messages.return_value = [
+            {"id": f"msg{n}", "content": "x", "sender_id": 1, "created_at": "2024-01-01T00:00:00"}
+            for n in range(3)
+        ]
+        limiter = container.rate_limiter
+        container.rate_limiter = RateLimiter(user_rate=0.1, user_burst=5)
+
+        try:
+            with mock_users_service(json={"id": 1, "username": "test"}):
+                first = client.post("/chats/chat123/messages:batch",
+                                    json={"messages": [{"content": "x"}] * 3})
+                second = client.post("/chats/chat123/messages:batch",
+                                     json={"messages": [{"content": "x"}] * 3})
+        finally:
+            container.rate_limiter = limiter
+
+        assert first.status_code == 200
+        assert second.status_code == 429
+        mock_instance.send_messages.assert_called_once()
+
+    def test_send_messages_batch_limits(self, mock_firebase):
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            assert client.post("/chats/chat123/messages:batch",
+                               json={"messages": []}).status_code == 422
+            assert client.post("/chats/chat123/messages:batch",
+                               json={"messages": [{"content": "x"}] * 101}).status_code == 422
+
+    def test_get_chats_success(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.get_inbox.return_value = ([], None)
+
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            response = client.get("/chats")
+
+            assert response.status_code == 200
+            assert response.json() == {"chats": [], "next_cursor": None}
+            mock_instance.get_inbox.assert_called_once_with(1, None, 20)
+
+    def test_get_messages_success(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.get_messages.return_value = ([], None)
+
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            response = client.get("/chats/chat123/messages?limit=20")
+
+            assert response.status_code == 200
+            assert response.json() == {"messages": [], "next_cursor": None}
+            mock_instance.get_messages.assert_called_once_with(
+                "chat123", 1, None, 20)
+
+    def test_get_messages_invalid_limit(self, mock_firebase):
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            response = client.get("/chats/chat123/messages?limit=1000")
+
+            assert response.status_code == 422
+
     def test_edit_message_success(self, mock_firebase, sample_message_data):
         mock_instance = mock_firebase.return_value
         mock_instance.edit_message.return_value = {
@@ -239,11 +2418,7 @@ class TestChatRoutes:
             "edited_at": datetime.now().isoformat()
         }
 
-        with requests_mock.Mocker() as m:
-            m.get(
-                f"{getenv('USERS_SERVICE_URL')}/users/test",
-                json={"id": 1, "username": "test"}
-            )
+        with mock_users_service(json={"id": 1, "username": "test"}):
 
             response = client.patch(
                 "/chats/chat123/messages/msg123",
@@ -256,11 +2431,7 @@ class TestChatRoutes:
     def test_delete_message_success(self, mock_firebase):
         mock_instance = mock_firebase.return_value
 
-        with requests_mock.Mocker() as m:
-            m.get(
-                f"{getenv('USERS_SERVICE_URL')}/users/test",
-                json={"id": 1, "username": "test"}
-            )
+        with mock_users_service(json={"id": 1, "username": "test"}):
 
             response = client.delete("/chats/chat123/messages/msg123")
 
@@ -270,114 +2441,162 @@ class TestChatRoutes:
             )
 
 
+    def test_chat_events_websocket(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.send_message.return_value = {
+            "id": "msg123",
+            "content": "Hello",
+            "sender_id": 1,
+            "created_at": "2024-01-01T00:00:00"
+        }
+
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            with client.websocket_connect("/chats/chat123/ws") as websocket:
+                client.post("/chats/chat123", json={"content": "Hello"})
+                client.delete("/chats/chat123/messages/msg123")
+
+                assert websocket.receive_json() == {
+                    "type": "message.created",
+                    "chat_id": "chat123",
+                    "message": {
+                        "id": "msg123",
+                        "content": "Hello",
+                        "sender_id": 1,
+                        "created_at": "2024-01-01T00:00:00",
+                        "edited_at": None
+                    }
+                }
+                assert websocket.receive_json() == {
+                    "type": "message.deleted",
+                    "chat_id": "chat123",
+                    "message_id": "msg123"
+                }
+
+        mock_instance.validate_participant.assert_called_once_with(
+            "chat123", 1)
+
+    def test_chat_events_websocket_rejects_non_participants(self, mock_firebase):
+        mock_instance = mock_firebase.return_value
+        mock_instance.validate_participant.side_effect = AuthenticationError(
+            "To read a chat you must be in it")
+
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            with pytest.raises(WebSocketDisconnect) as e:
+                with client.websocket_connect("/chats/chat123/ws") as websocket:
+                    websocket.receive_json()
+
+        assert e.value.code == 1008
+
+
+class TestUserRoutes:
+    def build_admin_client(self) -> TestClient:
+        class MockAdminJWTService(MockJWTService):
+            def verify(self, token: str) -> Union[dict, str]:
+                return {
+                    "username": "admin", 'email': "admin@gmail.com", "type": "admin"
+                }
+
+        app_aux = FastAPI()
+        app_aux.state.container = container
+
+        app_aux.add_middleware(JWTMiddleware, jwt_service=MockAdminJWTService(),
+                               security=MockHTTPBearer(), users_service=users_service)
+
+        app_aux.include_router(user_router, prefix="/users", tags=["users"])
+
+        return TestClient(app_aux)
+
+    def test_invalidate_user(self):
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            users_service.cache.set("test", 200)
+
+            response = self.build_admin_client().delete("/users/cache/test")
+
+            assert response.status_code == 204
+            assert users_service.cache.get("test") is None
+
+    def test_cache_stats(self):
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            response = self.build_admin_client().get("/users/cache/stats")
+
+            assert response.status_code == 200
+            assert set(response.json()) >= {"hits", "misses", "size"}
+
+    def test_user_can_not_manage_cache(self):
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            response = client.delete("/users/cache/test")
+
+            assert response.status_code == 403
+
+
 # Error handling tests
 
 
 class TestAuthentication:
     def test_invalid_auth_user_username(self):
-        with requests_mock.Mocker() as m:
-            m.get(
-                f"{getenv('USERS_SERVICE_URL')}/users/test",
-                json={"title": "Invalid username",
-                      "detail": "Invalid username provided"},
-                status_code=400
+        with mock_users_service(json={"title": "Invalid username", "detail": "Invalid username provided"}, status_code=400):
+            response = client.post(
+                "/chats/test-chat-id",
+                json={"content": "Hello"}
             )
 
-            with pytest.raises(Exception):
-                response = client.post(
-                    "/chats/test-chat-id",
-                    json={"content": "Hello"}
-                )
-
-                data = response.json()
+            data = response.json()
 
-                assert response.status_code == 400
-                assert data.detail == "Invalid username provided"
-                assert data.title == "Invalid username"
+            assert response.status_code == 400
+            assert data["detail"] == "Invalid username provided"
+            assert data["title"] == "Invalid username"
 
     def test_auth_user_blocked(self):
-        with requests_mock.Mocker() as m:
-            m.get(
-                f"{getenv('USERS_SERVICE_URL')}/users/test",
-                json={"title": "User blocked",
-                      "detail": "Blocked error"},
-                status_code=403
+        with mock_users_service(json={"title": "User blocked", "detail": "Blocked error"}, status_code=403):
+            response = client.post(
+                "/chats/test-chat-id",
+                json={"content": "Hello"}
             )
 
-            with pytest.raises(Exception):
-                response = client.post(
-                    "/chats/test-chat-id",
-                    json={"content": "Hello"}
-                )
-
-                data = response.json()
+            data = response.json()
 
-                assert response.status_code == 403
-                assert data.detail == "Blocked error"
-                assert data.title == "User blocked"
+            assert response.status_code == 403
+            assert data["detail"] == "Blocked error"
+            assert data["title"] == "User blocked"
 
     def test_auth_user_unauthorized(self):
-        with requests_mock.Mocker() as m:
-            m.get(
-                f"{getenv('USERS_SERVICE_URL')}/users/test",
-                json={"title": "AuthenticationError",
-                      "detail": ""},
-                status_code=401
+        with mock_users_service(json={"title": "AuthenticationError", "detail": ""}, status_code=401):
+            response = client.post(
+                "/chats/test-chat-id",
+                json={"content": "Hello"}
             )
 
-            with pytest.raises(Exception):
-                response = client.post(
-                    "/chats/test-chat-id",
-                    json={"content": "Hello"}
-                )
-
-                data = response.json()
+            data = response.json()
 
-                assert response.status_code == 401
-                assert data.detail == ""
-                assert data.title == "AuthenticationError"
+            assert response.status_code == 401
+            assert data["detail"] == ""
+            assert data["title"] == "AuthenticationError"
 
     def test_auth_user_not_found(self):
-        with requests_mock.Mocker() as m:
-            m.get(
-                f"{getenv('USERS_SERVICE_URL')}/users/test",
-                json={"title": "NotFoundError",
-                      "detail": "username test not found"},
-                status_code=404
+        with mock_users_service(json={"title": "NotFoundError", "detail": "username test not found"}, status_code=404):
+            response = client.post(
+                "/chats/test-chat-id",
+                json={"content": "Hello"}
             )
 
-            with pytest.raises(Exception):
-                response = client.post(
-                    "/chats/test-chat-id",
-                    json={"content": "Hello"}
-                )
-
-                data = response.json()
+            data = response.json()
 
-                assert response.status_code == 404
-                assert data.detail == "username test not found"
-                assert data.title == "NotFoundError"
+            assert response.status_code == 404
+            assert data["detail"] == "username test not found"
+            assert data["title"] == "NotFoundError"
 
     def test_service_unavailable(self):
-        with requests_mock.Mocker() as m:
-            m.get(
-                f"{getenv('USERS_SERVICE_URL')}/users/test",
-                json={"title": "ServiceUnavailableError",
-                      "detail": "Service unavailable"},
-                status_code=500
+        with mock_users_service(json={"title": "ServiceUnavailableError", "detail": "Service unavailable"}, status_code=500):
+            response = client.post(
+                "/chats/test-chat-id",
+                json={"content": "Hello"}
             )
 
-            with pytest.raises(Exception):
-                response = client.post(
-                    "/chats/test-chat-id",
-                    json={"content": "Hello"}
-                )
-
-                data = response.json()
+            data = response.json()
 
-                assert response.status_code == 500
-                assert data.detail == "Service unavailable"
-                assert data.title == "ServiceUnavailableError"
+            assert response.status_code == 503
+            assert data["detail"] == "Service unavailable"
+            assert data["title"] == "ServiceUnavailableError"
 
     def test_no_token(self):
         class MockHTTPBearer(HTTPBearer):
@@ -391,8 +2610,8 @@ class TestAuthentication:
 
         app_aux = FastAPI()
 
-        app_aux.add_middleware(BaseHTTPMiddleware,
-                               dispatch=JWTMiddleware(MockJWTService(), MockHTTPBearer()))
+        app_aux.add_middleware(JWTMiddleware, jwt_service=MockJWTService(),
+                               security=MockHTTPBearer(), users_service=build_users_service())
 
         app_aux.include_router(router, prefix="/chats", tags=["chats"])
 
@@ -402,36 +2621,226 @@ class TestAuthentication:
 
         client_aux = TestClient(app_aux)
 
-        with requests_mock.Mocker() as m:
-            m.get(
-                f"{getenv('USERS_SERVICE_URL')}/users/test",
-                json={"title": "AuthenticationError",
-                      "detail": ""},
-                status_code=401
+        with mock_users_service(json={"title": "AuthenticationError", "detail": ""}, status_code=401):
+            response = client_aux.post(
+                "/chats/test-chat-id",
+                json={"content": "Hello"}
             )
 
-            with pytest.raises(Exception):
-                response = client_aux.post(
-                    "/chats/test-chat-id",
-                    json={"content": "Hello"}
-                )
+            data = response.json()
+
+            assert response.status_code == 401
+            assert data["detail"] == ""
+            assert data["title"] == "AuthenticationError"
+
+
+    def test_public_paths_skip_authentication(self):
+        app_aux = FastAPI()
+
+        app_aux.add_middleware(JWTMiddleware, jwt_service=MockJWTService(),
+                               security=HTTPBearer(), users_service=build_users_service(),
+                               public_paths=["/health"])
+
+        @app_aux.get("/health")
+        def health() -> dict:
+            return {"status": "ok"}
+
+        @app_aux.get("/private")
+        def private() -> dict:
+            return {"status": "ok"}
+
+        client_aux = TestClient(app_aux)
+
+        assert client_aux.get("/health").status_code == 200
+        assert client_aux.get("/private").status_code == 403
+
+    def test_users_service_of_the_container(self):
+        app_aux = FastAPI()
+        app_aux.state.container = Container(users_service=Mock(spec=UsersService))
+
+        app_aux.add_middleware(JWTMiddleware, jwt_service=MockJWTService(),
+                               security=MockHTTPBearer())
+
+        @app_aux.get("/private")
+        def private() -> dict:
+            return {"status": "ok"}
+
+        client_aux = TestClient(app_aux)
+
+        assert client_aux.get("/private").status_code == 200
+
+        # Replacing the container after the middleware stack is built is enough
+        replacement = Container(users_service=Mock(spec=UsersService))
+        app_aux.state.container = replacement
+
+        assert client_aux.get("/private").status_code == 200
+        replacement.users_service.check_blocked.assert_awaited_once()
+
+    def test_websocket_token_query_parameter(self):
+        class CheckingJWTService(MockJWTService):
+            def verify(self, token: str) -> Union[dict, str]:
+                if token != "query-token":
+                    raise AuthenticationError()
+
+                return super().verify(token)
+
+        app_aux = FastAPI()
+
+        app_aux.add_middleware(JWTMiddleware, jwt_service=CheckingJWTService(),
+                               security=HTTPBearer(), users_service=build_users_service())
+
+        @app_aux.websocket("/ws")
+        async def ws(websocket: WebSocket) -> None:
+            await websocket.accept()
+            await websocket.send_json(websocket.state.user)
+            await websocket.close()
+
+        client_aux = TestClient(app_aux)
+
+        with client_aux.websocket_connect("/ws?token=query-token") as websocket:
+            assert websocket.receive_json()["userId"] == 1
+
+        with pytest.raises(WebSocketDisconnect) as e:
+            with client_aux.websocket_connect("/ws?token=other") as websocket:
+                websocket.receive_json()
+
+        assert e.value.code == 1008
+
+        with pytest.raises(WebSocketDisconnect):
+            with client_aux.websocket_connect("/ws") as websocket:
+                websocket.receive_json()
+
+class TestContainer:
+    @pytest.mark.anyio
+    async def test_lifecycle(self):
+        dispatcher = PushDispatcher(httpx.AsyncClient(transport=MockExpoTransport()))
+        service = UsersService(httpx.AsyncClient(
+            transport=users_service_transport), "http://users-service")
+        users_service_transport.requests = []
+        container = Container(
+            users_service=service,
+            repository=AsyncFirebaseDB(MemoryDatabase().reference(), ParticipantsCache()),
+            push_dispatcher=dispatcher
+        )
+
+        await container.start()
+
+        assert container.rtdb is None
+        assert dispatcher.running and container.push_aggregator.running
+        assert [str(request.url) for request in users_service_transport.requests] == [
+            "http://users-service"]
 
-                data = response.json()
+        await container.aclose()
 
-                assert response.status_code == 401
-                assert data.detail == ""
-                assert data.title == "AuthenticationError"
+        assert not dispatcher.running
+        assert service._client is None
+
+    @pytest.mark.anyio
+    async def test_warm_up_opens_database_connection(self):
+        transport = MockRTDBTransport({"": {"chats": True}})
+        credential = FakeCredential()
+        rtdb = RTDBClient(httpx.AsyncClient(transport=transport),
+                          "https://db.firebaseio.com", AccessTokenCache(lambda: credential))
+        container = Container(users_service=build_users_service(), rtdb=rtdb)
+
+        await container.warm_up()
+
+        assert credential.refreshes == 1
+        assert transport.requests[0].url.params["shallow"] == "true"
+
+        transport.status_codes = [500]
+        await container.warm_up()
+
+        await container.aclose()
+
+    def test_services_are_shared_by_requests(self):
+        services = set()
+        app_aux = FastAPI()
+        app_aux.state.container = container
+
+        @app_aux.get("/service")
+        async def service(chat_service: ChatService = Depends(get_chat_service)) -> dict:
+            services.add(id(chat_service))
+            return {}
+
+        client_aux = TestClient(app_aux)
+        client_aux.get("/service")
+        client_aux.get("/service")
+
+        assert services == {id(container.chat_service)}
+
+
+def metric_value(name: str, labels: str) -> float:
+    series = f"{name}{{{labels}}} " if labels else f"{name} "
+
+    for line in client.get("/metrics").text.splitlines():
+        if line.startswith(series):
+            return float(line.split()[-1])
+
+    return 0.0
+
+
+class TestMetrics:
+    def test_requests_are_labeled_by_route_template(self, mock_firebase):
+        mock_firebase.return_value.get_messages.return_value = ([], None)
+        labels = 'method="GET",route="/chats/{id}/messages",status="200"'
+        before = metric_value("http_request_duration_seconds_count", labels)
+
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            client.get("/chats/chat1/messages")
+            client.get("/chats/chat2/messages")
+
+        assert metric_value("http_request_duration_seconds_count", labels) == before + 2
+        assert metric_value("dependency_duration_seconds_count",
+                            'dependency="users_service",operation="check_blocked",outcome="ok"') > 0
+
+    def test_rejected_requests_keep_their_route(self):
+        labels = 'method="GET",route="/chats/{id}/messages",status="404"'
+        before = metric_value("http_request_duration_seconds_count", labels)
+
+        with mock_users_service(json={}, status_code=404):
+            client.get("/chats/chat1/messages")
+
+        assert metric_value("http_request_duration_seconds_count", labels) == before + 1
+
+    def test_unknown_paths_share_a_label(self):
+        before = metric_value("http_request_duration_seconds_count",
+                              'method="GET",route="unmatched",status="404"')
+
+        with mock_users_service(json={"id": 1, "username": "test"}):
+            client.get("/unknown/path")
+
+        assert metric_value("http_request_duration_seconds_count",
+                            'method="GET",route="unmatched",status="404"') == before + 1
+
+    def test_threadpool_is_reported(self):
+        assert metric_value("threadpool_tokens", "") == 40
+        assert metric_value("threadpool_in_use", "") == 0
+
+    @pytest.mark.anyio
+    async def test_timed_records_outcome(self):
+        @timed("test", "fails")
+        async def fails():
+            raise NotFoundError()
+
+        @timed("test")
+        def succeeds():
+            return 1
+
+        with pytest.raises(NotFoundError):
+            await fails()
+        assert succeeds() == 1
+
+        text = client.get("/metrics").text
+        assert 'dependency_duration_seconds_count{dependency="test",operation="fails",outcome="NotFoundError"} 1.0' in text
+        assert 'dependency_duration_seconds_count{dependency="test",operation="succeeds",outcome="ok"} 1.0' in text
 
 
 class TestErrorHandling:
     def test_message_too_long(self, mock_firebase):
         long_message = {"content": "x" * 281}
 
-        with requests_mock.Mocker() as m:
-            m.get(
-                f"{getenv('USERS_SERVICE_URL')}/users/test",
-                json={"id": 1, "username": "test"}
-            )
+        with mock_users_service(json={"id": 1, "username": "test"}):
 
             response = client.post(
                 "/chats/chat123",
@@ -444,11 +2853,7 @@ class TestErrorHandling:
         mock_instance = mock_firebase.return_value
         mock_instance.send_message.side_effect = Exception("Chat not found")
 
-        with requests_mock.Mocker() as m:
-            m.get(
-                f"{getenv('USERS_SERVICE_URL')}/users/test",
-                json={"id": 1, "username": "test"}
-            )
+        with mock_users_service(json={"id": 1, "username": "test"}):
 
             with pytest.raises(Exception):
                 response = client.post(
@@ -0,0 +1,232 @@
+import asyncio
+from collections import deque
+import logging
+from os import getenv
+import threading
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from utils.event_bus import IEventBus, InProcessEventBus
+
+# Close codes sent to clients
+GOING_AWAY = 1001
+TRY_AGAIN_LATER = 1013
+
+# Marks a connection the client already closed
+_GONE = 0
+
+
+class Connection:
+    __slots__ = ("chat_id", "user_id", "max_pending",
+                 "close_code", "_pending", "_wakeup")
+
+    def __init__(self, chat_id: str, user_id: int, max_pending: int):
+        """
+        A participant listening to a chat, with its bounded send queue
+
+        Args:
+            chat_id: The chat listened to
+            user_id: The participant
+            max_pending: Events kept before the connection is dropped as too slow
+        """
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.max_pending = max_pending
+        self.close_code: int | None = None
+        self._pending: deque[dict] = deque()
+        self._wakeup = asyncio.Event()
+
+    def push(self, event: dict) -> bool:
+        """Queue an event, False if the queue is full"""
+        if self.close_code is not None:
+            return True
+
+        if len(self._pending) >= self.max_pending:
+            return False
+
+        self._pending.append(event)
+        self._wakeup.set()
+
+        return True
+
+    def close(self, code: int) -> None:
+        if self.close_code is None:
+            self.close_code = code
+            self._pending.clear()
+            self._wakeup.set()
+
+    async def next(self) -> list[dict] | None:
+        """Wait for queued events, None once the connection is closed"""
+        await self._wakeup.wait()
+        self._wakeup.clear()
+
+        if self.close_code is not None:
+            return None
+
+        events = list(self._pending)
+        self._pending.clear()
+
+        return events
+
+
+class ChatHub:
+    def __init__(self, queue_size: int | None = None, heartbeat_interval: float | None = None, send_timeout: float | None = None, bus: IEventBus | None = None):
+        """
+        Fan out chat events to the WebSocket connections of this worker
+
+        Events are published through the bus, which hands them to the hub
+        of every worker with connections to the chat, this one included.
+
+        Each connection gets a bounded queue. A client that lets it fill up,
+        or takes too long to accept a frame, is disconnected instead of
+        holding memory. Idle connections only cost their queue and the
+        tasks serving them; a single task pings all of them.
+
+        Args:
+            queue_size: Events queued per connection, defaults to WS_QUEUE_SIZE
+            heartbeat_interval: Seconds between pings, defaults to WS_HEARTBEAT_INTERVAL
+            send_timeout: Seconds a frame may take to send, defaults to WS_SEND_TIMEOUT
+            bus: Carries events between workers, defaults to InProcessEventBus
+        """
+        self.queue_size = queue_size or int(getenv("WS_QUEUE_SIZE") or 100)
+        self.heartbeat_interval = heartbeat_interval or float(
+            getenv("WS_HEARTBEAT_INTERVAL") or 30.0)
+        self.send_timeout = send_timeout or float(
+            getenv("WS_SEND_TIMEOUT") or 10.0)
+
+        self.bus = bus or InProcessEventBus()
+        self.bus.attach(self._deliver)
+
+        self._chats: dict[str, set[Connection]] = {}
+        self._count = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _bind(self) -> None:
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.get_running_loop()
+            self._thread_id = threading.get_ident()
+
+    async def start(self) -> None:
+        if self.running:
+            return
+
+        self._bind()
+        await self.bus.start()
+        self._task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self) -> None:
+        """Close every connection"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        await self.bus.stop()
+
+        for connections in list(self._chats.values()):
+            for connection in list(connections):
+                connection.close(GOING_AWAY)
+
+    def publish(self, chat_id: str, event: dict) -> None:
+        """
+        Send an event to the connections of a chat, safe to call from any thread
+
+        Args:
+            chat_id: The chat the event belongs to
+            event: JSON serializable event
+        """
+        # A closed loop has no connection left to hand the event to
+        if self._loop is None or self._loop.is_closed() or threading.get_ident() == self._thread_id:
+            self.bus.publish(chat_id, event)
+        else:
+            self._loop.call_soon_threadsafe(self.bus.publish, chat_id, event)
+
+    def _deliver(self, chat_id: str, event: dict) -> None:
+        for connection in list(self._chats.get(chat_id, ())):
+            if not connection.push(event):
+                logging.warning(
+                    f"dropping slow websocket of user {connection.user_id} in chat {chat_id}")
+                connection.close(TRY_AGAIN_LATER)
+
+    async def serve(self, websocket: WebSocket, chat_id: str, user_id: int) -> None:
+        """
+        Send the events of a chat to an accepted websocket until it closes
+
+        Args:
+            websocket: The accepted websocket
+            chat_id: The chat listened to
+            user_id: The participant listening
+        """
+        self._bind()
+        connection = Connection(chat_id, user_id, self.queue_size)
+        connections = self._chats.get(chat_id)
+
+        if connections is None:
+            connections = self._chats[chat_id] = set()
+            # Only the chats with connections here are routed to this worker
+            self.bus.subscribe(chat_id)
+
+        connections.add(connection)
+        self._count += 1
+
+        receiver = asyncio.create_task(self._receive(websocket, connection))
+
+        try:
+            await self._send(websocket, connection)
+        finally:
+            receiver.cancel()
+            self._count -= 1
+            connections.discard(connection)
+
+            if not connections:
+                del self._chats[chat_id]
+                self.bus.unsubscribe(chat_id)
+
+    async def _receive(self, websocket: WebSocket, connection: Connection) -> None:
+        # Clients do not send anything, this only notices them leaving
+        while True:
+            message = await websocket.receive()
+
+            if message["type"] == "websocket.disconnect":
+                connection.close(_GONE)
+                return
+
+    async def _send(self, websocket: WebSocket, connection: Connection) -> None:
+        while True:
+            events = await connection.next()
+
+            if events is None:
+                break
+
+            try:
+                for event in events:
+                    await asyncio.wait_for(websocket.send_json(event), self.send_timeout)
+            except asyncio.TimeoutError:
+                logging.warning(
+                    f"websocket of user {connection.user_id} timed out, closing it")
+                connection.close(TRY_AGAIN_LATER)
+            except (WebSocketDisconnect, RuntimeError):
+                connection.close(_GONE)
+
+        if connection.close_code != _GONE:
+            try:
+                await websocket.close(connection.close_code)
+            except RuntimeError:
+                # The client left in the meantime
+                pass
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+
+            for chat_id in list(self._chats):
+                # Pings are local, other workers ping their own connections
+                self._deliver(chat_id, {"type": "ping"})
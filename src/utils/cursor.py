@@ -0,0 +1,40 @@
+import base64
+import binascii
+import json
+from typing import Any
+
+from models.errors.errors import ValidationError
+
+_INVALID = object()
+
+
+def encode_cursor(value: Any) -> str:
+    """Encode a pagination position as an opaque url safe string"""
+    return base64.urlsafe_b64encode(
+        json.dumps(value, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, expected_type: type = object) -> Any:
+    """
+    Decode a cursor built by `encode_cursor`
+
+    Args:
+        cursor: The opaque cursor sent by the client
+        expected_type: Type the decoded position must have
+
+    Raises:
+        ValidationError: If the cursor was not built by `encode_cursor`
+    """
+    try:
+        value = json.loads(base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        value = _INVALID
+
+    if value is _INVALID or not isinstance(value, expected_type):
+        raise ValidationError(
+            title="Invalid cursor",
+            detail="The cursor is not valid, use the one returned by the previous page"
+        )
+
+    return value
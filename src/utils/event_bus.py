@@ -0,0 +1,268 @@
+from abc import ABC, abstractmethod
+import asyncio
+import json
+import logging
+from os import getenv
+from typing import Callable
+
+# Receives the events of the chats this worker subscribed to
+EventHandler = Callable[[str, dict], None]
+# Receives the events of a channel every worker listens to
+ChannelHandler = Callable[[dict], None]
+
+DEFAULT_SOCKET_PATH = "/tmp/message-service-events.sock"
+
+# Channels are routed like chats, their names can not be push ids
+USERS_CACHE_CHANNEL = "users/cache"
+
+# Frames of the socket protocol, one JSON array per line
+SUBSCRIBE = "s"
+UNSUBSCRIBE = "u"
+PUBLISH = "p"
+
+
+def _frame(*fields) -> bytes:
+    return json.dumps(fields, separators=(",", ":")).encode() + b"\n"
+
+
+class IEventBus(ABC):
+    def __init__(self):
+        """
+        Pub/sub of chat events between the workers serving websockets
+
+        Publishing delivers the event to the handler of this worker and of
+        every other worker subscribed to the chat.
+        """
+        self.handler: EventHandler | None = None
+        self.listeners: dict[str, ChannelHandler] = {}
+
+    def attach(self, handler: EventHandler) -> None:
+        self.handler = handler
+
+    def listen(self, channel: str, handler: ChannelHandler) -> None:
+        """Hand the events of `channel` to `handler` instead of the attached one"""
+        self.listeners[channel] = handler
+        self.subscribe(channel)
+
+    def deliver(self, chat_id: str, event: dict) -> None:
+        listener = self.listeners.get(chat_id)
+
+        if listener is not None:
+            listener(event)
+        elif self.handler is not None:
+            self.handler(chat_id, event)
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    @abstractmethod
+    def publish(self, chat_id: str, event: dict) -> None:
+        pass
+
+    @abstractmethod
+    def subscribe(self, chat_id: str) -> None:
+        pass
+
+    @abstractmethod
+    def unsubscribe(self, chat_id: str) -> None:
+        pass
+
+
+class InProcessEventBus(IEventBus):
+    """Bus of a single worker, events never leave the process"""
+
+    def publish(self, chat_id: str, event: dict) -> None:
+        self.deliver(chat_id, event)
+
+    def subscribe(self, chat_id: str) -> None:
+        pass
+
+    def unsubscribe(self, chat_id: str) -> None:
+        pass
+
+
+class SocketEventBus(IEventBus):
+    def __init__(self, path: str | None = None, reconnect_delay: float | None = None, max_buffer: int | None = None):
+        """
+        Bus shared by the workers of a host through an EventBroker listening
+        on a Unix socket
+
+        The broker only forwards an event to the workers subscribed to its
+        chat. While the broker is unreachable events are still delivered
+        locally, and the subscriptions are sent again on reconnection.
+
+        Args:
+            path: Socket of the broker, defaults to EVENT_BUS_SOCKET
+            reconnect_delay: Seconds between connection attempts, defaults to EVENT_BUS_RECONNECT_DELAY
+            max_buffer: Bytes waiting to be written before events are dropped, defaults to EVENT_BUS_MAX_BUFFER
+        """
+        super().__init__()
+        self.path = path or getenv("EVENT_BUS_SOCKET") or DEFAULT_SOCKET_PATH
+        self.reconnect_delay = reconnect_delay or float(
+            getenv("EVENT_BUS_RECONNECT_DELAY") or 1.0)
+        self.max_buffer = max_buffer or int(
+            getenv("EVENT_BUS_MAX_BUFFER") or 1024 * 1024)
+
+        self.subscriptions: set[str] = set()
+        self._writer: asyncio.StreamWriter | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def publish(self, chat_id: str, event: dict) -> None:
+        self.deliver(chat_id, event)
+        self._write(_frame(PUBLISH, chat_id, event))
+
+    def subscribe(self, chat_id: str) -> None:
+        self.subscriptions.add(chat_id)
+        self._write(_frame(SUBSCRIBE, chat_id))
+
+    def unsubscribe(self, chat_id: str) -> None:
+        self.subscriptions.discard(chat_id)
+        self._write(_frame(UNSUBSCRIBE, chat_id))
+
+    def _write(self, frame: bytes) -> None:
+        if self._writer is None:
+            return
+
+        if self._writer.transport.get_write_buffer_size() > self.max_buffer:
+            logging.warning("event bus broker is not keeping up, dropping event")
+            return
+
+        self._writer.write(frame)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError as e:
+                logging.warning(f"could not connect to the event broker: {e!r}")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+
+            self._writer = writer
+
+            for chat_id in self.subscriptions:
+                writer.write(_frame(SUBSCRIBE, chat_id))
+
+            try:
+                await self._read(reader)
+            except (OSError, ValueError) as e:
+                logging.warning(f"lost the event broker: {e!r}")
+            finally:
+                self._writer = None
+                writer.close()
+
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _read(self, reader: asyncio.StreamReader) -> None:
+        while line := await reader.readline():
+            kind, chat_id, event = json.loads(line)
+
+            if kind == PUBLISH:
+                self.deliver(chat_id, event)
+
+
+class EventBroker:
+    def __init__(self, path: str | None = None, max_buffer: int | None = None):
+        """
+        Routes the events published by each worker to the other workers
+        subscribed to the chat
+
+        Args:
+            path: Socket to listen on, defaults to EVENT_BUS_SOCKET
+            max_buffer: Bytes waiting to be sent to a worker before its events are dropped, defaults to EVENT_BUS_MAX_BUFFER
+        """
+        self.path = path or getenv("EVENT_BUS_SOCKET") or DEFAULT_SOCKET_PATH
+        self.max_buffer = max_buffer or int(
+            getenv("EVENT_BUS_MAX_BUFFER") or 1024 * 1024)
+
+        self.routes: dict[str, set[asyncio.StreamWriter]] = {}
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_unix_server(self._serve, self.path)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        await self._server.serve_forever()  # type: ignore
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        chats: set[str] = set()
+
+        try:
+            while line := await reader.readline():
+                kind, chat_id = json.loads(line)[:2]
+
+                if kind == PUBLISH:
+                    self._forward(chat_id, line, writer)
+                elif kind == SUBSCRIBE:
+                    chats.add(chat_id)
+                    self.routes.setdefault(chat_id, set()).add(writer)
+                elif kind == UNSUBSCRIBE:
+                    chats.discard(chat_id)
+                    self._remove(chat_id, writer)
+        except (OSError, ValueError) as e:
+            logging.warning(f"dropping event bus worker: {e!r}")
+        finally:
+            for chat_id in chats:
+                self._remove(chat_id, writer)
+
+            writer.close()
+
+    def _forward(self, chat_id: str, line: bytes, sender: asyncio.StreamWriter) -> None:
+        for writer in self.routes.get(chat_id, ()):
+            if writer is sender:
+                continue
+
+            if writer.transport.get_write_buffer_size() > self.max_buffer:
+                logging.warning("event bus worker is not keeping up, dropping event")
+                continue
+
+            # Forwarded as received, there is no need to decode the event
+            writer.write(line)
+
+    def _remove(self, chat_id: str, writer: asyncio.StreamWriter) -> None:
+        writers = self.routes.get(chat_id)
+
+        if writers is not None:
+            writers.discard(writer)
+
+            if not writers:
+                del self.routes[chat_id]
+
+
+def create_event_bus() -> IEventBus:
+    """Build the bus selected by EVENT_BUS, memory (default) or socket"""
+    backend = getenv("EVENT_BUS") or "memory"
+
+    if backend == "socket":
+        return SocketEventBus()
+
+    if backend != "memory":
+        raise ValueError(f"Unknown EVENT_BUS backend {backend}")
+
+    return InProcessEventBus()
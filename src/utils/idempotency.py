@@ -0,0 +1,77 @@
+from os import getenv
+import time
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from cachetools import TTLCache
+
+from models.errors.errors import ValidationError
+from utils.single_flight import SingleFlight
+
+T = TypeVar("T")
+
+
+class IdempotencyCache:
+    def __init__(self, maxsize: int | None = None, ttl: float | None = None):
+        """
+        Bounded TTL cache of the responses of recent requests by
+        idempotency key, so client retries replay the first response
+
+        Retries arriving while the first request is still running wait for
+        it instead of running again.
+
+        Args:
+            maxsize: Maximum amount of keys kept, defaults to IDEMPOTENCY_CACHE_MAXSIZE
+            ttl: Seconds a response is kept, defaults to IDEMPOTENCY_CACHE_TTL
+        """
+        self.maxsize = maxsize or int(
+            getenv("IDEMPOTENCY_CACHE_MAXSIZE") or 10000)
+        self.ttl = ttl or float(getenv("IDEMPOTENCY_CACHE_TTL") or 3600)
+        self._cache: TTLCache = TTLCache(
+            self.maxsize, self.ttl, timer=time.monotonic)
+        self._flights = SingleFlight()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    async def run(self, key: Hashable, fingerprint: str, fn: Callable[[], Awaitable[T]]) -> tuple[T, bool]:
+        """
+        Run `fn` unless a request with the same key already did
+
+        Failed calls are not kept, so they can be retried.
+
+        Args:
+            key: Idempotency key, scoped to the user and the operation
+            fingerprint: Identifies the request, a key can not be reused for another one
+            fn: Factory of the awaitable to run on the first call
+
+        Returns:
+            tuple[T, bool]: The response and whether it was replayed
+
+        Raises:
+            ValidationError: The key was used for a different request
+        """
+        entry = self._cache.get(key)
+
+        if entry is not None:
+            _check_fingerprint(entry[0], fingerprint)
+            return entry[1], True
+
+        async def call() -> tuple[str, T]:
+            response = await fn()
+            self._cache[key] = (fingerprint, response)
+            return fingerprint, response
+
+        # Flights are shared by key alone, a concurrent request reusing the
+        # key for something else must be rejected, not run
+        stored_fingerprint, response = await self._flights.do(key, call)
+        _check_fingerprint(stored_fingerprint, fingerprint)
+
+        return response, False
+
+
+def _check_fingerprint(stored_fingerprint: str, fingerprint: str) -> None:
+    if stored_fingerprint != fingerprint:
+        raise ValidationError(
+            title="Idempotency key reused",
+            detail="The Idempotency-Key was already used for a different request"
+        )
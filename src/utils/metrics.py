@@ -0,0 +1,128 @@
+import functools
+import inspect
+import time
+from typing import Any, Callable, TypeVar
+
+import anyio.to_thread
+from prometheus_client import Gauge, Histogram
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Latency of HTTP requests by route template and status",
+    ["method", "route", "status"]
+)
+
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress",
+    "HTTP requests being served",
+    ["method"]
+)
+
+DEPENDENCY_LATENCY = Histogram(
+    "dependency_duration_seconds",
+    "Latency of calls to Firebase, the users service and Expo",
+    ["dependency", "operation", "outcome"]
+)
+
+THREADPOOL_TOKENS = Gauge(
+    "threadpool_tokens",
+    "Size of the thread pool sync routes and dependencies run on"
+)
+
+THREADPOOL_IN_USE = Gauge(
+    "threadpool_in_use",
+    "Threads of the pool currently busy"
+)
+
+THREADPOOL_WAITING = Gauge(
+    "threadpool_waiting",
+    "Tasks waiting for a thread of the pool"
+)
+
+
+def _threadpool_statistic(read: Callable[[anyio.CapacityLimiter], float]) -> Callable[[], float]:
+    def collect() -> float:
+        try:
+            return read(anyio.to_thread.current_default_thread_limiter())
+        except RuntimeError:
+            # Scraped outside of the event loop, the pool does not exist
+            return 0
+
+    return collect
+
+
+# Read when scraped so recording costs nothing
+THREADPOOL_TOKENS.set_function(_threadpool_statistic(
+    lambda limiter: limiter.total_tokens))
+THREADPOOL_IN_USE.set_function(_threadpool_statistic(
+    lambda limiter: limiter.borrowed_tokens))
+THREADPOOL_WAITING.set_function(_threadpool_statistic(
+    lambda limiter: limiter.statistics().tasks_waiting))
+
+
+class _Timer:
+    __slots__ = ("dependency", "operation", "children")
+
+    def __init__(self, dependency: str, operation: str):
+        self.dependency = dependency
+        self.operation = operation
+        # Resolving labels takes the metric lock, so children are kept around
+        self.children: dict[str, Any] = {}
+
+    def observe(self, outcome: str, seconds: float) -> None:
+        child = self.children.get(outcome)
+
+        if child is None:
+            child = self.children[outcome] = DEPENDENCY_LATENCY.labels(
+                self.dependency, self.operation, outcome)
+
+        child.observe(seconds)
+
+
+def timed(dependency: str, operation: str | None = None) -> Callable[[F], F]:
+    """
+    Record the latency of every call of a function in DEPENDENCY_LATENCY
+
+    The outcome label is "ok" or the name of the exception raised.
+
+    Args:
+        dependency: The service called, e.g. firebase
+        operation: Name of the call, defaults to the name of the function
+    """
+    def decorator(fn: F) -> F:
+        timer = _Timer(dependency, operation or fn.__name__)
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                outcome = "ok"
+
+                try:
+                    return await fn(*args, **kwargs)
+                except BaseException as e:
+                    outcome = type(e).__name__
+                    raise
+                finally:
+                    timer.observe(outcome, time.perf_counter() - start)
+
+            return async_wrapper  # type: ignore
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = "ok"
+
+            try:
+                return fn(*args, **kwargs)
+            except BaseException as e:
+                outcome = type(e).__name__
+                raise
+            finally:
+                timer.observe(outcome, time.perf_counter() - start)
+
+        return wrapper  # type: ignore
+
+    return decorator
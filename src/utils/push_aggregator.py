@@ -0,0 +1,148 @@
+import asyncio
+from collections import OrderedDict
+import logging
+from os import getenv
+import threading
+import time
+
+from utils.push_dispatcher import PushDispatcher
+from utils.sendNotification import send_push_notification
+
+
+class _CollapseWindow:
+    __slots__ = ("ends_at", "count", "sender", "body", "data")
+
+    def __init__(self, ends_at: float):
+        self.ends_at = ends_at
+        self.count = 0
+        self.sender = ""
+        self.body = ""
+        self.data: dict = {}
+
+
+class PushAggregator:
+    def __init__(self, dispatcher: PushDispatcher, window: float | None = None, max_keys: int | None = None):
+        """
+        Collapse bursts of message notifications per receiver and chat
+
+        The first notification of a (receiver, chat) pair is sent right away
+        and opens a window. Notifications arriving inside it are merged into
+        a single "{sender} sent N new messages" push sent when it closes.
+        Pairs that stay idle for a whole window are forgotten.
+
+        Args:
+            dispatcher: Dispatcher the notifications are handed to
+            window: Seconds a window stays open, defaults to PUSH_COLLAPSE_WINDOW
+            max_keys: Open windows kept in memory, defaults to PUSH_COLLAPSE_MAX_KEYS
+        """
+        self.dispatcher = dispatcher
+        self.window = window if window is not None else float(
+            getenv("PUSH_COLLAPSE_WINDOW") or 5.0)
+        self.max_keys = max_keys or int(
+            getenv("PUSH_COLLAPSE_MAX_KEYS") or 10000)
+
+        # Windows are opened in order so the first one always closes first
+        self._windows: OrderedDict[tuple[str, str], _CollapseWindow] = OrderedDict()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        if self.running:
+            return
+
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Send every pending merged notification"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        while self._windows:
+            self._close(*self._windows.popitem(last=False))
+
+    def notify(self, expo_token: str, chat_id: str, sender: str, body: str, data: dict, count: int = 1) -> None:
+        """
+        Notify a receiver of a new message, safe to call from any thread
+
+        Args:
+            expo_token: Expo push token of the receiver
+            chat_id: Chat the message was sent to
+            sender: Username of the sender
+            body: Content of the message
+            data: Payload of the notification, the latest one wins
+            count: Messages the notification stands for
+        """
+        if not self.running or threading.get_ident() == self._thread_id:
+            self._notify(expo_token, chat_id, sender, body, data, count)
+        else:
+            self._loop.call_soon_threadsafe(  # type: ignore
+                self._notify, expo_token, chat_id, sender, body, data, count)
+
+    def _notify(self, expo_token: str, chat_id: str, sender: str, body: str, data: dict, count: int = 1) -> None:
+        key = (expo_token, chat_id)
+        now = time.monotonic()
+        window = self._windows.get(key)
+
+        if window is not None and (window.count or now < window.ends_at):
+            window.count += count
+            window.sender = sender
+            window.body = body
+            window.data = data
+            return
+
+        self._send(expo_token, sender, count, body, data)
+
+        self._windows.pop(key, None)
+        self._windows[key] = _CollapseWindow(now + self.window)
+
+        while len(self._windows) > self.max_keys:
+            self._close(*self._windows.popitem(last=False))
+
+    def _close(self, key: tuple[str, str], window: _CollapseWindow) -> None:
+        if window.count:
+            self._send(key[0], window.sender, window.count,
+                       window.body, window.data)
+
+    def _sweep(self) -> float:
+        now = time.monotonic()
+
+        while self._windows:
+            key, window = next(iter(self._windows.items()))
+
+            if now < window.ends_at:
+                return window.ends_at - now
+
+            del self._windows[key]
+
+            if window.count:
+                # Merged pushes open a new window, idle pairs are forgotten
+                self._close(key, window)
+                self._windows[key] = _CollapseWindow(now + self.window)
+
+        return self.window
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                delay = self._sweep()
+            except Exception:
+                logging.exception("push aggregator sweep failed")
+                delay = self.window
+
+            await asyncio.sleep(delay)
+
+    def _send(self, expo_token: str, sender: str, count: int, body: str, data: dict) -> None:
+        title = f"{sender} sent a new message" if count == 1 else f"{sender} sent {count} new messages"
+
+        send_push_notification(self.dispatcher, expo_token, title, body, data)
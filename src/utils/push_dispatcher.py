@@ -0,0 +1,195 @@
+import asyncio
+import logging
+from os import getenv
+import threading
+
+import httpx
+
+from utils.metrics import timed
+
+EXPO_PUSH_URL = 'https://exp.host/--/api/v2/push/send'
+
+# Expo rejects requests carrying more than 100 messages
+EXPO_MAX_BATCH_SIZE = 100
+
+_STOP = object()
+
+
+class PushDispatcher:
+    def __init__(self, client: httpx.AsyncClient | None = None, url: str = EXPO_PUSH_URL, batch_size: int | None = None, flush_interval: float | None = None, max_retries: int | None = None, retry_backoff: float | None = None, max_queue_size: int | None = None):
+        """
+        Background sender of Expo push notifications
+
+        Messages are queued in memory and a single task posts them to Expo in
+        batches, reusing one pooled HTTP client.
+
+        Args:
+            client: Preconfigured async client, mostly useful for tests
+            url: Expo push endpoint
+            batch_size: Messages per request, at most 100, defaults to PUSH_BATCH_SIZE
+            flush_interval: Seconds to wait for a batch to fill, defaults to PUSH_FLUSH_INTERVAL
+            max_retries: Retries of a failed batch, defaults to PUSH_MAX_RETRIES
+            retry_backoff: Base seconds of the exponential backoff, defaults to PUSH_RETRY_BACKOFF
+            max_queue_size: Messages kept before dropping new ones, defaults to PUSH_QUEUE_SIZE
+        """
+        self.url = url
+        self.batch_size = min(
+            batch_size or int(getenv("PUSH_BATCH_SIZE") or EXPO_MAX_BATCH_SIZE), EXPO_MAX_BATCH_SIZE)
+        self.flush_interval = flush_interval if flush_interval is not None else float(
+            getenv("PUSH_FLUSH_INTERVAL") or 0.05)
+        self.max_retries = max_retries if max_retries is not None else int(
+            getenv("PUSH_MAX_RETRIES") or 3)
+        self.retry_backoff = retry_backoff if retry_backoff is not None else float(
+            getenv("PUSH_RETRY_BACKOFF") or 0.5)
+        self.max_queue_size = max_queue_size or int(
+            getenv("PUSH_QUEUE_SIZE") or 10000)
+
+        self._client = client
+        self._queue: asyncio.Queue | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._getter: asyncio.Future | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        if self.running:
+            return
+
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(float(getenv("PUSH_TIMEOUT") or 10.0)),
+                limits=httpx.Limits(max_keepalive_connections=10),
+                headers={
+                    "Accept": "application/json",
+                    'Accept-encoding': 'gzip, deflate',
+                    'Content-Type': 'application/json'
+                }
+            )
+
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._queue = asyncio.Queue(self.max_queue_size)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """
+        Send every queued message, then close the HTTP client
+
+        Args:
+            timeout: Seconds to wait for the queue to drain
+        """
+        if self.running:
+            self._put(_STOP, force=True)
+
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout)  # type: ignore
+            except asyncio.TimeoutError:
+                logging.error(
+                    f"push dispatcher did not drain in {timeout}s, dropping {self._queue.qsize()} messages")  # type: ignore
+                self._task.cancel()  # type: ignore
+
+        self._task = None
+
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def enqueue(self, message: dict) -> None:
+        """
+        Queue a push message, safe to call from any thread
+
+        Args:
+            message: An Expo push message
+        """
+        if not self.running:
+            logging.warning(
+                f"push dispatcher is not running, dropping notification to {message.get('to')}")
+            return
+
+        if threading.get_ident() == self._thread_id:
+            self._put(message)
+        else:
+            self._loop.call_soon_threadsafe(self._put, message)  # type: ignore
+
+    def _put(self, message: object, force: bool = False) -> None:
+        try:
+            self._queue.put_nowait(message)  # type: ignore
+        except asyncio.QueueFull:
+            if not force:
+                logging.warning("push queue is full, dropping notification")
+                return
+
+            # The stop marker always goes in, the loop drains one slot at a time
+            self._loop.call_later(  # type: ignore
+                self.flush_interval, self._put, message, force)
+
+    async def _get(self, timeout: float | None = None) -> object:
+        if self._getter is None:
+            self._getter = asyncio.ensure_future(self._queue.get())  # type: ignore
+
+        done, _ = await asyncio.wait({self._getter}, timeout=timeout)
+
+        if not done:
+            raise asyncio.TimeoutError()
+
+        message = self._getter.result()
+        self._getter = None
+
+        return message
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            message = await self._get()
+
+            if message is _STOP:
+                break
+
+            batch = [message]
+            deadline = loop.time() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                try:
+                    message = await self._get(max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+
+                if message is _STOP:
+                    stopping = True
+                    break
+
+                batch.append(message)
+
+            await self._send(batch)
+
+    @timed("expo", "send_batch")
+    async def _send(self, batch: list) -> None:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self._client.post(self.url, json=batch)  # type: ignore
+            except httpx.HTTPError as e:
+                logging.warning(f"push batch failed: {e!r}")
+            else:
+                if response.is_success:
+                    logging.debug(f"{len(batch)} notifications sent")
+                    return
+
+                if response.status_code != 429 and response.status_code < 500:
+                    logging.error(
+                        f"push batch rejected with {response.status_code}: {response.text}")
+                    return
+
+                logging.warning(
+                    f"push batch failed with {response.status_code}")
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+
+        logging.error(
+            f"dropping {len(batch)} notifications after {self.max_retries} retries")
@@ -0,0 +1,55 @@
+import random
+import threading
+import time
+
+# Same alphabet and layout as the ids Firebase push() generates, so ids sort
+# lexicographically by creation time
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+
+class PushIdGenerator:
+    def __init__(self):
+        """
+        Thread safe generator of 20 character Firebase push ids
+
+        The first 8 characters encode the timestamp in milliseconds and the
+        last 12 are random. Ids generated in the same millisecond increment
+        the random part so they still sort in generation order.
+        """
+        self._lock = threading.Lock()
+        self._last_time = 0
+        self._last_random: list[int] = [0] * 12
+
+    def __call__(self) -> str:
+        with self._lock:
+            now = int(time.time() * 1000)
+            duplicate_time = now <= self._last_time
+
+            if duplicate_time:
+                # Keep ids monotonic even if the clock goes backwards
+                now = self._last_time
+                self._increment_random()
+            else:
+                self._last_random = [random.randrange(64) for _ in range(12)]
+
+            self._last_time = now
+
+            time_chars = []
+            for _ in range(8):
+                time_chars.append(PUSH_CHARS[now % 64])
+                now //= 64
+
+            return ''.join(reversed(time_chars)) + ''.join(PUSH_CHARS[n] for n in self._last_random)
+
+    def _increment_random(self) -> None:
+        position = 11
+
+        while position >= 0 and self._last_random[position] == 63:
+            self._last_random[position] = 0
+            position -= 1
+
+        if position >= 0:
+            self._last_random[position] += 1
+
+
+generate_push_id = PushIdGenerator()
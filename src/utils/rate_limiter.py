@@ -0,0 +1,165 @@
+import math
+from os import getenv
+import time
+from typing import Hashable
+
+from models.errors.errors import TooManyRequestsError
+
+
+class TokenBuckets:
+    __slots__ = ("interval", "capacity", "increment", "maxsize", "_tats")
+
+    def __init__(self, rate: float, burst: float, maxsize: int):
+        """
+        Token buckets by key, refilled lazily when a key is used
+
+        Each bucket is stored as the single time at which it would be full
+        again (the generic cell rate algorithm), so there is no timer per
+        key and a key costs one float. When `maxsize` keys are tracked the
+        least recently used one is dropped, which at worst hands that key a
+        full bucket again.
+
+        Args:
+            rate: Tokens added per second
+            burst: Capacity of each bucket
+            maxsize: Maximum amount of keys tracked
+        """
+        self.interval = 1 / rate
+        self.capacity = burst * self.interval
+        # Time taken by a single token, which is the common cost
+        self.increment = min(self.interval, self.capacity)
+        self.maxsize = maxsize
+        # Kept in order of use, the first key is the least recently used
+        self._tats: dict[Hashable, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._tats)
+
+    def acquire(self, key: Hashable, now: float, cost: float = 1) -> float:
+        """
+        Take `cost` tokens from the bucket of `key`
+
+        A cost over the burst needs the whole bucket, or it could never pass.
+
+        Returns:
+            float: 0 if they were taken, otherwise the seconds until they are available
+        """
+        tats = self._tats
+        # Popped and set again so the key moves to the end, as the most
+        # recently used. A missing key and a time in the past are both a
+        # full bucket, so a rejected take can put back `now` in either case.
+        tat = tats.pop(key, None)
+
+        if tat is None:
+            if len(tats) >= self.maxsize:
+                del tats[next(iter(tats))]
+
+            tat = now
+        elif tat < now:
+            tat = now
+
+        new_tat = tat + (self.increment if cost == 1 else min(cost * self.interval, self.capacity))
+        wait = new_tat - now - self.capacity
+
+        if wait > 0:
+            tats[key] = tat
+            return wait
+
+        tats[key] = new_tat
+        return 0.0
+
+
+class RateLimiter:
+    def __init__(self, user_rate: float | None = None, user_burst: float | None = None, chat_rate: float | None = None, chat_burst: float | None = None, maxsize: int | None = None):
+        """
+        Per user and per chat limits of the write routes
+
+        Only used from the event loop, so it takes no lock.
+
+        Args:
+            user_rate: Writes per second of a user, defaults to RATE_LIMIT_USER_RATE
+            user_burst: Writes a user can make at once, defaults to RATE_LIMIT_USER_BURST
+            chat_rate: Writes per second in a chat, defaults to RATE_LIMIT_CHAT_RATE
+            chat_burst: Writes that can be made at once in a chat, defaults to RATE_LIMIT_CHAT_BURST
+            maxsize: Maximum amount of users and of chats tracked, defaults to RATE_LIMIT_MAXSIZE
+        """
+        maxsize = maxsize or int(getenv("RATE_LIMIT_MAXSIZE") or 100000)
+
+        self.users = TokenBuckets(
+            user_rate or float(getenv("RATE_LIMIT_USER_RATE") or 5),
+            user_burst or float(getenv("RATE_LIMIT_USER_BURST") or 20),
+            maxsize
+        )
+        self.chats = TokenBuckets(
+            chat_rate or float(getenv("RATE_LIMIT_CHAT_RATE") or 10),
+            chat_burst or float(getenv("RATE_LIMIT_CHAT_BURST") or 40),
+            maxsize
+        )
+
+    def check(self, user_id: int | None, chat_id: str | None = None, cost: int = 1) -> None:
+        """
+        Count writes of a user, in a chat if they target one
+
+        Tokens are only taken when both the user and the chat have them.
+
+        Args:
+            user_id: The user writing, None for admins, which are not limited
+            chat_id: The chat written to
+            cost: Amount of writes, like the messages of a batch
+
+        Raises:
+            TooManyRequestsError: The user or the chat is over its limit
+        """
+        if user_id is None:
+            return
+
+        # Both buckets are TokenBuckets.acquire inlined, as this runs on
+        # every write
+        now = time.monotonic()
+        users = self.users
+        user_tats = users._tats
+        user_tat = user_tats.pop(user_id, None)
+
+        if user_tat is None:
+            if len(user_tats) >= users.maxsize:
+                del user_tats[next(iter(user_tats))]
+
+            user_tat = now
+        elif user_tat < now:
+            user_tat = now
+
+        new_user_tat = user_tat + (
+            users.increment if cost == 1 else min(cost * users.interval, users.capacity))
+        wait = new_user_tat - now - users.capacity
+
+        if chat_id is None:
+            if wait > 0:
+                user_tats[user_id] = user_tat
+                raise TooManyRequestsError(math.ceil(wait))
+
+            user_tats[user_id] = new_user_tat
+            return
+
+        chats = self.chats
+        chat_tats = chats._tats
+        chat_tat = chat_tats.pop(chat_id, None)
+
+        if chat_tat is None:
+            if len(chat_tats) >= chats.maxsize:
+                del chat_tats[next(iter(chat_tats))]
+
+            chat_tat = now
+        elif chat_tat < now:
+            chat_tat = now
+
+        new_chat_tat = chat_tat + (
+            chats.increment if cost == 1 else min(cost * chats.interval, chats.capacity))
+        chat_wait = new_chat_tat - now - chats.capacity
+
+        if wait > 0 or chat_wait > 0:
+            user_tats[user_id] = user_tat
+            chat_tats[chat_id] = chat_tat
+            raise TooManyRequestsError(math.ceil(max(wait, chat_wait)))
+
+        user_tats[user_id] = new_user_tat
+        chat_tats[chat_id] = new_chat_tat
@@ -1,8 +1,9 @@
-import requests
-import logging
+from utils.metrics import timed
+from utils.push_dispatcher import PushDispatcher
 
 
-def send_push_notification(expoPushToken: str, title: str, body: str, data: dict = {}, sound: str = 'default') -> None:
+@timed("expo", "enqueue")
+def send_push_notification(dispatcher: PushDispatcher, expoPushToken: str, title: str, body: str, data: dict = {}, sound: str = 'default') -> None:
     message: dict = {
         "to": expoPushToken,
         "sound": sound,
@@ -11,15 +12,4 @@ def send_push_notification(expoPushToken: str, title: str, body: str, data: dict
         "data": data
     }
 
-    headers: dict = {
-        "host": "exp.host",
-        "Accept": "application/json",
-        'Accept-encoding': 'gzip, deflate',
-        'Content-Type': 'application/json'
-    }
-
-    r = requests.post('https://exp.host/--/api/v2/push/send',
-                      json=message, headers=headers)
-
-    if r.ok:
-        logging.debug("notification sent to, ", expoPushToken)
+    dispatcher.enqueue(message)
@@ -0,0 +1,48 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    def __init__(self):
+        """
+        Coalesce concurrent calls sharing a key into a single in-flight call
+
+        Every caller waiting on a key gets the result, or the exception, of
+        the one call that is actually running.
+        """
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run `fn` unless a call for `key` is already in flight
+
+        Args:
+            key: Identifies calls that can share a result
+            fn: Factory of the awaitable to run on the first call
+
+        Returns:
+            T: The result of the shared call
+        """
+        future = self._calls.get(key)
+
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(
+                lambda done: self._forget(key, done))
+
+        # A cancelled waiter must not cancel the call the others wait on
+        return await asyncio.shield(future)
+
+    def _forget(self, key: Hashable, future: asyncio.Future) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+        if not future.cancelled():
+            # Mark the exception as retrieved even if every waiter went away
+            future.exception()